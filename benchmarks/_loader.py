@@ -0,0 +1,42 @@
+import os
+import sys
+import types
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import a module from the comfy/ folder without running comfy/__init__.py, which needs a running ComfyUI
+def load_sd_ppp_module(name):
+    if 'sd_ppp' not in sys.modules:
+        package = types.ModuleType('sd_ppp')
+        package.__path__ = [os.path.join(ROOT, 'comfy')]
+        sys.modules['sd_ppp'] = package
+    return importlib.import_module('sd_ppp.' + name)
+
+# bare PromptServer stand-in so apis.py can register its routes on a plain aiohttp app, benchmarks and tests only
+def install_prompt_server():
+    from aiohttp import web
+    class PromptServer:
+        instance = None
+        def __init__(self):
+            self.routes = web.RouteTableDef()
+            self.loop = None
+            self.client_id = None
+            self.last_prompt_id = None
+            self.sent_events = 0
+        def send_sync(self, event, data, sid=None):
+            self.sent_events += 1
+    module = types.ModuleType('server')
+    module.PromptServer = PromptServer
+    PromptServer.instance = PromptServer()
+    sys.modules['server'] = module
+    return PromptServer.instance
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
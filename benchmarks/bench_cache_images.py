@@ -0,0 +1,69 @@
+# compares the old per image float conversion of cache_images with the vectorized uint8 one
+# every run happens in a fresh process so peak rss belongs to that run only
+#   python benchmarks/bench_cache_images.py --batch 16 --width 2048 --height 2048
+import argparse
+import time
+import multiprocessing
+import numpy as np
+import torch
+from _loader import load_sd_ppp_module, peak_rss_mb
+
+def legacy_convert(images):
+    ret = []
+    for image in images:
+        i = 255. * image.cpu().numpy()
+        ret.append(np.clip(i, 0, 255).astype(np.uint8))
+    return ret
+
+def vectorized_convert(images):
+    return list(load_sd_ppp_module('utils').images_to_uint8(images))
+
+VARIANTS = {
+    'legacy': legacy_convert,
+    'vectorized': vectorized_convert,
+}
+
+def run_variant(variant, batch, height, width, device, repeat, queue):
+    images = torch.rand((batch, height, width, 3), dtype=torch.float32, device=device)
+    convert = VARIANTS[variant]
+    # warm up, also loads the module before measuring
+    convert(images[:1])
+    baseline_rss = peak_rss_mb()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = convert(images)
+        timings.append(time.perf_counter() - start)
+        del frames
+    peak_rss = peak_rss_mb()
+    queue.put({
+        'variant': variant,
+        'best_s': min(timings),
+        'mean_s': sum(timings) / len(timings),
+        'peak_rss_over_input_mb': None if peak_rss is None else peak_rss - baseline_rss,
+    })
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    input_mb = args.batch * args.height * args.width * 3 * 4 / 1024 / 1024
+    print(f'batch={args.batch} size={args.width}x{args.height} device={args.device} input={input_mb:.0f}MB')
+    for variant in VARIANTS:
+        queue = context.Queue()
+        process = context.Process(target=run_variant, args=(variant, args.batch, args.height, args.width, args.device, args.repeat, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        peak = result['peak_rss_over_input_mb']
+        peak_str = 'n/a' if peak is None else f'{peak:.0f}MB'
+        print(f"{result['variant']:>10}: best {result['best_s'] * 1000:.0f}ms mean {result['mean_s'] * 1000:.0f}ms peak rss growth {peak_str}")
+
+if __name__ == '__main__':
+    main()
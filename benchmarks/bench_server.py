@@ -0,0 +1,160 @@
+# drives the sd-ppp routes and PhotoshopInstance methods with mock photoshop instances and simulated comfyui clients
+# the routes are hosted on a bare aiohttp app, every scenario (image size x batch) runs in a fresh process
+#   python benchmarks/bench_server.py --instances 4 --clients 2 --sizes 512,2048 --batches 1,4 --edit
+import argparse
+import asyncio
+import time
+import multiprocessing
+import aiohttp
+from aiohttp import web
+from _loader import load_sd_ppp_module, install_prompt_server, peak_rss_mb
+from mock_photoshop import MockPhotoshop, make_documents, PROTOCOL_FEATURES, SUPPORTED_CODECS, SUPPORTED_MESSAGE_CODECS
+
+def percentile(values, percent):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+class Scenario:
+    def __init__(self, args, size, batch):
+        self.args = args
+        self.size = size
+        self.batch = batch
+        self.latencies = {}
+
+    async def timed(self, operation, coroutine):
+        started_at = time.perf_counter()
+        result = await coroutine
+        self.latencies.setdefault(operation, []).append(time.perf_counter() - started_at)
+        return result
+
+    async def post(self, session, url, query, data):
+        async with session.post(url, params=query, json=data) as response:
+            return await response.json()
+
+    # what nodes.SendImageToPhotoshopNode does, minus the hop from the prompt thread
+    async def send_images(self, instance, document_id, layer_id, images):
+        loop = asyncio.get_running_loop()
+        if instance.supports('binary_push'):
+            frames = await loop.run_in_executor(None, self.utils.images_to_rgba_frames, images, instance.codec)
+            return await instance.send_images(document_id, layer_id, frames=frames)
+        image_ids, crops = await loop.run_in_executor(None, self.utils.cache_images, images, instance, instance.codec)
+        return await instance.send_images(document_id, layer_id, image_ids=image_ids, crops=crops)
+
+    async def client(self, session, url, mock, client_index):
+        import torch
+        document = mock.documents[0]
+        # each client works on its own layer, identical requests would only be coalesced
+        layer_id = document.layers[client_index % len(document.layers)]['id']
+        document_str = f'{document.name} (id:{document.id})'
+        query = {'client_id': f'bench-{mock.user_id}-{client_index}', 'user_id': str(mock.user_id)}
+        # matches the client with its photoshop like the comfyui page does on load
+        await self.timed('getlayers', self.post(session, url + '/sd-ppp/getlayers', dict(query, now='true'), {'document_str_list': [document_str]}))
+        instance = self.manager.instance_from_client_info('127.0.0.1', query['client_id'], query['user_id'])
+        if instance is None:
+            raise RuntimeError(f"client {query['client_id']} was not matched with a photoshop instance")
+        images = torch.rand((self.batch, self.size, self.size, 3), dtype=torch.float32)
+        for _ in range(self.args.iterations):
+            if self.args.edit:
+                document.edit(layer_id)
+                await mock.push_history(document)
+            await self.timed('checkchanges', self.post(session, url + '/sd-ppp/checkchanges', query, {'document_str_list': [document_str]}))
+            await self.timed('get_image', instance.get_image(document.id, layer_id, False))
+            await self.timed('send_images', self.send_images(instance, document.id, layer_id, images))
+
+    async def run(self):
+        prompt_server = install_prompt_server()
+        load_sd_ppp_module('apis')
+        self.manager = load_sd_ppp_module('photoshop_manager').PhotoshopManager.instance()
+        self.utils = load_sd_ppp_module('utils')
+        prompt_server.loop = asyncio.get_running_loop()
+        app = web.Application(client_max_size=4 * 1024 * 1024 * 1024)
+        app.add_routes(prompt_server.routes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+        features = PROTOCOL_FEATURES if self.args.features is None else [feature for feature in self.args.features.split(',') if feature]
+        codecs = SUPPORTED_CODECS if self.args.codecs is None else self.args.codecs.split(',')
+        message_codecs = SUPPORTED_MESSAGE_CODECS if self.args.message_codecs is None else self.args.message_codecs.split(',')
+        mocks = [MockPhotoshop(url, user_id, make_documents(1, self.size, self.size, self.args.layers), features, codecs, message_codecs) for user_id in range(1, self.args.instances + 1)]
+        session = aiohttp.ClientSession()
+        runs = []
+        try:
+            for mock in mocks:
+                await mock.connect(session)
+            runs = [asyncio.ensure_future(mock.run()) for mock in mocks]
+            # version 2 connections are ready once the handshake arrived
+            await asyncio.wait_for(asyncio.gather(*[mock.connected.wait() for mock in mocks]), 10)
+            baseline_rss = peak_rss_mb()
+            started_at = time.perf_counter()
+            await asyncio.gather(*[self.client(session, url, mock, client_index) for mock in mocks for client_index in range(self.args.clients)])
+            elapsed = time.perf_counter() - started_at
+            peak_rss = peak_rss_mb()
+        finally:
+            for mock in mocks:
+                await mock.close()
+            await session.close()
+            await runner.cleanup()
+        await asyncio.gather(*runs, return_exceptions=True)
+        return {
+            'size': self.size,
+            'batch': self.batch,
+            'codec': mocks[0].handshake.get('codec', 'png') if mocks[0].handshake else 'png',
+            'message_codec': mocks[0].handshake.get('message_codec', 'json') if mocks[0].handshake else 'json',
+            'elapsed_s': elapsed,
+            'peak_rss_mb': peak_rss,
+            'peak_rss_growth_mb': None if peak_rss is None else peak_rss - baseline_rss,
+            'operations': {
+                operation: {
+                    'count': len(latencies),
+                    'per_s': len(latencies) / elapsed if elapsed > 0 else 0,
+                    'p50_ms': percentile(latencies, 50) * 1000,
+                    'p99_ms': percentile(latencies, 99) * 1000,
+                } for (operation, latencies) in self.latencies.items()
+            },
+        }
+
+def run_scenario(args, size, batch, queue):
+    try:
+        queue.put(asyncio.run(Scenario(args, size, batch).run()))
+    except Exception as e:
+        queue.put({'size': size, 'batch': batch, 'error': repr(e)})
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=2, help='mock photoshop instances')
+    parser.add_argument('--clients', type=int, default=2, help='simulated comfyui clients per instance')
+    parser.add_argument('--iterations', type=int, default=5, help='checkchanges + get_image + send_images rounds per client')
+    parser.add_argument('--layers', type=int, default=8)
+    parser.add_argument('--sizes', default='512,2048', help='square document sizes')
+    parser.add_argument('--batches', default='1,4', help='images per send_images')
+    parser.add_argument('--features', default=None, help='protocol features the mocks announce, empty for none, all by default')
+    parser.add_argument('--codecs', default=None, help='encodings the mocks announce, all by default')
+    parser.add_argument('--message-codecs', default=None, help='message encodings the mocks announce, all by default')
+    parser.add_argument('--edit', action='store_true', help='edit and push the document before every round, otherwise get_image is served from cache after the first round')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    print(f'instances={args.instances} clients/instance={args.clients} iterations={args.iterations} edit={args.edit}')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for batch in [int(batch) for batch in args.batches.split(',')]:
+            queue = context.Queue()
+            process = context.Process(target=run_scenario, args=(args, size, batch, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            if 'error' in result:
+                print(f"{size}x{size} batch {batch}: failed {result['error']}")
+                continue
+            peak = result['peak_rss_mb']
+            peak_str = 'n/a' if peak is None else f"{peak:.0f}MB (+{result['peak_rss_growth_mb']:.0f}MB)"
+            print(f"{size}x{size} batch {batch} codec {result['codec']} messages {result['message_codec']}: {result['elapsed_s']:.2f}s peak rss {peak_str}")
+            for (operation, stats) in result['operations'].items():
+                print(f"  {operation:>13}: {stats['count']:4d} calls {stats['per_s']:8.1f}/s p50 {stats['p50_ms']:8.1f}ms p99 {stats['p99_ms']:8.1f}ms")
+
+if __name__ == '__main__':
+    main()
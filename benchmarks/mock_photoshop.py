@@ -0,0 +1,308 @@
+# stand-in photoshop plugin speaking the /photoshop_instance websocket protocol with synthetic documents,
+# for benchmarking without photoshop, either driven by bench_server.py or pointed at a running comfyui
+#   python benchmarks/mock_photoshop.py --url http://127.0.0.1:8188 --instances 4 --width 2048 --height 2048
+import argparse
+import asyncio
+import hashlib
+import json
+import aiohttp
+import numpy as np
+from _loader import load_sd_ppp_module
+
+PROTOCOL_VERSION = 2
+PROTOCOL_FEATURES = ['binary_push', 'batch', 'layer_delta', 'bulk_images', 'tile_delta', 'resume']
+SUPPORTED_CODECS = ['zlib', 'raw', 'png']
+SUPPORTED_MESSAGE_CODECS = ['msgpack', 'json']
+
+class MockDocument:
+    def __init__(self, document_id, width, height, layer_count):
+        self.id = document_id
+        self.name = f'Mock {document_id}.psd'
+        self.width = width
+        self.height = height
+        self.layers = [{'id': document_id * 1000 + index + 1, 'name': f'Layer {index + 1}'} for index in range(layer_count)]
+        self.history_state_id = document_id * 100000 + 1
+        self.pixels = {}
+        self.rng = np.random.default_rng(document_id)
+
+    # layer 0 is the canvas, pixels are noise so compression doesn't flatter the numbers
+    def layer_pixels(self, layer_id):
+        pixels = self.pixels.get(layer_id, None)
+        if pixels is None:
+            pixels = self.rng.integers(0, 256, (self.height, self.width, 4), dtype=np.uint8)
+            pixels[..., 3] = 255
+            self.pixels[layer_id] = pixels
+        return pixels
+
+    # a brush stroke sized change, touches at most four tiles
+    def edit(self, layer_id=None, size=64):
+        if layer_id is None:
+            layer_id = self.layers[0]['id'] if len(self.layers) > 0 else 0
+        pixels = self.layer_pixels(layer_id)
+        top = int(self.rng.integers(0, max(1, self.height - size)))
+        left = int(self.rng.integers(0, max(1, self.width - size)))
+        pixels[top:top + size, left:left + size, :3] = self.rng.integers(0, 256, 3, dtype=np.uint8)
+        self.history_state_id += 1
+        return self.history_state_id
+
+class MockPhotoshop:
+    def __init__(self, url, user_id=0, documents=None, features=None, codecs=None, message_codecs=None):
+        self.url = url.rstrip('/')
+        self.user_id = user_id
+        self.documents = documents if documents is not None else [MockDocument(1, 1024, 1024, 8)]
+        self.features = PROTOCOL_FEATURES if features is None else features
+        self.codecs = SUPPORTED_CODECS if codecs is None else codecs
+        self.message_codecs = SUPPORTED_MESSAGE_CODECS if message_codecs is None else message_codecs
+        self.protocol = load_sd_ppp_module('protocol')
+        self.pixel_codecs = load_sd_ppp_module('pixel_codecs')
+        self.message_codec_module = load_sd_ppp_module('message_codecs')
+        self.session = None
+        self.ws = None
+        self.handshake = None
+        self.connected = asyncio.Event()
+        self.binary_frames = {}
+        self.tasks = set()
+        self.call_counts = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def find_document(self, document_id):
+        if document_id == 0:
+            return self.documents[0]
+        for document in self.documents:
+            if document.id == document_id:
+                return document
+        raise ValueError(f'Document(id: {document_id}) not found')
+
+    async def connect(self, session=None):
+        self.session = session or aiohttp.ClientSession()
+        query = f'version={PROTOCOL_VERSION}&features={",".join(self.features)}&codecs={",".join(self.codecs)}&message_codecs={",".join(self.message_codecs)}&user_id={self.user_id}'
+        # reconnects resume the session of the last handshake like the plugin does
+        if self.handshake is not None and self.handshake.get('session', None):
+            query += f"&session={self.handshake['session']}"
+        self.ws = await self.session.ws_connect(self.url.replace('http://', 'ws://') + '/photoshop_instance?' + query, max_msg_size=0)
+        return self
+
+    # runs until the server closes the connection
+    async def run(self):
+        async for msg in self.ws:
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                self.bytes_in += len(msg.data)
+                if msg.data[0] == self.protocol.BINARY_FRAME_MESSAGE:
+                    _, _, data = self.protocol.unpack_binary_frame(msg.data)
+                    self.on_payload(self.message_codec_module.get_message_codec('msgpack').loads(data))
+                else:
+                    self.on_binary_message(msg.data)
+            elif msg.type == aiohttp.WSMsgType.TEXT:
+                self.bytes_in += len(msg.data)
+                self.on_payload(json.loads(msg.data))
+        self.connected.clear()
+
+    def on_payload(self, payload):
+        if 'handshake' in payload:
+            self.handshake = payload['handshake']
+            self.connected.set()
+        elif 'action' in payload:
+            # the plugin handles calls concurrently too
+            task = asyncio.ensure_future(self.on_call(payload))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.session is not None:
+            await self.session.close()
+
+    # what HistoryChecker does after a document changed
+    async def push_history(self, document):
+        await self.send_message({'push_data': {'history_state_id': {str(document.id): document.history_state_id}}})
+
+    # in the encoding the server picked in the handshake
+    async def send_message(self, payload):
+        codec = self.message_codec_module.get_message_codec((self.handshake or {}).get('message_codec', 'json'))
+        if codec.binary:
+            data = self.protocol.pack_binary_frame(self.protocol.BINARY_FRAME_MESSAGE, {}, codec.dumps(payload))
+            self.bytes_out += len(data)
+            await self.ws.send_bytes(data)
+        else:
+            data = codec.dumps(payload)
+            self.bytes_out += len(data)
+            await self.ws.send_str(data)
+
+    def on_binary_message(self, data):
+        kind, header, payload = self.protocol.unpack_binary_frame(data)
+        frames = self.binary_frames.setdefault(header['call_id'], {})
+        if kind == self.protocol.BINARY_FRAME_IMAGE:
+            frames[header['index']] = (header, bytes(payload))
+        elif kind == self.protocol.BINARY_FRAME_IMAGE_BUNDLE:
+            for (index, frame_header) in enumerate(header['frames'], header.get('first', 0)):
+                frames[index] = (frame_header, bytes(payload[frame_header['offset']:frame_header['offset'] + frame_header['length']]))
+
+    async def on_call(self, payload):
+        try:
+            if payload['action'] == 'batch':
+                result = await self.run_batch(payload)
+            else:
+                result = await self.run_action(payload['call_id'], payload['action'], payload['params'])
+            message = {'call_id': payload['call_id'], 'result': result}
+        except Exception as e:
+            message = {'call_id': payload['call_id'], 'error': str(e)}
+        if not self.ws.closed:
+            await self.send_message(message)
+
+    async def run_batch(self, payload):
+        results = []
+        for call in payload['params']['calls']:
+            try:
+                results.append({'result': await self.run_action(payload['call_id'], call['action'], call['params'])})
+            except Exception as e:
+                results.append({'error': str(e)})
+        return {'results': results}
+
+    async def run_action(self, call_id, action, params):
+        self.call_counts[action] = self.call_counts.get(action, 0) + 1
+        handler = getattr(self, 'action_' + action, None)
+        if handler is None:
+            return {}
+        return await handler(call_id, params)
+
+    async def action_get_active_history_state_id(self, call_id, params):
+        history_state_ids = []
+        for document_id in params['document_id_list']:
+            try:
+                history_state_ids.append(self.find_document(document_id).history_state_id)
+            except ValueError:
+                history_state_ids.append(0)
+        return {'history_state_id': history_state_ids}
+
+    async def action_get_layers(self, call_id, params):
+        known_versions = params.get('known_versions', None)
+        layer_trees = []
+        for document in self.documents:
+            if known_versions is not None and known_versions.get(str(document.id), None) == document.history_state_id:
+                layer_trees.append({'id': document.id, 'version': document.history_state_id, 'unchanged': True})
+            else:
+                layer_trees.append({'id': document.id, 'version': document.history_state_id, 'layers': document.layers})
+        return {
+            'layers': layer_trees,
+            'documents': [{'id': document.id, 'name': document.name} for document in self.documents],
+            'active_document_id': self.documents[0].id,
+        }
+
+    # always the whole canvas, bounds layers are not simulated
+    async def action_get_image(self, call_id, params):
+        document = self.find_document(params['document_id'])
+        skip_if_history_state_id = params.get('skip_if_history_state_id', None)
+        if skip_if_history_state_id is not None and skip_if_history_state_id == document.history_state_id:
+            return {'skipped': True, 'history_state_id': document.history_state_id}
+        pixels = document.layer_pixels(params['layer_id'])
+        encoding = params.get('encoding', None) or 'png'
+        codec = self.pixel_codecs.get_codec(encoding)
+        result = {'layer_opacity': 100, 'history_state_id': document.history_state_id, 'encoding': encoding, 'width': document.width, 'height': document.height}
+        data = None
+        tile_delta = params.get('tile_delta', None)
+        if tile_delta is not None:
+            tile_size = tile_delta['tile_size']
+            tile_hashes = self.hash_tiles(pixels, tile_size)
+            result.update({'tile_hashes': tile_hashes, 'tile_size': tile_size})
+            if tile_delta.get('hashes', None) is not None and tile_delta.get('width', None) == document.width and tile_delta.get('height', None) == document.height:
+                tiles = [index for (index, tile_hash) in enumerate(tile_hashes) if tile_delta['hashes'][index] != tile_hash]
+                tile_codec = codec if codec.rgba else self.pixel_codecs.get_codec('raw')
+                result.update({'delta': True, 'tiles': tiles, 'encoding': tile_codec.name})
+                if len(tiles) == 0:
+                    result.update({'upload_key': 0, 'upload_name': 0})
+                    return result
+                data = tile_codec.compress(self.collect_tiles(pixels, tile_size, tiles))
+        if data is None:
+            data = await asyncio.get_running_loop().run_in_executor(None, codec.encode, pixels)
+        upload_url = params.get('upload_url', None)
+        response = await self.upload(data, upload_url or '/upload/image')
+        if upload_url:
+            result.update({'upload_key': response['upload_key'], 'upload_name': 0})
+        else:
+            result.update({'upload_key': 0, 'upload_name': response['name']})
+        return result
+
+    # placing only bumps the document history, like photoshop does
+    async def action_send_images(self, call_id, params):
+        document = self.find_document(params['document_id'])
+        image_ids = params['image_ids']
+        if params.get('binary', False):
+            frames = self.binary_frames.pop(call_id, {})
+            if len(frames) != len(image_ids):
+                raise ValueError(f'Expected {len(image_ids)} binary frames, got {len(frames)}')
+        else:
+            for image_id in image_ids:
+                async with self.session.get(self.url + '/finished_images', params={'id': str(image_id)}) as response:
+                    if response.content_type == 'application/json':
+                        raise ValueError((await response.json())['error'])
+                    self.bytes_in += len(await response.read())
+        document.history_state_id += 1
+        return {'history_state_id': document.history_state_id}
+
+    async def upload(self, data, url):
+        form = aiohttp.FormData()
+        form.add_field('image', data, filename='PhotoshopBlob.png', content_type='application/octet-stream')
+        self.bytes_out += len(data)
+        async with self.session.post(self.url + url, data=form) as response:
+            result = await response.json()
+        if 'error' in result:
+            raise ValueError(result['error'])
+        return result
+
+    # any stable hash works, the server only compares them
+    def hash_tiles(self, pixels, tile_size):
+        height, width = pixels.shape[:2]
+        return [
+            hashlib.blake2b(np.ascontiguousarray(pixels[top:top + tile_size, left:left + tile_size]).tobytes(), digest_size=8).hexdigest()
+            for top in range(0, height, tile_size)
+            for left in range(0, width, tile_size)
+        ]
+
+    def collect_tiles(self, pixels, tile_size, tiles):
+        tiles_x = (pixels.shape[1] + tile_size - 1) // tile_size
+        return b''.join(
+            np.ascontiguousarray(pixels[(index // tiles_x) * tile_size:(index // tiles_x + 1) * tile_size, (index % tiles_x) * tile_size:(index % tiles_x + 1) * tile_size]).tobytes()
+            for index in tiles
+        )
+
+def make_documents(count, width, height, layer_count):
+    return [MockDocument(document_id, width, height, layer_count) for document_id in range(1, count + 1)]
+
+async def main_async(args):
+    mocks = [MockPhotoshop(args.url, user_id, make_documents(args.documents, args.width, args.height, args.layers)) for user_id in range(1, args.instances + 1)]
+    session = aiohttp.ClientSession()
+    try:
+        for mock in mocks:
+            await mock.connect(session)
+        runs = [asyncio.ensure_future(mock.run()) for mock in mocks]
+        print(f'{len(mocks)} mock photoshop instances connected to {args.url}, user ids 1-{len(mocks)}')
+        while True:
+            await asyncio.sleep(args.edit_interval if args.edit_interval > 0 else 1)
+            if args.edit_interval > 0:
+                for mock in mocks:
+                    document = mock.documents[0]
+                    document.edit()
+                    await mock.push_history(document)
+            if all(run.done() for run in runs):
+                break
+    finally:
+        for mock in mocks:
+            await mock.close()
+        await session.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8188')
+    parser.add_argument('--instances', type=int, default=1)
+    parser.add_argument('--documents', type=int, default=1)
+    parser.add_argument('--layers', type=int, default=8)
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--edit-interval', type=float, default=0, help='seconds between simulated edits of the first document, 0 for none')
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,27 @@
 from server import PromptServer
 from aiohttp import web
-from io import BytesIO
-from .utils import ImageCache
+import asyncio
+from .image_cache import ImageCache
 from .photoshop_manager import PhotoshopManager
+from .protocol import SUPPORTED_VERSIONS, HEARTBEAT, negotiate_features
+from .pixel_codecs import negotiate_codec
+from .message_codecs import negotiate_message_codec
+from .metrics import Metrics, render_prometheus, render_json
+from .tracing import Tracer
+from .spill import SpilledImage
+
+# bytes written per chunk by /finished_images
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+def notify_history_changed(client_id_list, document_ids):
+    for client_id in client_id_list:
+        PromptServer.instance.send_sync('sd-ppp-history-changed', {'document_ids': document_ids}, client_id)
+PhotoshopManager.instance().on_history_changed = notify_history_changed
+
+# sent to every client, the ones not matched yet can't be told apart and match on their next getlayers
+def notify_photoshop_connected(instance):
+    PromptServer.instance.send_sync('sd-ppp-photoshop-connected', {})
+PhotoshopManager.instance().on_photoshop_connected = notify_photoshop_connected
 
 @PromptServer.instance.routes.get('/finished_images')
 async def download_handler(request):
@@ -14,19 +33,79 @@ async def download_handler(request):
             })
         
         image_id = int(image_id)
-        if (image_id not in ImageCache.data):
+        image_cache = ImageCache.instance()
+        entry = image_cache.get_entry(image_id)
+        if (entry is None):
             return web.json_response({
                 'error': 'image not found'
             })
-        
-        image = ImageCache.data[image_id]
-        ImageCache.data.pop(image_id)
-        # image = image.tobytes()
-        
-        stream = BytesIO()
-        image.save(stream, "PNG")
-        
-        return web.Response(body=stream.getvalue(), content_type='image/png')
+        # encoded by the worker pool as soon as it was cached, only wait here if it's not finished yet
+        body = await asyncio.wrap_future(entry.data)
+        size = len(body)
+        try:
+            http_range = request.http_range
+        except ValueError:
+            # malformed ranges are ignored like the spec says
+            http_range = slice(None, None)
+        start, stop = http_range.start, http_range.stop
+        partial = start is not None or stop is not None
+        if start is not None and start < 0:
+            # suffix range, the last -start bytes
+            start, stop = max(0, size + start), None
+        start = start or 0
+        stop = size if stop is None else min(stop, size)
+        headers = {'Accept-Ranges': 'bytes'}
+        if start >= stop and size > 0:
+            headers['Content-Range'] = f'bytes */{size}'
+            return web.Response(status=416, headers=headers)
+        status = 200
+        if partial:
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_type = entry.content_type or 'image/png'
+        response.content_length = stop - start
+        await response.prepare(request)
+        view = body.view() if isinstance(body, SpilledImage) else memoryview(body)
+        sent = 0
+        try:
+            for offset in range(start, stop, DOWNLOAD_CHUNK_BYTES):
+                chunk = view[offset:min(offset + DOWNLOAD_CHUNK_BYTES, stop)]
+                await response.write(chunk)
+                sent += len(chunk)
+            await response.write_eof()
+        except ConnectionError:
+            # kept until the ttl, the plugin can resume with a range request
+            return response
+        finally:
+            Metrics.instance().inc('sd_ppp_transfer_bytes_total', sent, direction='out', channel='http')
+        # dropped once its last byte went out, a transfer that broke off earlier can still resume
+        if stop == size:
+            image_cache.remove(image_id)
+        return response
+    except Exception as e:
+        print('=============error============', e)
+        return web.json_response({
+            'error': str(e)
+        })
+
+@PromptServer.instance.routes.post('/sd-ppp/upload_image')
+async def upload_image_handler(request):
+    try:
+        # read part by part, request.post() would spool big files to a temporary file and read it back on the loop
+        data = None
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'image' and part.filename is not None:
+                data = await part.read()
+                break
+        if (data is None):
+            return web.json_response({
+                'error': 'image is required'
+            })
+        Metrics.instance().inc('sd_ppp_transfer_bytes_total', len(data), direction='in', channel='http')
+        upload_key = ImageCache.uploads().put(data, len(data))
+        return web.json_response({'upload_key': upload_key})
     except Exception as e:
         print('=============error============', e)
         return web.json_response({
@@ -38,9 +117,8 @@ async def websocket_handler(request):
     # get version from query
     print('try connect: ' + str(request.query))
     version = int(request.query.get('version', 0))
-    EXPECTED_VERSION = 1
     
-    if (version is not EXPECTED_VERSION):
+    if (version not in SUPPORTED_VERSIONS):
         if (version == 0):
             return web.json_response({ 
                 'error': f'version is not provided.',
@@ -50,14 +128,21 @@ async def websocket_handler(request):
                 'error': f'version {version} not supported.',
             })
     user_id = request.query.get('user_id', 0)
+    features = negotiate_features(version, request.query.get('features', ''))
+    codec = negotiate_codec(version, request.query.get('codecs', ''))
+    message_codec = negotiate_message_codec(version, request.query.get('message_codecs', ''))
+    # token from a previous handshake, the instance state is reused if it's still in its grace period
+    session = request.query.get('session', None)
     ip = request.remote
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(heartbeat=HEARTBEAT or None)
     await ws.prepare(request)
-    instance = await PhotoshopManager.instance().new_ps_instance(ws, ip, user_id)
-    await instance.run_server_loop()
+    instance = await PhotoshopManager.instance().new_ps_instance(ws, ip, user_id, version, features, codec, session, message_codec)
+    await instance.run_server_loop(ws)
+    return ws
 
 @PromptServer.instance.routes.post("/sd-ppp/checkchanges")
 async def check_changes(request):
+    Metrics.instance().inc('sd_ppp_checkchanges_requests_total')
     ip = request.remote
     client_id = request.query.get('client_id', None)
     user_id = request.query.get('user_id', 0)
@@ -66,6 +151,9 @@ async def check_changes(request):
     is_changed = False
     instance = PhotoshopManager.instance().instance_from_client_info(ip, client_id, user_id)
     if (instance is not None):
+        # layers of the client's get image nodes, prefetched when photoshop pushes an edit
+        if 'watched_layers' in data:
+            instance.set_watched_layers(client_id, data['watched_layers'])
         is_changed = await instance.is_ps_history_changed(document_str_list)
     return web.json_response({'is_changed': is_changed}, content_type='application/json')
 
@@ -98,4 +186,24 @@ async def get_layers(request):
     return web.json_response({
         'doc_strs': doc_strs,
         'docs_layers_strs': docs_layers_strs, 
-    }, content_type='application/json')
\ No newline at end of file
+        'matched': instance is not None,
+    }, content_type='application/json')
+
+# prometheus text by default, json with ?format=json or an application/json accept header
+@PromptServer.instance.routes.get("/sd-ppp/metrics")
+async def metrics(request):
+    families = Metrics.instance().collect()
+    if request.query.get('format', None) == 'json' or 'application/json' in request.headers.get('Accept', ''):
+        return web.json_response(render_json(families))
+    return web.Response(body=render_prometheus(families).encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+# chrome trace event json of one prompt, open it in chrome://tracing or ui.perfetto.dev
+@PromptServer.instance.routes.get("/sd-ppp/trace")
+async def trace(request):
+    tracer = Tracer.instance()
+    prompt_id = request.query.get('prompt_id', None)
+    if prompt_id is None:
+        return web.json_response({'enabled': tracer.enabled, 'prompt_ids': tracer.prompt_ids()})
+    if prompt_id not in tracer.prompt_ids():
+        return web.json_response({'error': 'trace not found'}, status=404)
+    return web.json_response(tracer.export(prompt_id), headers={'Content-Disposition': f'attachment; filename="sd-ppp-trace-{prompt_id}.json"'})
@@ -0,0 +1,166 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+class ImageCacheEntry:
+    def __init__(self, image_id, data, nbytes, owner=None, content_type=None):
+        self.image_id = image_id
+        self.data = data
+        self.nbytes = nbytes
+        self.owner = owner
+        self.content_type = content_type
+        self.created_at = time.time()
+
+# images waiting for photoshop to download them, or uploaded by photoshop and waiting for a node to decode them
+# bounded by a byte budget (lru eviction) and a ttl, so images never fetched by a disconnected or failed peer don't stay forever
+class ImageCache:
+    _instance = None
+    _uploads = None
+    DEFAULT_MAX_BYTES = int(os.environ.get('SD_PPP_IMAGE_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+    DEFAULT_TTL = float(os.environ.get('SD_PPP_IMAGE_CACHE_TTL', 600))
+
+    @classmethod
+    def instance(cls) -> 'ImageCache':
+        if cls._instance is None:
+            cls._instance = ImageCache()
+        return cls._instance
+
+    # separate store for images photoshop uploads to /sd-ppp/upload_image, they never hit the disk
+    @classmethod
+    def uploads(cls) -> 'ImageCache':
+        if cls._uploads is None:
+            cls._uploads = ImageCache()
+        return cls._uploads
+
+    def __init__(self, max_bytes=None, ttl=None):
+        self.max_bytes = max_bytes if max_bytes is not None else self.DEFAULT_MAX_BYTES
+        self.ttl = ttl if ttl is not None else self.DEFAULT_TTL
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.image_id_inc = 0
+        self.total_bytes = 0
+        self.owner_usage = {}
+        self.evictions = 0
+        self.expirations = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, data, nbytes, owner=None, content_type=None):
+        with self.lock:
+            self._evict_expired()
+            self._evict_for(nbytes)
+            self.image_id_inc += 1
+            image_id = self.image_id_inc
+            self.data[image_id] = ImageCacheEntry(image_id, data, nbytes, owner, content_type)
+            self._account(owner, 1, nbytes)
+            return image_id
+
+    def get(self, image_id):
+        entry = self.get_entry(image_id)
+        if entry is None:
+            return None
+        return entry.data
+
+    def get_entry(self, image_id):
+        with self.lock:
+            self._evict_expired()
+            entry = self.data.get(image_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(image_id)
+            return entry
+
+    def pop(self, image_id):
+        entry = self.pop_entry(image_id)
+        if entry is None:
+            return None
+        return entry.data
+
+    def pop_entry(self, image_id):
+        with self.lock:
+            self._evict_expired()
+            entry = self._remove(image_id)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def remove(self, image_id):
+        with self.lock:
+            return self._remove(image_id) is not None
+
+    # update the accounted size of an entry, e.g. once its pixels are replaced by encoded bytes
+    def resize(self, image_id, nbytes):
+        with self.lock:
+            entry = self.data.get(image_id, None)
+            if entry is None:
+                return
+            self._account(entry.owner, 0, nbytes - entry.nbytes)
+            entry.nbytes = nbytes
+
+    def remove_owner(self, owner):
+        with self.lock:
+            image_ids = [image_id for image_id, entry in self.data.items() if entry.owner is owner]
+            for image_id in image_ids:
+                self._remove(image_id)
+            self.owner_usage.pop(owner, None)
+            return len(image_ids)
+
+    def owner_stats(self, owner):
+        with self.lock:
+            entries, nbytes = self.owner_usage.get(owner, (0, 0))
+            return {'entries': entries, 'bytes': nbytes}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.data),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'owners': len(self.owner_usage),
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    #------------------------------------------------------------------------------------------------------------------------------------------------
+    # all methods below expect the lock to be held
+    def _remove(self, image_id):
+        entry = self.data.pop(image_id, None)
+        if entry is not None:
+            self._account(entry.owner, -1, -entry.nbytes)
+        return entry
+
+    def _account(self, owner, entries, nbytes):
+        self.total_bytes += nbytes
+        if owner is None:
+            return
+        owner_entries, owner_bytes = self.owner_usage.get(owner, (0, 0))
+        owner_entries += entries
+        owner_bytes += nbytes
+        if owner_entries <= 0:
+            self.owner_usage.pop(owner, None)
+        else:
+            self.owner_usage[owner] = (owner_entries, owner_bytes)
+
+    def _evict_expired(self):
+        if self.ttl <= 0:
+            return
+        deadline = time.time() - self.ttl
+        expired_ids = [image_id for image_id, entry in self.data.items() if entry.created_at < deadline]
+        for image_id in expired_ids:
+            self._remove(image_id)
+            self.expirations += 1
+
+    # evict least recently used images until the new one fits, a single image larger than the budget is still accepted
+    def _evict_for(self, nbytes):
+        while len(self.data) > 0 and self.total_bytes + nbytes > self.max_bytes:
+            image_id = next(iter(self.data))
+            self._remove(image_id)
+            self.evictions += 1
@@ -0,0 +1,28 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .pixel_codecs import get_codec
+from .spill import should_spill, encode_to_disk
+
+# encodes images off the event loop, pillow and zlib release the gil while compressing so threads are enough
+class ImageEncoder:
+    _instance = None
+    DEFAULT_WORKERS = int(os.environ.get('SD_PPP_ENCODE_WORKERS', min(4, os.cpu_count() or 1)))
+
+    @classmethod
+    def instance(cls) -> 'ImageEncoder':
+        if cls._instance is None:
+            cls._instance = ImageEncoder()
+        return cls._instance
+
+    def __init__(self, workers=None):
+        self.workers = workers if workers is not None else self.DEFAULT_WORKERS
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sd-ppp-encode')
+
+    # pixels: [H, W, C] uint8 array, returns a concurrent.futures.Future resolving to the encoded bytes
+    # or, for large images, to a SpilledImage so the encoded copy doesn't sit in memory next to the pixels
+    def submit(self, pixels, codec=None):
+        if codec is None:
+            codec = get_codec('png')
+        if should_spill(pixels):
+            return self.executor.submit(encode_to_disk, codec, pixels)
+        return self.executor.submit(codec.encode, pixels)
@@ -0,0 +1,75 @@
+import os
+import threading
+from collections import OrderedDict
+
+def tensors_nbytes(*tensors):
+    return sum(tensor.nelement() * tensor.element_size() for tensor in tensors)
+
+# decoded layer images of one photoshop instance, keyed by (document_id, layer_id, bounds_id, history_state_id)
+# an entry stays valid as long as the document history doesn't advance, so re-queued prompts get unchanged layers without a round trip
+class LayerImageCache:
+    DEFAULT_MAX_BYTES = int(os.environ.get('SD_PPP_LAYER_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes if max_bytes is not None else self.DEFAULT_MAX_BYTES
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data.move_to_end(key)
+            return entry[0]
+
+    # doesn't count as a hit or refresh the entry
+    def contains(self, key):
+        with self.lock:
+            return key in self.data
+
+    # value is (image, mask, layer_opacity) unless its size is given
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            image, mask, _ = value
+            nbytes = tensors_nbytes(image, mask)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            while len(self.data) > 0 and self.total_bytes + nbytes > self.max_bytes:
+                self._remove(next(iter(self.data)))
+                self.evictions += 1
+            self.data[key] = (value, nbytes)
+            self.total_bytes += nbytes
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.data),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
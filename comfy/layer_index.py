@@ -0,0 +1,23 @@
+# "name (id:N)" as shown in comfyui for documents and layers
+def name_id_str(item):
+    return f"{item['name']} (id:{item['id']})"
+
+# lookups and option lists of one document's layers, built once when the layer list is synced
+# and reused as long as sync_layers keeps the same list (unchanged documents keep their list object)
+class LayerIndex:
+    def __init__(self, layers, base_prefix, bounds_prefix, set_prefix):
+        self.layers = layers
+        self.raw_layer_strs = [name_id_str(layer) for layer in layers]
+        self.layer_str_to_id = {layer_str: layer['id'] for (layer_str, layer) in zip(self.raw_layer_strs, layers)}
+        self.id_to_layer = {layer['id']: layer for layer in layers}
+        self.layer_strs = base_prefix + self.raw_layer_strs
+        self.bounds_strs = bounds_prefix + self.raw_layer_strs
+        self.set_layer_strs = set_prefix + self.raw_layer_strs
+        self.layer_str_set = set(self.layer_strs)
+        self.bounds_str_set = set(self.bounds_strs)
+        # served as is by /sd-ppp/getlayers
+        self.layer_strs_payload = {
+            'layer_strs': self.layer_strs,
+            'bounds_strs': self.bounds_strs,
+            'set_layer_strs': self.set_layer_strs,
+        }
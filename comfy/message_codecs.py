@@ -0,0 +1,61 @@
+import os
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# server preference, the first one the plugin also understands is used for every message after the handshake
+SERVER_MESSAGE_CODECS = [name.strip() for name in os.environ.get('SD_PPP_MESSAGE_CODECS', 'msgpack,json').split(',') if name.strip()]
+
+# text frames, orjson when it's installed
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def dumps(self, payload):
+        if orjson is not None:
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        return json.dumps(payload)
+
+    def loads(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+# BINARY_FRAME_MESSAGE frames, only when the optional msgpack package is installed
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+MESSAGE_CODECS = {codec.name: codec for codec in [JsonCodec()]}
+if msgpack is not None:
+    MESSAGE_CODECS['msgpack'] = MsgpackCodec()
+
+def get_message_codec(name=None):
+    if not name:
+        name = 'json'
+    codec = MESSAGE_CODECS.get(name, None)
+    if codec is None:
+        raise ValueError(f"Unknown message encoding {name}")
+    return codec
+
+# the handshake itself is always json, older plugins don't send message_codecs and keep json
+def negotiate_message_codec(version, codecs_query):
+    if version < 2 or not codecs_query:
+        return 'json'
+    client_codecs = set(name.strip() for name in codecs_query.split(','))
+    for name in SERVER_MESSAGE_CODECS:
+        if name in MESSAGE_CODECS and name in client_codecs:
+            return name
+    return 'json'
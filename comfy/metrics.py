@@ -0,0 +1,144 @@
+import bisect
+import threading
+
+# seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+COUNTER_HELP = {
+    'sd_ppp_transfer_bytes_total': 'Bytes exchanged with photoshop, websocket text frames are counted in characters',
+    'sd_ppp_ws_messages_total': 'Websocket frames exchanged with photoshop',
+    'sd_ppp_checkchanges_requests_total': 'Change polls from comfyui clients, rate() of it is the poll rate',
+    'sd_ppp_prefetches_total': 'Watched layers prefetched after a history push, by outcome',
+    'sd_ppp_sessions_total': 'Photoshop connections, new or resumed from a disconnected session',
+    'sd_ppp_call_events_total': 'Photoshop calls coalesced, timed out, cancelled or answered too late',
+}
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    # cumulative [le, count] pairs like prometheus, '+Inf' last
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for (le, count) in zip(self.buckets, self.bucket_counts):
+            total += count
+            buckets.append([le, total])
+        buckets.append(['+Inf', self.count])
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+# process wide counters and call latencies, gauges are read from their owners when /sd-ppp/metrics is scraped
+class Metrics:
+    _instance = None
+
+    @classmethod
+    def instance(cls) -> 'Metrics':
+        if cls._instance is None:
+            cls._instance = Metrics()
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.call_latency = {}
+        self.counters = {}
+
+    # outcome: ok, error, timeout, cancelled or disconnected
+    def observe_call(self, action, outcome, seconds):
+        with self.lock:
+            histogram = self.call_latency.get((action, outcome), None)
+            if histogram is None:
+                histogram = self.call_latency[(action, outcome)] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # list of {'name', 'type', 'help', 'samples': [(labels, value)]}, histogram values are Histogram.snapshot()
+    def collect(self):
+        from .photoshop_manager import PhotoshopManager
+        from .image_cache import ImageCache
+        families = []
+        def family(name, type, help):
+            metric_family = {'name': name, 'type': type, 'help': help, 'samples': []}
+            families.append(metric_family)
+            return metric_family['samples']
+
+        with self.lock:
+            samples = family('sd_ppp_call_duration_seconds', 'histogram', 'Photoshop call latency, including the wait for a call slot')
+            for ((action, outcome), histogram) in sorted(self.call_latency.items()):
+                samples.append(({'action': action, 'outcome': outcome}, histogram.snapshot()))
+            counter_samples = {}
+            for ((name, labels), value) in sorted(self.counters.items()):
+                counter_samples.setdefault(name, []).append((dict(labels), value))
+        for (name, help) in COUNTER_HELP.items():
+            family(name, 'counter', help).extend(counter_samples.get(name, []))
+
+        manager = PhotoshopManager.instance()
+        instances = list(manager.ps_instance_to_ip.keys())
+        manager_stats = manager.stats()
+        family('sd_ppp_photoshop_instances', 'gauge', 'Connected photoshop instances').append(({}, manager_stats['instances']))
+        samples = family('sd_ppp_clients', 'gauge', 'Comfyui clients known and matched with a photoshop instance')
+        samples.append(({'state': 'known'}, manager_stats['clients']))
+        samples.append(({'state': 'matched'}, manager_stats['matched_clients']))
+        family('sd_ppp_evicted_clients_total', 'counter', 'Comfyui clients forgotten after being idle').append(({}, manager_stats['evicted_clients']))
+
+        call_stats = [instance.wsCallsManager.stats() for instance in instances]
+        samples = family('sd_ppp_calls', 'gauge', 'Photoshop calls waiting for a result, holding a call slot or waiting for one')
+        for state in ['pending', 'running', 'queued']:
+            samples.append(({'state': state}, sum(stats[state] for stats in call_stats)))
+
+        cache_stats = [('outgoing', ImageCache.instance().stats()), ('uploads', ImageCache.uploads().stats())]
+        layer_cache_stats = [instance.layer_image_cache.stats() for instance in instances]
+        cache_stats.append(('layers', {key: sum(stats[key] for stats in layer_cache_stats) for key in ['entries', 'bytes', 'hits', 'misses', 'evictions']}))
+        for (name, type, key, help) in [
+            ('sd_ppp_cache_entries', 'gauge', 'entries', 'Entries in the image caches'),
+            ('sd_ppp_cache_bytes', 'gauge', 'bytes', 'Bytes held by the image caches'),
+            ('sd_ppp_cache_hits_total', 'counter', 'hits', 'Image cache lookups that found their entry'),
+            ('sd_ppp_cache_misses_total', 'counter', 'misses', 'Image cache lookups that found nothing'),
+            ('sd_ppp_cache_evictions_total', 'counter', 'evictions', 'Image cache entries dropped to stay within budget'),
+        ]:
+            family(name, type, help).extend([({'cache': cache}, stats[key]) for (cache, stats) in cache_stats])
+        return families
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (key, value) in labels.items()]
+    return '{' + ','.join(f'{key}="{value}"' for (key, value) in escaped) + '}'
+
+# prometheus text exposition format 0.0.4
+def render_prometheus(families):
+    lines = []
+    for metric_family in families:
+        name = metric_family['name']
+        lines.append(f"# HELP {name} {metric_family['help']}")
+        lines.append(f"# TYPE {name} {metric_family['type']}")
+        for (labels, value) in metric_family['samples']:
+            if metric_family['type'] != 'histogram':
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            for (le, count) in value['buckets']:
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le=le))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+    return '\n'.join(lines) + '\n'
+
+def render_json(families):
+    return {
+        metric_family['name']: {
+            'type': metric_family['type'],
+            'help': metric_family['help'],
+            'samples': [{'labels': labels, 'value': value} for (labels, value) in metric_family['samples']],
+        } for metric_family in families
+    }
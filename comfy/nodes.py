@@ -1,10 +1,9 @@
-import asyncio
-import threading
 import numpy as np
-from nodes import LoadImage
-from .utils import cache_images
+from .utils import cache_images, images_to_rgba_frames
+from .server_loop import run_on_server_loop, submit_to_server_loop
 from server import PromptServer
 from .photoshop_manager import PhotoshopManager
+from .tracing import span, current_prompt_id
 prompt_server = PromptServer.instance
 
 class GetImageFromPhotoshopLayerNode:
@@ -19,10 +18,12 @@ class GetImageFromPhotoshopLayerNode:
         if not photoshopInstance:
             return np.random.rand()
         else:
+            prompt_id = _trace_prompt()
             document_id = photoshopInstance.document_name_to_id(document)
             layer_id = photoshopInstance.layer_name_to_id(layer)
             bounds_id = photoshopInstance.layer_name_to_id(use_layer_bounds, layer_id)
-            is_changed, history_state_id = asyncio.run(photoshopInstance.check_document_changed(document_id))
+            with span('IS_CHANGED', document_id=document_id, layer_id=layer_id):
+                is_changed, history_state_id = _invoke_async(photoshopInstance.check_document_changed(document_id, prompt_id))
             if is_changed:
                 if history_state_id:
                     comfyui_tracking_value = photoshopInstance.update_comfyui_last_value(layer_id, bounds_id, history_state_id)
@@ -52,26 +53,20 @@ class GetImageFromPhotoshopLayerNode:
         photoshopInstance = PhotoshopManager.instance().instance_from_client_id(prompt_server.client_id)
         if not photoshopInstance:
             raise ValueError('Photoshop is not connected')
-        doc_strs = photoshopInstance.get_documents()
-        if document not in doc_strs:
+        if not photoshopInstance.has_document(document):
             raise ValueError(f"Document {document} not found in Photoshop")
         document_id = photoshopInstance.document_name_to_id(document)
-        layer_strs = photoshopInstance.get_base_layers(document_id=document_id)
-        if layer not in layer_strs:
+        if not photoshopInstance.has_base_layer(document_id, layer):
             raise ValueError(f"Layer {layer} not found in Photoshop")
-        bounds_strs = photoshopInstance.get_bounds_layers(document_id=document_id)
-        if use_layer_bounds not in bounds_strs:
+        if not photoshopInstance.has_bounds_layer(document_id, use_layer_bounds):
             raise ValueError(f"Layer {use_layer_bounds} not found in Photoshop")
 
         layer_id = photoshopInstance.layer_name_to_id(layer)
         bounds_id = photoshopInstance.layer_name_to_id(use_layer_bounds, layer_id)
         
-        image_id, layer_opacity = _invoke_async(photoshopInstance.get_image(document_id=document_id, layer_id=layer_id, bounds_id=bounds_id))
-        if not image_id:
-            raise ValueError(f"Failed getting image from photoshop, please check log")
-        
-        loadImage = LoadImage()
-        (output_image, output_mask) = loadImage.load_image(image_id)
+        prompt_id = _trace_prompt()
+        with span('Get image from Photoshop layer', document_id=document_id, layer_id=layer_id, bounds_id=bounds_id):
+            (output_image, output_mask, layer_opacity) = _invoke_async(photoshopInstance.get_image(document_id=document_id, layer_id=layer_id, bounds_id=bounds_id, prompt_id=prompt_id))
         return (output_image, output_mask, layer_opacity / 100)
 
 class SendImageToPhotoshopLayerNode:
@@ -101,15 +96,20 @@ class SendImageToPhotoshopLayerNode:
         photoshopInstance = PhotoshopManager.instance().instance_from_client_id(prompt_server.client_id)
         if (photoshopInstance is None):
             raise ValueError('Photoshop is not connected')
-        doc_strs = photoshopInstance.get_documents()
-        if document not in doc_strs:
+        if not photoshopInstance.has_document(document):
             raise ValueError(f"Document {document} not found in Photoshop")
         
-        ret = cache_images(images)
-        
         document_id = photoshopInstance.document_name_to_id(document)
         layer_id = photoshopInstance.layer_name_to_id(layer)
-        threading.Thread(target=lambda: asyncio.run(photoshopInstance.send_images(document_id=document_id, image_ids=ret, layer_id=layer_id))).start()
+        _trace_prompt()
+        with span('Send images to Photoshop', document_id=document_id, layer_id=layer_id, images=len(images)):
+            if photoshopInstance.supports('binary_push'):
+                send_images = photoshopInstance.send_images(document_id=document_id, layer_id=layer_id, frames=images_to_rgba_frames(images, photoshopInstance.codec))
+            else:
+                image_ids, crops = cache_images(images, owner=photoshopInstance, codec=photoshopInstance.codec)
+                send_images = photoshopInstance.send_images(document_id=document_id, layer_id=layer_id, image_ids=image_ids, crops=crops)
+            # delivered in the background, its spans still land in this prompt's trace
+            submit_to_server_loop(send_images)
         return (None,)
     
 class ImageTimesOpacity:
@@ -149,7 +149,14 @@ class MaskTimesOpacity:
         return (mask_out,)
 
 def _invoke_async(call):
-    return asyncio.run(call)
+    return run_on_server_loop(call)
+
+# spans of the node and of the coroutines it submits go to the trace of the running prompt, see /sd-ppp/trace
+# the prompt id also selects the history snapshot shared by the prompt's nodes, None on comfyui versions without it
+def _trace_prompt():
+    prompt_id = getattr(prompt_server, 'last_prompt_id', None)
+    current_prompt_id.set(prompt_id)
+    return prompt_id
 
 NODE_CLASS_MAPPINGS = { 
     'Get Image From Photoshop Layer': GetImageFromPhotoshopLayerNode,
@@ -1,9 +1,19 @@
+import os
 import time
-from aiohttp import WSMsgType
 import threading
 import asyncio
 import json
+from collections import OrderedDict
 from .ws_call_manager import WSCallsManager
+from .metrics import Metrics
+from .image_cache import ImageCache
+from .layer_image_cache import LayerImageCache
+from .tile_delta import TILE_SIZE, TILE_BASE_MAX_BYTES, load_tile_upload
+from .utils import load_uploaded_image
+from .pixel_codecs import get_codec
+from .message_codecs import get_message_codec
+from .tracing import span
+from .layer_index import LayerIndex, name_id_str
 
 class PhotoshopInstance:
     SPECIAL_DOCUMENT_USE_ACTIVE = '### Use Active Document ###'
@@ -21,65 +31,299 @@ class PhotoshopInstance:
         SPECIAL_LAYER_SAME_AS_LAYER: -3
     }
     
-    def __init__(self, ws, uid = 0):
+    # pushes arriving within this window are forwarded to comfyui clients together
+    HISTORY_CHANGED_DEBOUNCE = 0.2
+    # fetch the layers comfyui clients watch as soon as photoshop pushes an edit, before the prompt asks for them
+    PREFETCH_ENABLED = os.environ.get('SD_PPP_PREFETCH', '0') == '1'
+    # seconds without a new push before prefetching, every push in between restarts the wait
+    PREFETCH_DELAY = float(os.environ.get('SD_PPP_PREFETCH_DELAY', 0.5))
+    # behind every call a prompt is waiting for
+    PREFETCH_PRIORITY = 3
+    # prompts whose history snapshot is kept, a prompt only needs its own while it starts
+    MAX_HISTORY_SNAPSHOTS = 4
+    # seconds a disconnected instance that negotiated 'resume' keeps its state for the plugin to reconnect, 0 destroys it right away
+    RESUME_GRACE = float(os.environ.get('SD_PPP_RESUME_GRACE', 60))
+
+    def __init__(self, ws, uid = 0, version = 1, features = None, codec = 'png', message_codec = 'json'):
         self.uid = uid
-        self.wsCallsManager = WSCallsManager(ws, self.message_handler)
+        self.version = version
+        self.features = set(features or [])
+        # pixel codec negotiated in the handshake, used for images in both directions
+        self.codec = get_codec(codec)
+        # encoding of the websocket messages after the handshake
+        self.message_codec = get_message_codec(message_codec)
+        self.push_image_id_inc = 0
+        self.wsCallsManager = WSCallsManager(ws, self.message_handler, self.message_codec)
         self.destroyed = False
+        # token handed out in the handshake when 'resume' is negotiated, set by the manager
+        self.session = None
+        self.detached_handle = None
         self.layers = {}
+        self.layer_versions = {}
         self.documents = []
+        self.layer_indexes = {}
+        self.layer_str_to_id = {}
+        self.empty_layer_index = self.new_layer_index([])
+        self.rebuild_indexes()
         self.document_ids_to_sync_layers = []
         self.last_sync_layer = 0
         self.sync_layer_min_interval = 1
         self.on_destroy = None
+        self.on_history_changed = None
+        self.history_changed_document_ids = set()
+        self.history_changed_handle = None
+        self.layer_image_cache = LayerImageCache()
+        self.tile_bases = LayerImageCache(TILE_BASE_MAX_BYTES)
+        self.get_image_calls = {}
+        # client_id -> {(document_id, layer_id, bounds_id)} of its get image nodes
+        self.watched_layers = {}
+        self.prefetch_handles = {}
+        self.prefetch_tasks = {}
+        self.prefetch_calls = {}
+        # prompt_id -> task resolving to {document_id: history_state_id}
+        self.history_snapshots = OrderedDict()
         self.reset_change_tracker()
 
     async def destroy(self):
         if self.destroyed:
             return
         self.destroyed = True
+        if self.detached_handle is not None:
+            self.detached_handle.cancel()
+            self.detached_handle = None
+        if self.history_changed_handle is not None:
+            self.history_changed_handle.cancel()
+            self.history_changed_handle = None
+        for handle in self.prefetch_handles.values():
+            handle.cancel()
+        for task in self.prefetch_tasks.values():
+            task.cancel()
         if self.on_destroy is not None:
             self.on_destroy(self)
+        ImageCache.instance().remove_owner(self)
+        self.layer_image_cache.clear()
+        self.tile_bases.clear()
         await self.wsCallsManager.ws.close()
 
-    async def message_handler(self, msg):
-        if msg.type == WSMsgType.TEXT:
-            payload = json.loads(msg.data)
-            if 'push_data' in payload:
-                push_data = payload['push_data']
-                self.update_push_data(push_data)
-                return True
+    # payload is already decoded by the calls manager
+    async def message_handler(self, payload):
+        if 'push_data' in payload:
+            self.update_push_data(payload['push_data'])
+            return True
         return False
 
-    async def run_server_loop(self):
+    def supports(self, feature):
+        return feature in self.features
+
+    async def run_server_loop(self, ws=None):
+        ws_calls_manager = self.wsCallsManager
+        if ws is not None and ws_calls_manager.ws is not ws:
+            # another connection of the same session took over before this loop started
+            return
         print('Photoshop Connected')
         try:
-            await self.wsCallsManager.message_loop()
+            if self.version >= 2:
+                handshake = {'version': self.version, 'features': sorted(self.features), 'codec': self.codec.name, 'message_codec': self.message_codec.name}
+                if self.session is not None:
+                    handshake['session'] = self.session
+                await ws_calls_manager.ws.send_str(json.dumps({'handshake': handshake}))
+            await ws_calls_manager.message_loop()
         finally:
             print('Photoshop Disconnected')
-            await self.destroy()
+            # a newer connection of the same session re-attached already, the state is its own now
+            if self.wsCallsManager is ws_calls_manager:
+                if self.session is not None and self.RESUME_GRACE > 0 and not self.destroyed:
+                    self.detach()
+                else:
+                    await self.destroy()
+
+    # keeps layers, trackers and caches for RESUME_GRACE seconds, calls made meanwhile fail like before
+    def detach(self):
+        if self.detached_handle is not None:
+            self.detached_handle.cancel()
+        self.detached_handle = asyncio.get_event_loop().call_later(self.RESUME_GRACE, lambda: asyncio.ensure_future(self.destroy()))
+
+    # the plugin reconnected with the session token, only the connection and what it negotiated change
+    async def attach(self, ws, version, features, codec, message_codec='json'):
+        if self.detached_handle is not None:
+            self.detached_handle.cancel()
+            self.detached_handle = None
+        old_ws_calls_manager = self.wsCallsManager
+        self.version = version
+        self.features = set(features or [])
+        self.codec = get_codec(codec)
+        self.message_codec = get_message_codec(message_codec)
+        self.wsCallsManager = WSCallsManager(ws, self.message_handler, self.message_codec)
+        # the old socket may be half dead and not noticed yet
+        await old_ws_calls_manager.ws.close()
+        # pushes sent while disconnected were lost, check with photoshop until the next one
+        self.push_data = {}
+        self.history_snapshots.clear()
+        # comfyui clients check what changed while photoshop was away
+        self.schedule_history_changed([str(document['id']) for document in self.documents])
 
     def update_push_data(self, push_data):
         doc_id_to_history_state_id = push_data.get('history_state_id', None)
         if doc_id_to_history_state_id is None or len(doc_id_to_history_state_id) == 0:
             return
         existing_data = self.push_data.get('doc_id_to_history_state_id', {})
+        advanced_document_ids = [document_id for (document_id, history_state_id) in doc_id_to_history_state_id.items() if history_state_id is not None and history_state_id > (existing_data.get(document_id, None) or 0)]
         existing_data.update(doc_id_to_history_state_id)
         self.push_data['doc_id_to_history_state_id'] = existing_data
+        self.schedule_history_changed(doc_id_to_history_state_id.keys())
+        if self.PREFETCH_ENABLED:
+            for document_id in advanced_document_ids:
+                self.schedule_prefetch(int(document_id))
+
+    def schedule_history_changed(self, document_ids):
+        self.history_changed_document_ids.update(document_ids)
+        if self.history_changed_handle is not None:
+            return
+        self.history_changed_handle = asyncio.get_event_loop().call_later(self.HISTORY_CHANGED_DEBOUNCE, self._emit_history_changed)
+
+    def _emit_history_changed(self):
+        self.history_changed_handle = None
+        document_ids = sorted(self.history_changed_document_ids)
+        self.history_changed_document_ids = set()
+        if self.on_history_changed is not None and not self.destroyed:
+            self.on_history_changed(self, document_ids)
+
+    # watched_layers: [document, layer, use_layer_bounds] widget values of a client's get image nodes
+    def set_watched_layers(self, client_id, watched_layers):
+        keys = set()
+        for (document, layer, use_layer_bounds) in watched_layers:
+            try:
+                document_id = self.document_name_to_id(document)
+                layer_id = self.layer_name_to_id(layer)
+                bounds_id = self.layer_name_to_id(use_layer_bounds, layer_id)
+            except Exception:
+                # placeholder values of nodes not set up yet
+                continue
+            keys.add((document_id, layer_id, bounds_id))
+        self.watched_layers[client_id] = keys
+
+    def remove_watched_layers(self, client_id):
+        self.watched_layers.pop(client_id, None)
+
+    def schedule_prefetch(self, document_id):
+        handle = self.prefetch_handles.pop(document_id, None)
+        if handle is not None:
+            handle.cancel()
+        # pixels of an older state are useless now
+        task = self.prefetch_tasks.pop(document_id, None)
+        if task is not None:
+            task.cancel()
+            Metrics.instance().inc('sd_ppp_prefetches_total', outcome='superseded')
+        self.prefetch_handles[document_id] = asyncio.get_event_loop().call_later(self.PREFETCH_DELAY, self._start_prefetch, document_id)
+
+    def _start_prefetch(self, document_id):
+        self.prefetch_handles.pop(document_id, None)
+        history_state_id = self.get_push_history_state_id(document_id)
+        # layers of the active document placeholder are left to the prompt, pushes name real documents
+        keys = set(key for keys in self.watched_layers.values() for key in keys if key[0] == document_id)
+        if self.destroyed or history_state_id is None or len(keys) == 0:
+            return
+        task = asyncio.ensure_future(self._prefetch_document(keys, history_state_id))
+        self.prefetch_tasks[document_id] = task
+        task.add_done_callback(lambda task: self._on_prefetch_done(document_id, task))
+
+    def _on_prefetch_done(self, document_id, task):
+        if self.prefetch_tasks.get(document_id, None) is task:
+            self.prefetch_tasks.pop(document_id, None)
+
+    # one layer at a time, a prefetch shouldn't hold several call slots or modal sessions next to the prompt's calls
+    async def _prefetch_document(self, keys, history_state_id):
+        for key in sorted(keys):
+            task = asyncio.ensure_future(self._prefetch_image(key, history_state_id))
+            self.prefetch_calls[key] = task
+            task.add_done_callback(lambda task, key=key: self._on_prefetch_call_done(key, task))
+            try:
+                # failures are reported by _on_prefetch_call_done, the next layer is still prefetched
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+
+    def _on_prefetch_call_done(self, key, task):
+        if self.prefetch_calls.get(key, None) is task:
+            self.prefetch_calls.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            print('SD-PPP: prefetch failed', key, task.exception())
+
+    # only fills the layer image cache, what comfyui considers changed is still decided by the prompt's own checks
+    async def _prefetch_image(self, key, history_state_id):
+        (document_id, layer_id, bounds_id) = key
+        # a prompt fetching the same layer right now is as good as a prefetch
+        if key in self.get_image_calls or self.layer_image_cache.contains(key + (history_state_id,)):
+            Metrics.instance().inc('sd_ppp_prefetches_total', outcome='cached')
+            return
+        params, tile_base = self._get_image_params(document_id, layer_id, bounds_id)
+        try:
+            result = await self.wsCallsManager.call('get_image', params, timeout=60, priority=self.PREFETCH_PRIORITY)
+            fetched_state_id = result.get('history_state_id', None)
+            # older plugins don't report the state the pixels belong to, nothing to key the cache with
+            if fetched_state_id is not None:
+                await self._decode_and_cache(key, tile_base, result, fetched_state_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            Metrics.instance().inc('sd_ppp_prefetches_total', outcome='error')
+            raise
+        Metrics.instance().inc('sd_ppp_prefetches_total', outcome='fetched')
+
+    # rebuilt after every sync, layer indexes of documents whose layer list didn't change are kept
+    def rebuild_indexes(self):
+        self.raw_document_strs = [name_id_str(doc) for doc in self.documents]
+        self.document_strs = [self.SPECIAL_DOCUMENT_USE_ACTIVE] + self.raw_document_strs
+        self.document_str_to_id = dict(self.SPECIAL_DOCUMENT_TO_ID)
+        self.document_str_to_id.update({doc_str: doc['id'] for (doc_str, doc) in zip(self.raw_document_strs, self.documents)})
+        layer_indexes = {}
+        # the active document shares its layer list with its real id
+        new_layer_indexes = {}
+        is_layer_index_changed = len(self.layers) != len(self.layer_indexes)
+        for document_id, layers in self.layers.items():
+            layer_index = self.layer_indexes.get(document_id, None)
+            if layer_index is None or layer_index.layers is not layers:
+                layer_index = new_layer_indexes.get(id(layers), None) or self.new_layer_index(layers)
+                new_layer_indexes[id(layers)] = layer_index
+                is_layer_index_changed = True
+            layer_indexes[document_id] = layer_index
+        self.layer_indexes = layer_indexes
+        if is_layer_index_changed:
+            # layer strings carry their id, so the same string means the same layer in every document
+            self.layer_str_to_id = {}
+            for layer_index in layer_indexes.values():
+                self.layer_str_to_id.update(layer_index.layer_str_to_id)
+
+    def new_layer_index(self, layers):
+        return LayerIndex(
+            layers,
+            [self.SPECIAL_LAYER_USE_CANVAS],
+            [self.SPECIAL_LAYER_SAME_AS_LAYER, self.SPECIAL_LAYER_USE_CANVAS, self.SPECIAL_LAYER_USE_SELECTION],
+            [self.SPECIAL_LAYER_NEW_LAYER],
+        )
+
+    def get_layer_index(self, document_id=None):
+        if document_id is None:
+            document_id = next(iter(self.layer_indexes), None)
+        layer_index = self.layer_indexes.get(document_id, None)
+        if layer_index is None:
+            return self.empty_layer_index
+        return layer_index
 
     def get_raw_documents(self):
-        return list(map(lambda doc: f"{doc['name']} (id:{doc['id']})", self.documents))
+        return self.raw_document_strs
     
+    # cached lists, don't modify
     def get_documents(self):
-        raw_doc_strs = self.get_raw_documents()
-        doc_strs = list(raw_doc_strs)
-        doc_strs.insert(0, self.SPECIAL_DOCUMENT_USE_ACTIVE)
-        return doc_strs
+        return self.document_strs
+
+    def has_document(self, doc_name):
+        return doc_name in self.document_str_to_id
     
     def document_name_to_id(self, doc_name):
-        id = 0
-        if self.SPECIAL_DOCUMENT_TO_ID.get(doc_name, None) is not None:
-            id = self.SPECIAL_DOCUMENT_TO_ID[doc_name]
-        else:
+        id = self.document_str_to_id.get(doc_name, None)
+        if id is None:
             doc_name_and_id_split = doc_name.split('(id:')
             id = int(doc_name_and_id_split.pop().strip()[:-1])
         return id
@@ -99,37 +343,30 @@ class PhotoshopInstance:
             return {}
         if document_name_list is None:
             document_name_list = self.get_raw_documents()
-        all_layer_strs = {document_name: {
-            'layer_strs': self.get_base_layers(document_id=self.document_name_to_id(document_name)),
-            'bounds_strs': self.get_bounds_layers(document_id=self.document_name_to_id(document_name)),
-            'set_layer_strs': self.get_set_layers(document_id=self.document_name_to_id(document_name))
-        } for document_name in document_name_list}
+        all_layer_strs = {document_name: self.get_layer_index(self.document_name_to_id(document_name)).layer_strs_payload for document_name in document_name_list}
         return all_layer_strs
     
     def get_raw_layers(self, document_id=None):
-        if len(self.layers) == 0:
-            return []
-        layers = self.layers.get(document_id, []) if document_id is not None else self.layers.values()[0]
-        return list(map(lambda layer: f"{layer['name']} (id:{layer['id']})", layers))
+        return self.get_layer_index(document_id).raw_layer_strs
 
+    # the lists below are cached, don't modify
     def get_base_layers(self, document_id=None):
-        raw_layer_strs = self.get_raw_layers(document_id=document_id)
-        layer_strs = list(raw_layer_strs)
-        layer_strs.insert(0, self.SPECIAL_LAYER_USE_CANVAS)
-        return layer_strs
+        return self.get_layer_index(document_id).layer_strs
 
     def get_bounds_layers(self, document_id=None):
-        bounds_strs = list(self.get_raw_layers(document_id=document_id))
-        bounds_strs.insert(0, self.SPECIAL_LAYER_USE_SELECTION)
-        bounds_strs.insert(0, self.SPECIAL_LAYER_USE_CANVAS)
-        bounds_strs.insert(0, self.SPECIAL_LAYER_SAME_AS_LAYER)
-        return bounds_strs
+        return self.get_layer_index(document_id).bounds_strs
 
     def get_set_layers(self, document_id=None):
-        raw_layer_strs = self.get_raw_layers(document_id=document_id)
-        set_layer_strs = list(raw_layer_strs)
-        set_layer_strs.insert(0, self.SPECIAL_LAYER_NEW_LAYER)
-        return set_layer_strs
+        return self.get_layer_index(document_id).set_layer_strs
+
+    def has_base_layer(self, document_id, layer_name):
+        return layer_name in self.get_layer_index(document_id).layer_str_set
+
+    def has_bounds_layer(self, document_id, layer_name):
+        return layer_name in self.get_layer_index(document_id).bounds_str_set
+
+    def get_layer(self, document_id, layer_id):
+        return self.get_layer_index(document_id).id_to_layer.get(layer_id, None)
 
     def layer_name_to_id(self, layer_name, refrence_id=None):
         id = 0
@@ -137,40 +374,174 @@ class PhotoshopInstance:
             id = refrence_id
         elif self.SPECIAL_LAYER_NAME_TO_ID.get(layer_name, None) is not None:
             id = self.SPECIAL_LAYER_NAME_TO_ID[layer_name]
+        elif self.layer_str_to_id.get(layer_name, None) is not None:
+            id = self.layer_str_to_id[layer_name]
         else:
             layer_name_and_id_split = layer_name.split('(id:')
             id = int(layer_name_and_id_split.pop().strip()[:-1])
         return id
 
-    async def check_document_changed(self, document_id):
+    # with a prompt_id the latest state comes from the prompt's history snapshot, so every node of a prompt sees the same states
+    async def check_document_changed(self, document_id, prompt_id=None):
         document_history_state_id = self.change_tracker.get(document_id, None)
         if document_history_state_id is None:
-            return True
-        latest_state_id = self.get_push_history_state_id(document_id) or await self.get_active_history_state_id(document_id)
+            return True, None
+        if prompt_id is not None:
+            latest_state_id = await self.get_snapshot_history_state_id(prompt_id, document_id)
+        else:
+            latest_state_id = self.get_push_history_state_id(document_id) or await self.get_active_history_state_id(document_id)
+        return self.compare_with_tracked_state_id(document_history_state_id, latest_state_id)
+
+    # history states of all known documents taken once per prompt, ten layer nodes cost at most one round trip instead of ten
+    async def get_snapshot_history_state_id(self, prompt_id, document_id):
+        snapshot = self.history_snapshots.get(prompt_id, None)
+        if snapshot is None:
+            document_ids = set(document['id'] for document in self.documents)
+            document_ids.add(document_id)
+            snapshot = asyncio.ensure_future(self._take_history_snapshot(sorted(document_ids)))
+            self.history_snapshots[prompt_id] = snapshot
+            while len(self.history_snapshots) > self.MAX_HISTORY_SNAPSHOTS:
+                self.history_snapshots.popitem(last=False)
+        try:
+            history_state_ids = await asyncio.shield(snapshot)
+        except Exception:
+            # the next node tries again
+            if self.history_snapshots.get(prompt_id, None) is snapshot:
+                self.history_snapshots.pop(prompt_id, None)
+            raise
+        if document_id not in history_state_ids:
+            # opened after the snapshot, or the active document placeholder
+            history_state_ids[document_id] = self.get_push_history_state_id(document_id) or await self.get_active_history_state_id(document_id)
+        return history_state_ids[document_id]
+
+    # pushed states are used as they are, the rest come from one get_active_history_state_id call
+    async def _take_history_snapshot(self, document_ids):
+        history_state_ids = {document_id: self.get_push_history_state_id(document_id) for document_id in document_ids}
+        missing_document_ids = [document_id for (document_id, history_state_id) in history_state_ids.items() if history_state_id is None]
+        if len(missing_document_ids) > 0:
+            with span('history snapshot', documents=len(missing_document_ids)):
+                history_state_ids.update(zip(missing_document_ids, await self.get_active_history_state_id(missing_document_ids)))
+        return history_state_ids
+
+    def compare_with_tracked_state_id(self, document_history_state_id, latest_state_id):
         if latest_state_id is None:
             return False, document_history_state_id
         if latest_state_id > document_history_state_id:
             return True, latest_state_id
         return False, document_history_state_id
 
-    async def get_image(self, document_id, layer_id, bounds_id=False):
-        is_changed = await self.check_document_changed(document_id)
-        if not is_changed and self.last_get_img_id is not None:
-            return self.last_get_img_id
-        result = await self.wsCallsManager.call('get_image', {'document_id': document_id, 'layer_id': layer_id, 'use_layer_bounds': bounds_id}, timeout=60)
+    # returns (image, mask, layer_opacity), served from the layer image cache while the document history doesn't advance
+    # identical requests in flight share one photoshop modal operation
+    # prompt_id: see check_document_changed
+    async def get_image(self, document_id, layer_id, bounds_id=False, prompt_id=None):
+        key = (document_id, layer_id, bounds_id)
+        task = self.get_image_calls.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(self._get_image(document_id, layer_id, bounds_id, prompt_id))
+            self.get_image_calls[key] = task
+            task.add_done_callback(lambda task: self._on_get_image_done(key, task))
+        return await asyncio.shield(task)
+
+    def _on_get_image_done(self, key, task):
+        if self.get_image_calls.get(key, None) is task:
+            self.get_image_calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()
 
-        history_state_id = await self.get_active_history_state_id(document_id)
+    # returns (get_image params, tile base the upload will be relative to)
+    def _get_image_params(self, document_id, layer_id, bounds_id):
+        # upload_url keeps the upload in memory, older plugins ignore it and upload png to /upload/image
+        params = {'document_id': document_id, 'layer_id': layer_id, 'use_layer_bounds': bounds_id, 'upload_url': '/sd-ppp/upload_image', 'encoding': self.codec.name}
+        tile_base = None
+        if self.supports('tile_delta'):
+            # without a base photoshop sends the full png and the tile hashes to compare against next time
+            tile_base = self.tile_bases.get((document_id, layer_id, bounds_id))
+            params['tile_delta'] = tile_base.params() if tile_base is not None else {'tile_size': TILE_SIZE}
+        return params, tile_base
+
+    async def _get_image(self, document_id, layer_id, bounds_id=False, prompt_id=None):
+        key = (document_id, layer_id, bounds_id)
+        prefetch = self.prefetch_calls.get(key, None)
+        if prefetch is not None:
+            # the pixels are already on their way, wait instead of asking twice
+            # it also patches the tile base in place, the params below have to describe the base after it
+            with span('wait prefetch'):
+                await asyncio.wait([prefetch])
+        params, tile_base = self._get_image_params(document_id, layer_id, bounds_id)
+        result = None
+        document_history_state_id = self.change_tracker.get(document_id, None)
+        if prompt_id is None and self.supports('batch') and document_history_state_id is not None and self.get_push_history_state_id(document_id) is None:
+            # no pushed state to check against, pipeline the check and the fetch in one frame
+            # photoshop skips the fetch if nothing changed since the tracked state, only asked when the cache has the layer at that state
+            # so a skipped fetch is always a cache hit and this is one round trip either way
+            image_params = params
+            if self.layer_image_cache.contains(key + (document_history_state_id,)):
+                image_params = dict(params, skip_if_history_state_id=document_history_state_id)
+            with span('check and fetch', document_id=document_id) as trace_span:
+                state_result, result = await self.wsCallsManager.call_batch([
+                    ('get_active_history_state_id', {'document_id_list': [document_id]}),
+                    ('get_image', image_params),
+                ], timeout=60)
+                latest_state_ids = state_result.get('history_state_id', [])
+                _, history_state_id = self.compare_with_tracked_state_id(document_history_state_id, latest_state_ids[0] if len(latest_state_ids) > 0 else None)
+                if result.get('skipped', False):
+                    result = None
+                trace_span.set(skipped=result is None)
+        else:
+            with span('check document changed', document_id=document_id):
+                _, history_state_id = await self.check_document_changed(document_id, prompt_id)
+        if result is None and history_state_id is not None:
+            cached = self.layer_image_cache.get(key + (history_state_id,))
+            if cached is not None:
+                with span('layer cache hit', history_state_id=history_state_id):
+                    self.change_tracker[document_id] = history_state_id
+                    self.get_img_state_id[document_id] = max(history_state_id, self.get_img_state_id.get(document_id, 0))
+                return cached
+        if result is None:
+            with span('fetch image', delta=tile_base is not None):
+                result = await self.wsCallsManager.call('get_image', params, timeout=60)
+
+        # newer plugins return the history state after the operation inline, saves a round trip
+        history_state_id = result.get('history_state_id', None) or await self.get_active_history_state_id(document_id)
         self.change_tracker[document_id] = history_state_id
         await self.update_history_state_id_after_internal_change(document_id, history_state_id)
 
+        return await self._decode_and_cache(key, tile_base, result, history_state_id)
+
+    # key: (document_id, layer_id, bounds_id), the decoded image is cached under the history state it was fetched at
+    async def _decode_and_cache(self, key, tile_base, result, history_state_id):
         layer_opacity = result['layer_opacity']
-        id = result['upload_name']
-        self.last_get_img_id = id
-        return id, layer_opacity
+        with span('decode image', encoding=result.get('encoding', 'png'), tiles=len(result['tiles']) if result.get('delta', False) else None):
+            if result.get('tile_hashes', None) is not None:
+                try:
+                    tile_base, image, mask = await asyncio.get_running_loop().run_in_executor(None, load_tile_upload, tile_base, result)
+                except:
+                    # the base may be half patched
+                    self.tile_bases.remove(key)
+                    raise
+                self.tile_bases.put(key, tile_base, tile_base.pixels.nbytes)
+            else:
+                upload = {name: result.get(name, None) for name in ['upload_key', 'upload_name', 'encoding', 'width', 'height']}
+                image, mask = await asyncio.get_running_loop().run_in_executor(None, load_uploaded_image, upload)
+        if history_state_id is not None:
+            self.layer_image_cache.put(key + (history_state_id,), (image, mask, layer_opacity))
+        return image, mask, layer_opacity
     
-    async def send_images(self, document_id, image_ids, layer_id):
-        result = await self.wsCallsManager.call('send_images', {'document_id': document_id, 'image_ids': image_ids, 'layer_id': layer_id})
-        await self.update_history_state_id_after_internal_change(document_id)
+    # either image_ids cached for /finished_images or frames (header, rgba bytes) to push as binary frames when 'binary_push' is supported
+    # crops: where each cached image was cut from its full size image, frames carry theirs in the header
+    async def send_images(self, document_id, layer_id, image_ids=None, frames=None, crops=None):
+        params = {'document_id': document_id, 'layer_id': layer_id, 'encoding': self.codec.name}
+        if crops is not None:
+            params['crops'] = crops
+        if frames is not None:
+            image_ids = []
+            for _ in frames:
+                self.push_image_id_inc += 1
+                image_ids.append(self.push_image_id_inc)
+            params['binary'] = True
+        params['image_ids'] = image_ids
+        result = await self.wsCallsManager.call('send_images', params, binaries=frames, bundle=self.supports('bulk_images'))
+        await self.update_history_state_id_after_internal_change(document_id, result.get('history_state_id', None))
         return result
     
     # have to track this value because comfyui determines if the value is changed by comparing it with the last value.
@@ -193,18 +564,56 @@ class PhotoshopInstance:
         self.get_img_state_id[document_id] = history_state_id # it gets into a loop if get img state is not updated
 
     async def sync_layers(self, now=False):
+        # detached, waiting for photoshop to resume, the layers synced last are served meanwhile
+        if self.wsCallsManager.closed:
+            return
         if not now and time.time() - self.last_sync_layer < self.sync_layer_min_interval:
             return
-        result = await self.wsCallsManager.call('get_layers', {'document_ids_to_sync_layers': self.document_ids_to_sync_layers})
-        layers = result.get('layers', [])
-        if len(layers) == 0:
-            layers = {}
-        else:
-            layers = {layer['id']: layer['layers'] for layer in layers}
-        self.layers = layers
+        params = {'document_ids_to_sync_layers': self.document_ids_to_sync_layers}
+        if self.supports('layer_delta'):
+            # photoshop answers unchanged or with a delta for documents we already know at these versions
+            params['known_versions'] = {str(document_id): version for document_id, version in self.layer_versions.items()}
+        result = await self.wsCallsManager.call('get_layers', params)
+        self.layers, self.layer_versions = self.apply_layer_trees(result.get('layers', []), result.get('active_document_id', None))
         self.documents = result.get('documents', [])
+        self.rebuild_indexes()
+
+    # a tree is either full {id, layers}, {id, version, unchanged} or a delta {id, version, base_version, order, changed}
+    def apply_layer_trees(self, layer_trees, active_document_id=None):
+        layers = {}
+        layer_versions = {}
+        for layer_tree in layer_trees:
+            document_id = layer_tree['id']
+            if layer_tree.get('unchanged', False):
+                document_layers = self.layers.get(document_id, None)
+            elif 'order' in layer_tree:
+                document_layers = self.apply_layer_delta(document_id, layer_tree)
+            else:
+                document_layers = layer_tree.get('layers', [])
+            if document_layers is None:
+                # base is gone, leave the version out so photoshop sends the full tree next time
+                continue
+            layers[document_id] = document_layers
+            if layer_tree.get('version', None) is not None:
+                layer_versions[document_id] = layer_tree['version']
+        # the active document is sent once under its own id
+        if active_document_id is not None and active_document_id in layers:
+            layers[self.SPECIAL_DOCUMENT_TO_ID[self.SPECIAL_DOCUMENT_USE_ACTIVE]] = layers[active_document_id]
+        return layers, layer_versions
+
+    def apply_layer_delta(self, document_id, layer_tree):
+        if self.layer_versions.get(document_id, None) != layer_tree.get('base_version', None):
+            return None
+        base_layers = {layer['id']: layer for layer in self.layers.get(document_id, [])}
+        base_layers.update({layer['id']: layer for layer in layer_tree.get('changed', [])})
+        if any(layer_id not in base_layers for layer_id in layer_tree['order']):
+            return None
+        return [base_layers[layer_id] for layer_id in layer_tree['order']]
     
     async def is_ps_history_changed(self, document_name_list=None):
+        # detached, nothing can change until photoshop resumes and clients are told then
+        if self.wsCallsManager.closed:
+            return False
         if self.documents is None or len(self.documents) == 0:
             return False
         if len(self.get_img_state_id) <= 0:
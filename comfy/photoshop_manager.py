@@ -1,9 +1,16 @@
+import os
+import time
 import asyncio
+import secrets
 from .photoshop_instance import PhotoshopInstance
+from .metrics import Metrics
 DEFAULT_ID = 0
 
 class PhotoshopManager:
     _instance = None
+    # clients (browser tabs) not seen for this long are forgotten
+    CLIENT_IDLE_TIMEOUT = float(os.environ.get('SD_PPP_CLIENT_IDLE_TIMEOUT', 3600))
+    CLIENT_EVICT_INTERVAL = 60
 
     @classmethod
     def instance(cls) -> 'PhotoshopManager':
@@ -13,66 +20,140 @@ class PhotoshopManager:
 
     def __init__(self):
         # client id info
-        self.ip_to_client_id_list = {}
+        self.ip_to_client_id_set = {}
+        self.client_id_to_ip = {}
         self.client_id_to_userid = {}
+        self.client_id_last_seen = {}
         # ps instance info
         self.ip_to_ps_instance_list = {}
+        self.ip_and_user_id_to_ps_instance = {}
+        self.ps_instance_to_ip = {}
+        # session token -> instance, for instances that negotiated 'resume'
+        self.session_to_ps_instance = {}
         # final match
         self.client_id_to_ps_instance = {}
+        self.ps_instance_to_client_id_set = {}
+        # called with (client_id_list, document_ids) when photoshop pushes a history change
+        self.on_history_changed = None
+        # called with the instance when a photoshop connects or resumes, unmatched clients can only be reached by a broadcast
+        self.on_photoshop_connected = None
+        self.last_evict_time = time.time()
+        self.evicted_client_count = 0
 
     # get instance from client information, match new instance if not exist
     def instance_from_client_info(self, ip, client_id, user_id) -> PhotoshopInstance:
         if not ip: return None
         if not client_id: user_id = 0
         if not user_id: user_id = 0
+        self._evict_idle_clients_if_due()
         instance = self.instance_from_client_id(client_id)
         if instance is not None:
             return instance
         self._add_new_client(ip, client_id, user_id)
         self._client_match_ps(ip, client_id, user_id)
         return self.instance_from_client_id(client_id)
-    
+
     # get instance from client id
     def instance_from_client_id(self, client_id) -> PhotoshopInstance:
+        if client_id in self.client_id_last_seen:
+            self.client_id_last_seen[client_id] = time.time()
         return self.client_id_to_ps_instance.get(client_id, None)
 
-    # create new instance and record
-    async def new_ps_instance(self, ws, ip, user_id) -> PhotoshopInstance:
+    # create new instance and record, or re-attach the instance of the session when it's still kept
+    async def new_ps_instance(self, ws, ip, user_id, version=1, features=None, codec='png', session=None, message_codec='json') -> PhotoshopInstance:
         if not ip: return None
         if not user_id: user_id = 0
+        if session and 'resume' in (features or []):
+            instance = self.session_to_ps_instance.get(session, None)
+            # same photoshop means same ip and user id, a leaked token alone isn't enough
+            if instance is not None and not instance.destroyed and self.ps_instance_to_ip.get(instance, None) == ip and instance.uid == user_id:
+                await instance.attach(ws, version, features, codec, message_codec)
+                Metrics.instance().inc('sd_ppp_sessions_total', outcome='resumed')
+                self._notify_photoshop_connected(instance)
+                return instance
         # create new instance
-        instance = PhotoshopInstance(ws, user_id)
+        instance = PhotoshopInstance(ws, user_id, version, features, codec, message_codec)
+        if instance.supports('resume'):
+            instance.session = secrets.token_urlsafe(16)
+            self.session_to_ps_instance[instance.session] = instance
+        Metrics.instance().inc('sd_ppp_sessions_total', outcome='new')
         instance.on_destroy = self._on_instance_destroy
+        instance.on_history_changed = self._on_instance_history_changed
         # record new instance
         await self._add_new_ps_instance(ip, instance)
+        self._notify_photoshop_connected(instance)
         return instance
 
+    def stats(self):
+        return {
+            'clients': len(self.client_id_to_ip),
+            'matched_clients': len(self.client_id_to_ps_instance),
+            'instances': len(self.ps_instance_to_ip),
+            'ips': len(self.ip_to_ps_instance_list),
+            'evicted_clients': self.evicted_client_count,
+        }
+
+    # forget clients that haven't polled or run a prompt for CLIENT_IDLE_TIMEOUT seconds
+    def evict_idle_clients(self, now=None):
+        if now is None:
+            now = time.time()
+        deadline = now - self.CLIENT_IDLE_TIMEOUT
+        idle_client_ids = [client_id for client_id, last_seen in self.client_id_last_seen.items() if last_seen < deadline]
+        for client_id in idle_client_ids:
+            self._remove_client(client_id)
+        self.evicted_client_count += len(idle_client_ids)
+        return len(idle_client_ids)
+
     #------------------------------------------------------------------------------------------------------------------------------------------------
     # callback when instance is destroyed and remove from record
     def _on_instance_destroy(self, instance):
         self._remove_instance(instance)
 
+    # forward pushed history changes to the comfyui clients matched with the instance
+    def _on_instance_history_changed(self, instance, document_ids):
+        if self.on_history_changed is None:
+            return
+        client_id_list = list(self.ps_instance_to_client_id_set.get(instance, []))
+        if len(client_id_list) == 0:
+            return
+        self.on_history_changed(client_id_list, document_ids)
+
+    def _notify_photoshop_connected(self, instance):
+        if self.on_photoshop_connected is None:
+            return
+        self.on_photoshop_connected(instance)
+
+    def _evict_idle_clients_if_due(self):
+        now = time.time()
+        if now - self.last_evict_time < self.CLIENT_EVICT_INTERVAL:
+            return
+        self.last_evict_time = now
+        self.evict_idle_clients(now)
+
     # record new ps instance for matching
     async def _add_new_ps_instance(self, ip, instance):
-        # find old one and destroy
-        same_ip_list = self.ip_to_ps_instance_list.get(ip, [])
-        for check_instance in same_ip_list:
-            if check_instance.uid == instance.uid:
-                await check_instance.destroy()
+        # find old one and destroy, same ip + same user id = same photoshop reconnecting
+        old_instance = self.ip_and_user_id_to_ps_instance.get((ip, instance.uid), None)
+        if old_instance is not None:
+            await old_instance.destroy()
         # record ip to instance
         ps_instance_list = self.ip_to_ps_instance_list.get(ip, [])
         if instance not in ps_instance_list:
             ps_instance_list.append(instance)
         self.ip_to_ps_instance_list[ip] = ps_instance_list
+        self.ip_and_user_id_to_ps_instance[(ip, instance.uid)] = instance
+        self.ps_instance_to_ip[instance] = ip
 
     # record new client id
     def _add_new_client(self, ip, client_id, user_id):
         # record client id, if exist, do nothing
-        client_id_list = self.ip_to_client_id_list.get(ip, [])
-        if client_id in client_id_list:
+        if self.client_id_to_ip.get(client_id, None) == ip:
+            self.client_id_last_seen[client_id] = time.time()
             return
-        client_id_list.append(client_id)
-        self.ip_to_client_id_list[ip] = client_id_list
+        self._remove_client(client_id)
+        self.ip_to_client_id_set.setdefault(ip, set()).add(client_id)
+        self.client_id_to_ip[client_id] = ip
+        self.client_id_last_seen[client_id] = time.time()
         # record user_id
         self.client_id_to_userid[client_id] = user_id
 
@@ -92,25 +173,47 @@ class PhotoshopManager:
             return
         # if only one same ip ps instance, assign client id
         if count == 1:
-            self.client_id_to_ps_instance[client_id] = ps_instance_list[0]
+            self._match(client_id, ps_instance_list[0])
             return
         # if more than one same ip ps instance, check same user_id, same ip + same user id = same ps instance
-        ps_user_id_list = [instance.uid for instance in ps_instance_list]
-        try:
-            check_index = ps_user_id_list.index(user_id)
-        except:
-            check_index = None
-        if check_index is None:
+        instance = self.ip_and_user_id_to_ps_instance.get((ip, user_id), None)
+        if instance is None:
             return
-        self.client_id_to_ps_instance[client_id] = ps_instance_list[check_index]
+        self._match(client_id, instance)
+
+    def _match(self, client_id, instance):
+        self.client_id_to_ps_instance[client_id] = instance
+        self.ps_instance_to_client_id_set.setdefault(instance, set()).add(client_id)
+
+    def _remove_client(self, client_id):
+        ip = self.client_id_to_ip.pop(client_id, None)
+        if ip is not None:
+            client_id_set = self.ip_to_client_id_set.get(ip, set())
+            client_id_set.discard(client_id)
+            if len(client_id_set) == 0:
+                self.ip_to_client_id_set.pop(ip, None)
+        self.client_id_to_userid.pop(client_id, None)
+        self.client_id_last_seen.pop(client_id, None)
+        instance = self.client_id_to_ps_instance.pop(client_id, None)
+        if instance is not None:
+            self.ps_instance_to_client_id_set.get(instance, set()).discard(client_id)
+            instance.remove_watched_layers(client_id)
 
     def _remove_instance(self, instance):
+        if instance.session is not None and self.session_to_ps_instance.get(instance.session, None) is instance:
+            self.session_to_ps_instance.pop(instance.session, None)
         # remove id from ip to instance list
-        for ip, ps_instance_list in self.ip_to_ps_instance_list.items():
+        ip = self.ps_instance_to_ip.pop(instance, None)
+        if ip is not None:
+            ps_instance_list = self.ip_to_ps_instance_list.get(ip, [])
             if instance in ps_instance_list:
                 ps_instance_list.remove(instance)
-        # remove instance from client id to instance
-        for client_id in list(self.client_id_to_ps_instance.keys()):
-            check_instance = self.client_id_to_ps_instance.get(client_id, None)
-            if check_instance == instance:
-                self.client_id_to_ps_instance.pop(client_id, None)
\ No newline at end of file
+            if len(ps_instance_list) == 0:
+                self.ip_to_ps_instance_list.pop(ip, None)
+            if self.ip_and_user_id_to_ps_instance.get((ip, instance.uid), None) is instance:
+                self.ip_and_user_id_to_ps_instance.pop((ip, instance.uid), None)
+        # remove instance from client id to instance, clients get matched again on their next request
+        for client_id in self.ps_instance_to_client_id_set.pop(instance, set()):
+            if self.client_id_to_ps_instance.get(client_id, None) is instance:
+                self.client_id_to_ps_instance.pop(client_id, None)
+            instance.remove_watched_layers(client_id)
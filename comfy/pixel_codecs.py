@@ -0,0 +1,146 @@
+import os
+import zlib
+from io import BytesIO
+import numpy as np
+from PIL import Image, ImageOps
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PNG_COMPRESS_LEVEL = int(os.environ.get('SD_PPP_PNG_COMPRESS_LEVEL', 6))
+ZLIB_LEVEL = int(os.environ.get('SD_PPP_ZLIB_LEVEL', 1))
+ZSTD_LEVEL = int(os.environ.get('SD_PPP_ZSTD_LEVEL', 3))
+# server preference, the first one the plugin also understands is used for every image of that photoshop instance
+SERVER_CODECS = [name.strip() for name in os.environ.get('SD_PPP_CODECS', 'zlib,png').split(',') if name.strip()]
+
+# [..., C] uint8 pixels to [..., 4]
+def to_rgba(pixels):
+    channels = pixels.shape[-1]
+    if channels == 4:
+        return pixels
+    if channels < 3:
+        pixels = np.repeat(pixels[..., :1], 3, axis=-1)
+    alpha = np.full(pixels.shape[:-1] + (1,), 255, dtype=np.uint8)
+    return np.concatenate([pixels[..., :3], alpha], axis=-1)
+
+class PngCodec:
+    name = 'png'
+    content_type = 'image/png'
+    rgba = False
+
+    def __init__(self, compress_level=PNG_COMPRESS_LEVEL):
+        self.compress_level = compress_level
+
+    # pixels: [H, W, C] uint8 array
+    def encode(self, pixels):
+        stream = BytesIO()
+        Image.fromarray(np.ascontiguousarray(pixels)).save(stream, "PNG", compress_level=self.compress_level)
+        return stream.getvalue()
+
+    # same bytes as encode, written to a file object instead of being built in memory
+    def encode_to(self, pixels, file):
+        Image.fromarray(np.ascontiguousarray(pixels)).save(file, "PNG", compress_level=self.compress_level)
+
+    # the size is in the png
+    def decode(self, data, width=None, height=None):
+        image = Image.open(BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        return np.array(image.convert("RGBA"))
+
+class Uncompressed:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+# rgba rows, optionally compressed, the size travels next to the data
+class RawCodec:
+    name = 'raw'
+    content_type = 'application/octet-stream'
+    rgba = True
+    # rows converted and compressed at a time by encode_to
+    STREAM_CHUNK_BYTES = 16 * 1024 * 1024
+
+    def compress(self, data):
+        return data
+
+    # size: bytes that will go through it
+    def compressor(self, size=None):
+        return Uncompressed()
+
+    def decompress(self, data):
+        return data
+
+    def encode(self, pixels):
+        return self.compress(np.ascontiguousarray(to_rgba(pixels)).tobytes())
+
+    # streams the rows through the compressor, neither the rgba copy nor the output is ever whole in memory
+    def encode_to(self, pixels, file):
+        compressor = self.compressor(pixels.shape[0] * pixels.shape[1] * 4)
+        rows = max(1, self.STREAM_CHUNK_BYTES // max(1, pixels.shape[1] * 4))
+        for start in range(0, pixels.shape[0], rows):
+            file.write(compressor.compress(np.ascontiguousarray(to_rgba(pixels[start:start + rows])).tobytes()))
+        file.write(compressor.flush())
+
+    def decode(self, data, width, height):
+        data = self.decompress(data)
+        if len(data) != width * height * 4:
+            raise ValueError(f"{self.name} image is {len(data)} bytes, expected {width}x{height} rgba")
+        return np.frombuffer(data, np.uint8).reshape(height, width, 4).copy()
+
+class ZlibCodec(RawCodec):
+    name = 'zlib'
+
+    def __init__(self, level=ZLIB_LEVEL):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def compressor(self, size=None):
+        return zlib.compressobj(self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+# only when the optional zstandard package is installed
+class ZstdCodec(RawCodec):
+    name = 'zstd'
+
+    def __init__(self, level=ZSTD_LEVEL):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    # the size goes into the frame header, decoders that need it up front can read the stream
+    def compressor(self, size=None):
+        return zstandard.ZstdCompressor(level=self.level).compressobj(size=-1 if size is None else size)
+
+    # a decompressobj also reads frames written without their content size
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+CODECS = {codec.name: codec for codec in [PngCodec(), RawCodec(), ZlibCodec()]}
+if zstandard is not None:
+    CODECS['zstd'] = ZstdCodec()
+
+def get_codec(name=None):
+    if not name:
+        name = 'png'
+    codec = CODECS.get(name, None)
+    if codec is None:
+        raise ValueError(f"Unknown image encoding {name}")
+    return codec
+
+# older plugins don't send codecs and keep png
+def negotiate_codec(version, codecs_query):
+    if version < 2 or not codecs_query:
+        return 'png'
+    client_codecs = set(name.strip() for name in codecs_query.split(','))
+    for name in SERVER_CODECS:
+        if name in CODECS and name in client_codecs:
+            return name
+    return 'png'
@@ -0,0 +1,64 @@
+import os
+import json
+import struct
+
+# version 1: json calls only, images are pulled through /finished_images
+# version 2: the plugin lists the features it understands in the `features` query, the server answers with the accepted ones in a handshake message
+SUPPORTED_VERSIONS = [1, 2]
+SERVER_FEATURES = [
+    'binary_push', # send_images pixels are pushed as binary frames before the call instead of being downloaded
+    'batch', # several actions in one 'batch' call, results returned together
+    'layer_delta', # get_layers only sends documents whose layer tree changed since the version the server knows, as a delta
+    'bulk_images', # all binary_push frames of a call travel in one length-prefixed bundle frame
+    'tile_delta', # get_image uploads only the tiles that changed since the pixels the server kept from the last fetch
+    'resume', # the handshake carries a session token, reconnecting with it re-attaches to the instance state kept for a grace period
+]
+# seconds between websocket pings, a peer that doesn't answer within half of it is dropped, 0 disables
+HEARTBEAT = float(os.environ.get('SD_PPP_HEARTBEAT', 20))
+# bundles are split into several frames of at most this many payload bytes, an image bigger than it goes alone
+BUNDLE_MAX_BYTES = int(os.environ.get('SD_PPP_BUNDLE_MAX_BYTES', 16 * 1024 * 1024))
+
+# binary frame layout: kind(uint8) + header length(uint32 big endian) + json header + payload
+BINARY_FRAME_IMAGE = 1
+# header {'first': index of the first frame, 'frames': [frame header + offset + length, ...]}, payload is every frame's bytes back to back
+BINARY_FRAME_IMAGE_BUNDLE = 2
+# header {}, payload is one message in the negotiated binary message codec (msgpack)
+BINARY_FRAME_MESSAGE = 3
+BINARY_FRAME_PREFIX = struct.Struct('>BI')
+
+def negotiate_features(version, features_query):
+    if version < 2 or not features_query:
+        return set()
+    client_features = set(feature.strip() for feature in features_query.split(','))
+    return client_features & set(SERVER_FEATURES)
+
+def pack_binary_frame(kind, header, payload):
+    header_bytes = json.dumps(header).encode('utf-8')
+    return b''.join([BINARY_FRAME_PREFIX.pack(kind, len(header_bytes)), header_bytes, payload])
+
+def pack_image_bundle(header, frames, first=0):
+    frame_headers = []
+    offset = 0
+    for (frame_header, data) in frames:
+        frame_headers.append(dict(frame_header, offset=offset, length=len(data)))
+        offset += len(data)
+    return pack_binary_frame(BINARY_FRAME_IMAGE_BUNDLE, dict(header, first=first, frames=frame_headers), b''.join([data for (_, data) in frames]))
+
+# yields the bundle frames of frames, packed one at a time so only one of them is in memory next to the images
+def pack_image_bundles(header, frames, max_bytes=BUNDLE_MAX_BYTES):
+    first = 0
+    size = 0
+    for (index, (_, data)) in enumerate(frames):
+        if index > first and size + len(data) > max_bytes:
+            yield pack_image_bundle(header, frames[first:index], first)
+            first = index
+            size = 0
+        size += len(data)
+    if first < len(frames):
+        yield pack_image_bundle(header, frames[first:], first)
+
+def unpack_binary_frame(data):
+    kind, header_length = BINARY_FRAME_PREFIX.unpack_from(data, 0)
+    header_end = BINARY_FRAME_PREFIX.size + header_length
+    header = json.loads(bytes(data[BINARY_FRAME_PREFIX.size:header_end]).decode('utf-8'))
+    return kind, header, memoryview(data)[header_end:]
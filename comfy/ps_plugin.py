@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+import platform
+import shutil
+import zipfile
+import subprocess
+
+# photoshop/dist and the .ccx are committed prebuilt, plugin developers can opt in to rebuilding them at startup when the source changed
+BUILD_PLUGIN = os.environ.get('SD_PPP_BUILD_PLUGIN', '0') == '1'
+PHOTOSHOP_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photoshop'))
+DIST_PATH = os.path.join(PHOTOSHOP_PATH, 'dist')
+CCX_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'plugins', 'sd-ppp_PS.ccx'))
+# everything webpack reads
+SOURCE_PATHS = ['src', 'plugin', 'package.json', 'package-lock.json', 'webpack.config.js']
+# hash of the source a dist was built from, also copied to the installed plugin
+SOURCE_HASH_FILE = 'source_hash'
+
+def plugin_source_hash():
+    digest = hashlib.sha256()
+    for source_path in SOURCE_PATHS:
+        path = os.path.join(PHOTOSHOP_PATH, source_path)
+        files = [path] if os.path.isfile(path) else sorted(os.path.join(root, name) for (root, _, names) in os.walk(path) for name in names)
+        for file in files:
+            digest.update(os.path.relpath(file, PHOTOSHOP_PATH).replace(os.sep, '/').encode('utf-8'))
+            with open(file, 'rb') as f:
+                # crlf and lf checkouts build the same plugin
+                digest.update(f.read().replace(b'\r\n', b'\n'))
+    return digest.hexdigest()
+
+def get_source_hash_from_path(path):
+    hash_path = os.path.join(path, SOURCE_HASH_FILE)
+    if not os.path.exists(hash_path):
+        return None
+    with open(hash_path, 'r') as f:
+        return f.read().strip()
+
+def is_dist_stale():
+    return get_source_hash_from_path(DIST_PATH) != plugin_source_hash()
+
+# the .ccx is a zip of dist, with the single host manifest photoshop's installer expects
+def pack_ccx():
+    with zipfile.ZipFile(CCX_PATH, 'w', zipfile.ZIP_DEFLATED) as ccx:
+        for (root, _, names) in os.walk(DIST_PATH):
+            for name in sorted(names):
+                if name == SOURCE_HASH_FILE:
+                    continue
+                file = os.path.join(root, name)
+                arcname = os.path.relpath(file, DIST_PATH).replace(os.sep, '/')
+                if arcname == 'manifest.json':
+                    with open(file, 'r') as f:
+                        data = json.load(f)
+                    if isinstance(data.get('host', None), list) and len(data['host']) > 0:
+                        data['host'] = data['host'][0]
+                    ccx.writestr(arcname, json.dumps(data, indent=2))
+                    continue
+                ccx.write(file, arcname)
+
+# returns True when dist matches the source afterwards
+def build_ps_plugin_if_stale():
+    if not is_dist_stale():
+        return True
+    if not BUILD_PLUGIN:
+        print("SD-PPP: Photoshop plugin in photoshop/dist is older than its source, start ComfyUI with SD_PPP_BUILD_PLUGIN=1 to rebuild it and sd-ppp_PS.ccx (needs npm)")
+        return False
+    npm = shutil.which('npm')
+    if npm is None:
+        print("SD-PPP: npm not found, Photoshop plugin not rebuilt")
+        return False
+    print("SD-PPP: Building Photoshop plugin")
+    try:
+        # also picks up package-lock.json changes and repairs a half finished install
+        subprocess.run([npm, 'ci', '--no-audit', '--no-fund'], cwd=PHOTOSHOP_PATH, check=True)
+        subprocess.run([npm, 'run', 'build'], cwd=PHOTOSHOP_PATH, check=True)
+        with open(os.path.join(DIST_PATH, SOURCE_HASH_FILE), 'w') as f:
+            f.write(plugin_source_hash())
+        pack_ccx()
+    except Exception as e:
+        print("SD-PPP: Photoshop plugin build failed")
+        print(e)
+        return False
+    print("SD-PPP: Photoshop plugin built")
+    return True
+
+def auto_install_ps_plugin():
+    # only warns unless SD_PPP_BUILD_PLUGIN=1
+    build_ps_plugin_if_stale()
+    system = platform.system()
+    if system != 'Windows':
+        print("SD-PPP: Auto install Photoshop plugin only support Windows")
+        return
+    ps_plugin_path = []
+    try:
+        import winreg
+        aReg = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
+        aKey = winreg.OpenKey(aReg, r"SOFTWARE\Adobe\Photoshop")
+        for i in range(1024):
+            try:
+                asubkey_name = winreg.EnumKey(aKey, i)
+                asubkey = winreg.OpenKey(aKey, asubkey_name)
+                val = winreg.QueryValueEx(asubkey, "PluginPath")
+                ps_plugin_path.append(val[0])
+            except EnvironmentError:
+                break
+    except Exception as e:
+        print("SD-PPP: Failed to get Photoshop plugin path")
+        print(e)
+    if len(ps_plugin_path) <= 0:
+        print("SD-PPP: Photoshop plugin path not found")
+        return
+    print("SD-PPP: Photoshop plugin path found")
+    for path in ps_plugin_path:
+        print("SD-PPP: Checking to install Photoshop plugin to path: " + path)
+        try_install_ps_plugin(path)
+    
+def get_version_from_path(path):
+    manifest_path = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        data = json.load(f)
+        return data.get("version", None)
+
+def perpare_manifest(manifest_path):
+    data = None
+    with open(manifest_path, "r") as f:
+        data = json.load(f)
+        host = data.get("host", None)
+        if host is None:
+            return
+        if not isinstance(host, list):
+            return
+        if len(host) <= 0:
+            return
+        data["host"] = host[0]
+    with open(manifest_path, "w") as f:
+        json.dump(data, f, indent=4)
+        
+
+FORCE_REINSTALL = False
+def try_install_ps_plugin(ps_plugin_path):
+    #check path exist
+    if not os.path.exists(ps_plugin_path):
+        print("SD-PPP: Photoshop plugin path not exist")
+        return
+    dst_extension_name = "sd-ppp_PS"
+    dst_extension_path = os.path.join(ps_plugin_path, dst_extension_name)
+    src_extension_path = DIST_PATH
+    if os.path.exists(dst_extension_path):
+        if not FORCE_REINSTALL:
+            #check version
+            src_version = get_version_from_path(src_extension_path)
+            dst_version = get_version_from_path(dst_extension_path)
+            # a rebuilt plugin keeps its version
+            if src_version == dst_version and get_source_hash_from_path(src_extension_path) == get_source_hash_from_path(dst_extension_path):
+                print("SD-PPP: Photoshop plugin already installed")
+                return
+            else:
+                print("SD-PPP: Photoshop plugin version mismatch")
+        #remove old folder
+        shutil.rmtree(dst_extension_path)
+    #fix manifest format
+    perpare_manifest(os.path.join(src_extension_path, "manifest.json"))
+    #clone directory to path
+    try:
+        shutil.copytree(src_extension_path, dst_extension_path)
+    except Exception as e:
+        print("SD-PPP: Photoshop plugin install failed")
+        print(e)
+        return
+    print("SD-PPP: Photoshop plugin installed")
+
+
+if __name__ == "__main__":
+    auto_install_ps_plugin()
\ No newline at end of file
@@ -0,0 +1,44 @@
+import os
+import asyncio
+import traceback
+from server import PromptServer
+
+# nodes run on the prompt worker thread while the photoshop websockets belong to the PromptServer loop,
+# so every photoshop coroutine is submitted to that loop instead of spinning a new loop (and thread) per call
+MAX_BACKGROUND_CALLS = int(os.environ.get('SD_PPP_MAX_BACKGROUND_CALLS', 8))
+_background_slots = None
+
+def _server_loop():
+    loop = PromptServer.instance.loop
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        raise RuntimeError('can not block the server loop waiting for a coroutine scheduled on itself')
+    return loop
+
+# block the calling thread until the coroutine finished on the server loop
+def run_on_server_loop(coroutine, timeout=None):
+    future = asyncio.run_coroutine_threadsafe(coroutine, _server_loop())
+    return future.result(timeout)
+
+# schedule without waiting, at most MAX_BACKGROUND_CALLS run at the same time and the rest wait for a slot
+def submit_to_server_loop(coroutine):
+    future = asyncio.run_coroutine_threadsafe(_run_in_background_slot(coroutine), _server_loop())
+    future.add_done_callback(_report_background_error)
+    return future
+
+async def _run_in_background_slot(coroutine):
+    global _background_slots
+    if _background_slots is None:
+        _background_slots = asyncio.Semaphore(MAX_BACKGROUND_CALLS)
+    async with _background_slots:
+        return await coroutine
+
+def _report_background_error(future):
+    if future.cancelled() or future.exception() is None:
+        return
+    exception = future.exception()
+    print('SD-PPP: background photoshop call failed')
+    traceback.print_exception(type(exception), exception, exception.__traceback__)
@@ -0,0 +1,37 @@
+import os
+import mmap
+import tempfile
+
+# encoded outputs of at least this many pixel bytes are written to a scratch file instead of memory, 0 disables
+SPILL_MIN_BYTES = int(os.environ.get('SD_PPP_SPILL_MIN_BYTES', 64 * 1024 * 1024))
+# system temp dir by default
+SPILL_DIR = os.environ.get('SD_PPP_SPILL_DIR', None) or None
+
+# an encoded image in an anonymous temp file, read through a read only memory map so pages come from the os file cache
+# nothing to clean up: the file has no name on posix (deleted on close on windows) and is closed when the last reference goes away
+class SpilledImage:
+    def __init__(self, file):
+        self.file = file
+        self.file.flush()
+        self.size = os.fstat(file.fileno()).st_size
+        self.map = mmap.mmap(file.fileno(), self.size, access=mmap.ACCESS_READ) if self.size > 0 else None
+
+    def __len__(self):
+        return self.size
+
+    def view(self):
+        if self.map is None:
+            return memoryview(b'')
+        return memoryview(self.map)
+
+def should_spill(pixels):
+    return SPILL_MIN_BYTES > 0 and pixels.nbytes >= SPILL_MIN_BYTES
+
+def encode_to_disk(codec, pixels):
+    file = tempfile.TemporaryFile(prefix='sd-ppp-', dir=SPILL_DIR)
+    try:
+        codec.encode_to(pixels, file)
+        return SpilledImage(file)
+    except Exception:
+        file.close()
+        raise
@@ -4,7 +4,12 @@ import { api } from "../../../scripts/api.js"
 console.log("[sd-ppp]", "Loading js extension");
 
 const DEFAULT_USER_ID = "Change if sharing remote server"
+// changes are pushed by the server, polling is only a fallback
+const FALLBACK_CHECK_INTERVAL = 30000
+// until this tab is matched with a photoshop nothing is pushed to it, so poll faster
+const UNMATCHED_CHECK_INTERVAL = 2000
 
+let matched = false;
 let docStrs = [];
 let docsLayerStrs = {};
 let getDocWidgetList = [];
@@ -39,8 +44,10 @@ app.registerExtension({
 	async setup() {
 		// init for backend
 		await api.fetchApi(`/sd-ppp/init?client_id=${api.clientId}&user_id=${getUserId()}`);
-		// set change query loop
-		setInterval(checkChanges, 2000);
+		// check when photoshop pushes a history change or connects, and poll in case a push was missed
+		api.addEventListener("sd-ppp-history-changed", checkChanges);
+		api.addEventListener("sd-ppp-photoshop-connected", checkChanges);
+		scheduleFallbackCheck();
 		// add setting for using remote server
 		const userName = localStorage["Comfy.userName"];
 		const emptyValue = app.multiUserServer ? userName : DEFAULT_USER_ID
@@ -134,9 +141,33 @@ const SDPPPNodes = [
 	'Get Image From Photoshop Layer',
     'Send Images To Photoshop',
 ]
+function scheduleFallbackCheck() {
+	setTimeout(async () => {
+		await checkChanges();
+		scheduleFallbackCheck();
+	}, matched ? FALLBACK_CHECK_INTERVAL : UNMATCHED_CHECK_INTERVAL);
+}
+
+let checkingChanges = null;
+let checkChangesAgain = false;
 async function checkChanges() {
-	await checkHistoryChanges();
-	await refreshLayers();
+	// a change while checking is picked up by one more check right after
+	if (checkingChanges) {
+		checkChangesAgain = true;
+		return checkingChanges;
+	}
+	checkingChanges = (async () => {
+		do {
+			checkChangesAgain = false;
+			await checkHistoryChanges();
+			await refreshLayers();
+		} while (checkChangesAgain);
+	})();
+	try {
+		await checkingChanges;
+	} finally {
+		checkingChanges = null;
+	}
 }
 
 async function refreshLayers() {
@@ -148,6 +179,7 @@ async function refreshLayers() {
 			body: JSON.stringify({ document_str_list: documentStrList }),
 		});
 		const json = await res.json()
+		matched = !!json.matched;
 		docStrs = json.doc_strs || [];
 		const newDocsLayerStrs = json.docs_layers_strs || {};
 		for (const [docStr, docLayerStrs] of Object.entries(newDocsLayerStrs)) {
@@ -166,14 +198,18 @@ async function refreshLayers() {
 async function checkHistoryChanges() {
 	try {
 		const currentState = app.graph.serialize();
-		const mode0NodeTypes = currentState.nodes.filter(node => node.mode == 0).map(node => node.type);
-		const containsSDPPPNodes = mode0NodeTypes.some(nodeType => SDPPPNodes.includes(nodeType));
+		const mode0Nodes = currentState.nodes.filter(node => node.mode == 0);
+		const containsSDPPPNodes = mode0Nodes.some(node => SDPPPNodes.includes(node.type));
 		if (!containsSDPPPNodes) return;
 		const documentStrList = getDocWidgetStrs(getDocWidgetList);
+		// [document, layer, use_layer_bounds] the server can prefetch when photoshop pushes an edit
+		const watchedLayers = mode0Nodes
+			.filter(node => node.type == SDPPPNodes[0] && node.widgets_values?.length >= 3)
+			.map(node => node.widgets_values.slice(0, 3));
 		const res = await api.fetchApi(`/sd-ppp/checkchanges?client_id=${api.clientId}&user_id=${getUserId()}`, {
 			method: "POST",
 			headers: { "Content-Type": "application/json" },
-			body: JSON.stringify({ document_str_list: documentStrList }),
+			body: JSON.stringify({ document_str_list: documentStrList, watched_layers: watchedLayers }),
 		});
 		const json = await res.json()
 		if (!json.is_changed) return;
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+from .image_cache import ImageCache
+from .pixel_codecs import get_codec
+from .utils import rgba_to_image_and_mask
+
+# photoshop hashes the layer in TILE_SIZE x TILE_SIZE tiles and only uploads the ones that changed since the server's copy
+TILE_SIZE = 256
+# memory budget per photoshop connection for the last full pixels of each fetched layer
+TILE_BASE_MAX_BYTES = int(os.environ.get('SD_PPP_TILE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# last full rgba pixels of one (document, layer, bounds) and photoshop's hashes of its tiles
+class TileBase:
+    def __init__(self, pixels, tile_size, hashes):
+        self.pixels = pixels
+        self.tile_size = tile_size
+        self.hashes = hashes
+
+    # sent as get_image's tile_delta param
+    def params(self):
+        return {
+            'tile_size': self.tile_size,
+            'width': self.pixels.shape[1],
+            'height': self.pixels.shape[0],
+            'hashes': self.hashes,
+        }
+
+# tiles are row major indexes, data is their rgba rows back to back, edge tiles are clipped to the image
+def apply_tiles(pixels, tile_size, tiles, data):
+    height, width = pixels.shape[:2]
+    tiles_x = (width + tile_size - 1) // tile_size
+    offset = 0
+    for index in tiles:
+        top = (index // tiles_x) * tile_size
+        left = (index % tiles_x) * tile_size
+        tile_height = min(tile_size, height - top)
+        tile_width = min(tile_size, width - left)
+        if tile_height <= 0 or tile_width <= 0:
+            raise ValueError(f"Tile {index} is outside of the image")
+        count = tile_height * tile_width * 4
+        if offset + count > len(data):
+            raise ValueError(f"Tile data from photoshop is truncated")
+        pixels[top:top + tile_height, left:left + tile_width] = np.frombuffer(data, np.uint8, count, offset).reshape(tile_height, tile_width, 4)
+        offset += count
+    if offset != len(data):
+        raise ValueError(f"Tile data from photoshop has {len(data) - offset} extra bytes")
+
+# result of a get_image call sent with tile_delta, either a full image or the changed tiles patched into base in place
+# returns (base, image, mask)
+def load_tile_upload(base, result):
+    upload_key = result.get('upload_key', None)
+    data = ImageCache.uploads().pop(upload_key) if upload_key else b''
+    if data is None:
+        raise ValueError(f"Uploaded image from photoshop expired, please retry")
+    codec = get_codec(result.get('encoding', None))
+    if result.get('delta', False):
+        if base is None:
+            raise ValueError(f"Photoshop sent tiles without a base image")
+        # tiles are rgba rows, compressed as a whole by rgba codecs
+        if codec.rgba and len(data) > 0:
+            data = codec.decompress(data)
+        apply_tiles(base.pixels, base.tile_size, result.get('tiles', []), data)
+        base.hashes = result['tile_hashes']
+    else:
+        base = TileBase(codec.decode(data, result.get('width', None), result.get('height', None)), result.get('tile_size', TILE_SIZE), result['tile_hashes'])
+    image, mask = rgba_to_image_and_mask(base.pixels)
+    return base, image, mask
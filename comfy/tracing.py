@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+
+# opt in, spans cost a lock and a list append each
+TRACE_ENABLED = os.environ.get('SD_PPP_TRACE', '0') == '1'
+MAX_TRACED_PROMPTS = int(os.environ.get('SD_PPP_TRACE_PROMPTS', 20))
+MAX_EVENTS_PER_PROMPT = 10000
+PHOTOSHOP_TRACK = 'photoshop'
+
+# set by the nodes on the prompt thread, coroutines submitted to the server loop inherit it
+current_prompt_id = contextvars.ContextVar('sd_ppp_prompt_id', default=None)
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+NULL_SPAN = NullSpan()
+
+class Span(NullSpan):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.prompt_id = current_prompt_id.get()
+        self.track = None
+        self.started_at = None
+
+    def __enter__(self):
+        self.track = self.tracer.current_track()
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add(self.prompt_id, self.name, self.track, self.started_at, time.perf_counter() - self.started_at, self.args)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return self.__exit__(exc_type, exc_value, traceback)
+
+    # attach values known only once the span is running, e.g. a cache hit
+    def set(self, **args):
+        self.args.update(args)
+
+# spans per prompt id, exported as chrome trace event json (chrome://tracing, ui.perfetto.dev)
+# every thread and every asyncio task gets its own track so concurrent spans don't overlap on one row
+class Tracer:
+    _instance = None
+
+    @classmethod
+    def instance(cls) -> 'Tracer':
+        if cls._instance is None:
+            cls._instance = Tracer()
+        return cls._instance
+
+    def __init__(self, enabled=TRACE_ENABLED, max_prompts=MAX_TRACED_PROMPTS):
+        self.enabled = enabled
+        self.max_prompts = max_prompts
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()
+        self.epoch = time.perf_counter()
+
+    def span(self, name, **args):
+        if not self.enabled or current_prompt_id.get() is None:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def current_track(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            return ('task', id(task), task.get_name())
+        thread = threading.current_thread()
+        return ('thread', thread.ident, thread.name)
+
+    # phases photoshop measured itself: [{'name', 'start', 'duration'}] in ms from when it received the call at started_at
+    def add_photoshop_timings(self, prompt_id, action, started_at, timings):
+        if not self.enabled or prompt_id is None:
+            return
+        track = (PHOTOSHOP_TRACK, 0, 'Photoshop')
+        for timing in timings:
+            self.add(prompt_id, timing['name'], track, started_at + timing['start'] / 1000, timing['duration'] / 1000, {'action': action})
+
+    def add(self, prompt_id, name, track, started_at, duration, args):
+        if prompt_id is None:
+            return
+        with self.lock:
+            trace = self.traces.get(prompt_id, None)
+            if trace is None:
+                trace = self.traces[prompt_id] = []
+                while len(self.traces) > self.max_prompts:
+                    self.traces.popitem(last=False)
+            if len(trace) < MAX_EVENTS_PER_PROMPT:
+                trace.append((name, track, started_at, duration, args))
+
+    def prompt_ids(self):
+        with self.lock:
+            return list(self.traces.keys())
+
+    def export(self, prompt_id):
+        with self.lock:
+            trace = list(self.traces.get(prompt_id, []))
+        tids = {}
+        events = []
+        for (name, (kind, ident, label), started_at, duration, args) in sorted(trace, key=lambda event: event[2]):
+            tid = tids.get((kind, ident), None)
+            if tid is None:
+                tid = tids[(kind, ident)] = len(tids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': label}})
+            events.append({
+                'name': name,
+                'cat': kind,
+                'ph': 'X',
+                'pid': 1,
+                'tid': tid,
+                'ts': (started_at - self.epoch) * 1000000,
+                'dur': duration * 1000000,
+                'args': args,
+            })
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': f'sd-ppp prompt {prompt_id}'}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+def span(name, **args):
+    return Tracer.instance().span(name, **args)
@@ -1,113 +1,109 @@
-from PIL import Image
+from PIL import Image, ImageOps
+from io import BytesIO
 import numpy as np
-import platform
-import os
-import platform
-import shutil
-import json
-import glob
+import torch
+from .image_cache import ImageCache
+from .image_encoder import ImageEncoder
+from .pixel_codecs import get_codec, to_rgba
 
-class ImageCache:
-    data = dict()
-    image_id_inc = 0
+# float temporaries of images_to_uint8 stay under this size, whatever the batch size
+QUANTIZE_CHUNK_BYTES = 256 * 1024 * 1024
 
-def cache_images(images):
-    ret = []
-    for (batch_number, image) in enumerate(images):
-        i = 255. * image.cpu().numpy()
-        img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-        ImageCache.image_id_inc += 1
-        image_id = ImageCache.image_id_inc
-        ImageCache.data[image_id] = img
-        ret.append(image_id)
-    return ret
+# quantize a [B, H, W, C] float batch to uint8 on the tensor's device, only the uint8 result is copied to the host
+# same values as the old per image np.clip(255. * image, 0, 255).astype(np.uint8)
+def images_to_uint8(images):
+    with torch.no_grad():
+        pixels = torch.empty(images.shape, dtype=torch.uint8, device=images.device)
+        frame_bytes = max(1, images[0].nelement() * images.element_size()) if len(images) > 0 else 1
+        chunk_size = max(1, QUANTIZE_CHUNK_BYTES // frame_bytes)
+        for start in range(0, len(images), chunk_size):
+            # copy_ truncates like astype(np.uint8)
+            pixels[start:start + chunk_size].copy_(images[start:start + chunk_size].mul(255.).clamp_(0, 255))
+        return pixels.cpu().numpy()
 
-def auto_install_ps_plugin():
-    system = platform.system()
-    if system != 'Windows':
-        print("SD-PPP: Auto install Photoshop plugin only support Windows")
-        return
-    ps_plugin_path = []
-    try:
-        import winreg
-        aReg = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
-        aKey = winreg.OpenKey(aReg, r"SOFTWARE\Adobe\Photoshop")
-        for i in range(1024):
-            try:
-                asubkey_name = winreg.EnumKey(aKey, i)
-                asubkey = winreg.OpenKey(aKey, asubkey_name)
-                val = winreg.QueryValueEx(asubkey, "PluginPath")
-                ps_plugin_path.append(val[0])
-            except EnvironmentError:
-                break
-    except Exception as e:
-        print("SD-PPP: Failed to get Photoshop plugin path")
-        print(e)
-    if len(ps_plugin_path) <= 0:
-        print("SD-PPP: Photoshop plugin path not found")
-        return
-    print("SD-PPP: Photoshop plugin path found")
-    for path in ps_plugin_path:
-        print("SD-PPP: Checking to install Photoshop plugin to path: " + path)
-        try_install_ps_plugin(path)
-    
-def get_version_from_path(path):
-    manifest_path = os.path.join(path, "manifest.json")
-    if not os.path.exists(manifest_path):
-        return None
-    with open(manifest_path, "r") as f:
-        data = json.load(f)
-        return data.get("version", None)
+# bounding box of the non transparent pixels of a [H, W, C] image, the whole image without alpha or when fully transparent
+def opaque_bounds(pixels):
+    height, width = pixels.shape[:2]
+    crop = {'left': 0, 'top': 0, 'width': width, 'height': height, 'full_width': width, 'full_height': height}
+    if pixels.shape[-1] != 4:
+        return crop
+    opaque = pixels[..., 3] != 0
+    rows = np.flatnonzero(opaque.any(axis=1))
+    if len(rows) == 0:
+        return crop
+    cols = np.flatnonzero(opaque.any(axis=0))
+    crop.update({'left': int(cols[0]), 'top': int(rows[0]), 'width': int(cols[-1] - cols[0] + 1), 'height': int(rows[-1] - rows[0] + 1)})
+    return crop
 
-def perpare_manifest(manifest_path):
-    data = None
-    with open(manifest_path, "r") as f:
-        data = json.load(f)
-        host = data.get("host", None)
-        if host is None:
-            return
-        if not isinstance(host, list):
-            return
-        if len(host) <= 0:
-            return
-        data["host"] = host[0]
-    with open(manifest_path, "w") as f:
-        json.dump(data, f, indent=4)
-        
+def crop_pixels(pixels, crop):
+    return pixels[crop['top']:crop['top'] + crop['height'], crop['left']:crop['left'] + crop['width']]
 
-FORCE_REINSTALL = False
-def try_install_ps_plugin(ps_plugin_path):
-    #check path exist
-    if not os.path.exists(ps_plugin_path):
-        print("SD-PPP: Photoshop plugin path not exist")
-        return
-    dst_extension_name = "sd-ppp_PS"
-    dst_extension_path = os.path.join(ps_plugin_path, dst_extension_name)
-    src_file_folder = os.path.dirname(os.path.abspath(__file__))
-    src_extension_path = os.path.abspath(os.path.join(src_file_folder, "..", "photoshop", "dist"))
-    if os.path.exists(dst_extension_path):
-        if not FORCE_REINSTALL:
-            #check version
-            src_version = get_version_from_path(src_extension_path)
-            dst_version = get_version_from_path(dst_extension_path)
-            if src_version == dst_version:
-                print("SD-PPP: Photoshop plugin already installed")
-                return
-            else:
-                print("SD-PPP: Photoshop plugin version mismatch")
-        #remove old folder
-        shutil.rmtree(dst_extension_path)
-    #fix manifest format
-    perpare_manifest(os.path.join(src_extension_path, "manifest.json"))
-    #clone directory to path
-    try:
-        shutil.copytree(src_extension_path, dst_extension_path)
-    except Exception as e:
-        print("SD-PPP: Photoshop plugin install failed")
-        print(e)
-        return
-    print("SD-PPP: Photoshop plugin installed")
+# start encoding right away and cache the pending encoded bytes, photoshop downloads them later through /finished_images
+# images are autocropped to their non transparent pixels, returns (image_ids, crops)
+def cache_images(images, owner=None, codec=None):
+    image_ids = []
+    crops = []
+    codec = codec or get_codec('png')
+    image_cache = ImageCache.instance()
+    image_encoder = ImageEncoder.instance()
+    for pixels in images_to_uint8(images):
+        crop = opaque_bounds(pixels)
+        pixels = crop_pixels(pixels, crop)
+        encoding = image_encoder.submit(pixels, codec)
+        image_id = image_cache.put(encoding, pixels.nbytes, owner, codec.content_type)
+        encoding.add_done_callback(lambda encoding, image_id=image_id: _on_image_encoded(image_cache, image_id, encoding))
+        image_ids.append(image_id)
+        crops.append(crop)
+    return image_ids, crops
 
+# rgba frames for pushing over the websocket, no png round trip and nothing kept in the cache
+# compressed with the instance's codec when it is an rgba one (raw, zlib, zstd), png instances get raw frames
+def images_to_rgba_frames(images, codec=None):
+    frames = []
+    if codec is None or not codec.rgba:
+        codec = get_codec('raw')
+    for pixels in to_rgba(images_to_uint8(images)):
+        crop = opaque_bounds(pixels)
+        pixels = crop_pixels(pixels, crop)
+        frames.append(({'width': pixels.shape[1], 'height': pixels.shape[0], 'components': 4, 'encoding': codec.name, 'crop': crop}, codec.encode(pixels)))
+    return frames
 
-if __name__ == "__main__":
-    auto_install_ps_plugin()
\ No newline at end of file
+# same output as LoadImage.load_image but straight from memory
+def decode_image(data):
+    image = Image.open(BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if image.mode == 'I':
+        image = image.point(lambda i: i * (1 / 255))
+    output_image = torch.from_numpy(np.array(image.convert("RGB")).astype(np.float32) / 255.0)[None,]
+    if 'A' in image.getbands():
+        mask = np.array(image.getchannel('A')).astype(np.float32) / 255.0
+        output_mask = 1. - torch.from_numpy(mask)
+    else:
+        output_mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+    return output_image, output_mask.unsqueeze(0)
+
+# [H, W, 4] uint8 pixels to the same (image, mask) decode_image returns for an rgba png
+def rgba_to_image_and_mask(pixels):
+    output_image = torch.from_numpy(pixels[..., :3].astype(np.float32) / 255.0)[None,]
+    output_mask = 1. - torch.from_numpy(pixels[..., 3].astype(np.float32) / 255.0)
+    return output_image, output_mask.unsqueeze(0)
+
+# upload is {'upload_key', 'upload_name', 'encoding', 'width', 'height'} from get_image, older plugins only upload png to comfy's input folder
+def load_uploaded_image(upload):
+    if upload['upload_key']:
+        data = ImageCache.uploads().pop(upload['upload_key'])
+        if data is None:
+            raise ValueError(f"Uploaded image from photoshop expired, please retry")
+        codec = get_codec(upload.get('encoding', None))
+        if not codec.rgba:
+            return decode_image(data)
+        return rgba_to_image_and_mask(codec.decode(data, upload['width'], upload['height']))
+    if upload['upload_name']:
+        from nodes import LoadImage
+        return LoadImage().load_image(upload['upload_name'])
+    raise ValueError(f"Failed getting image from photoshop, please check log")
+
+def _on_image_encoded(image_cache, image_id, encoding):
+    if encoding.cancelled() or encoding.exception() is not None:
+        return
+    image_cache.resize(image_id, len(encoding.result()))
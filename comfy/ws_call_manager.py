@@ -1,70 +1,314 @@
+import os
+import time
+import heapq
 import asyncio
 from aiohttp import WSMsgType
 import json
+from .protocol import pack_binary_frame, pack_image_bundles, unpack_binary_frame, BINARY_FRAME_IMAGE, BINARY_FRAME_MESSAGE
+from .message_codecs import get_message_codec
+from .metrics import Metrics
+from .tracing import Tracer, span, current_prompt_id
 
 class WSCallsManager:
+    # lower runs first, cheap queries shouldn't wait behind pixel transfers
+    ACTION_PRIORITIES = {
+        'get_active_history_state_id': 0,
+        'get_layers': 1,
+        'get_image': 2,
+        'send_images': 2,
+    }
+    DEFAULT_PRIORITY = 1
+    # read only calls, identical ones in flight share one result
+    SINGLE_FLIGHT_ACTIONS = ['get_active_history_state_id', 'get_layers']
+    MAX_CONCURRENT_CALLS = int(os.environ.get('SD_PPP_MAX_CONCURRENT_CALLS', 4))
+
     ws = None
-    def __init__(self, ws, message_handler=None):
+    # message_handler: called with every decoded payload, returns True when it handled it
+    # message_codec: encoding of the messages sent after the handshake, text frames are always json
+    def __init__(self, ws, message_handler=None, message_codec=None):
         self.calls = dict()
         self.call_id = 0
         self.ws = ws
         self.message_handler = message_handler
+        self.message_codec = message_codec or get_message_codec('json')
+        self.json_codec = get_message_codec('json')
         self.destroyed = False
+        # the message loop ended, nothing sent from now on would be answered
+        self.closed = False
+        # scheduler state
+        self.single_flight_calls = dict()
+        self.slot_waiters = []
+        self.slot_waiter_seq = 0
+        self.running_calls = 0
+        self.coalesced_calls = 0
+        self.timed_out_calls = 0
+        self.cancelled_calls = 0
+        self.late_results = 0
+    
+    # binaries: list of (header, payload) sent as binary frames right before the call, correlated by call_id and index
+    # bundle: send all binaries in a single frame instead of one frame each
+    async def call(self, action, params, timeout=30, binaries=None, priority=None, bundle=False):
+        if priority is None:
+            priority = self.ACTION_PRIORITIES.get(action, self.DEFAULT_PRIORITY)
+        if binaries is not None or action not in self.SINGLE_FLIGHT_ACTIONS:
+            return await self._scheduled_call(action, params, timeout, binaries, priority, bundle)
+        key = (action, json.dumps(params, sort_keys=True))
+        task = self.single_flight_calls.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(self._scheduled_call(action, params, timeout, binaries, priority, bundle))
+            self.single_flight_calls[key] = task
+            task.add_done_callback(lambda task: self._on_single_flight_done(key, task))
+        else:
+            self.coalesced_calls += 1
+            Metrics.instance().inc('sd_ppp_call_events_total', event='coalesced')
+        # one waiter giving up must not cancel the call for the others
+        return await asyncio.shield(task)
+    
+    # several calls in one frame, photoshop runs them in order and answers with all results together
+    async def call_batch(self, calls, timeout=30):
+        priority = max([self.ACTION_PRIORITIES.get(action, self.DEFAULT_PRIORITY) for (action, _) in calls] or [self.DEFAULT_PRIORITY])
+        result = await self.call('batch', {'calls': [{'action': action, 'params': params} for (action, params) in calls]}, timeout, priority=priority)
+        results = []
+        for call_result in result.get('results', []):
+            if call_result.get('error', None) is not None:
+                raise ValueError(call_result['error'])
+            results.append(call_result.get('result', None))
+        return results
+    
+    def stats(self):
+        return {
+            'pending': len(self.calls),
+            'running': self.running_calls,
+            'queued': len([waiter for (_, _, waiter) in self.slot_waiters if not waiter.done()]),
+            'coalesced': self.coalesced_calls,
+            'timed_out': self.timed_out_calls,
+            'cancelled': self.cancelled_calls,
+            'late_results': self.late_results,
+        }
     
-    async def call(self, action, params, timeout=30):
+    def handle_call(self, call_id, result=None, error=None):
+        loop, call = self._get_call_and_remove(call_id)
+        if call is None:
+            # the caller timed out or was cancelled already
+            self.late_results += 1
+            Metrics.instance().inc('sd_ppp_call_events_total', event='late_results')
+            print(f'SD-PPP: result of call {call_id} arrived after it timed out or was cancelled, dropped')
+            return
+        if (error is not None):
+            loop.call_soon_threadsafe(self._resolve_call, call, None, ValueError(error))
+        else:
+            loop.call_soon_threadsafe(self._resolve_call, call, result, None)
+    
+    def _resolve_call(self, call, result, exception):
+        if call.done():
+            return
+        if exception is not None:
+            call.set_exception(exception)
+        else:
+            call.set_result(result)
+    
+    def _get_call_and_remove(self, call_id):
+        return self.calls.pop(call_id, (None, None))
+    
+    async def _scheduled_call(self, action, params, timeout, binaries, priority, bundle=False):
+        started_at = time.perf_counter()
+        outcome = 'error'
+        try:
+            with span('wait call slot', action=action, priority=priority):
+                await self._acquire_slot(priority)
+            try:
+                with span(f'call {action}', action=action, binaries=len(binaries or [])):
+                    result = await self._send_call(action, params, timeout, binaries, bundle)
+                outcome = 'ok'
+                return result
+            finally:
+                self._release_slot()
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except ConnectionError:
+            outcome = 'disconnected'
+            raise
+        finally:
+            Metrics.instance().observe_call(action, outcome, time.perf_counter() - started_at)
+    
+    async def _send_call(self, action, params, timeout, binaries, bundle=False):
         self.call_id += 1
+        call_id = self.call_id
+        prompt_id = current_prompt_id.get()
+        if prompt_id is not None and Tracer.instance().enabled:
+            # photoshop reports its phases in the result
+            params = self._with_trace(action, params)
         payload = {
-            'call_id': self.call_id,
+            'call_id': call_id,
             'action': action,
             'params': params
         }
         loop = asyncio.get_event_loop()
         call = loop.create_future()
-        self.calls[self.call_id] = (loop, call)
-        
-        await self.ws.send_str(json.dumps(payload))
-        await asyncio.wait_for(call, timeout)
-        return call.result()
+        self.calls[call_id] = (loop, call)
+        try:
+            if bundle and binaries:
+                for frame in pack_image_bundles({'call_id': call_id}, binaries):
+                    await self._send_bytes(frame)
+            else:
+                for (index, (header, data)) in enumerate(binaries or []):
+                    frame_header = dict(header, call_id=call_id, index=index)
+                    await self._send_bytes(pack_binary_frame(BINARY_FRAME_IMAGE, frame_header, data))
+            sent_at = time.perf_counter()
+            await self._send_message(payload)
+            result = await asyncio.wait_for(call, timeout)
+            if prompt_id is not None:
+                self._trace_photoshop_timings(prompt_id, action, sent_at, result)
+            return result
+        except asyncio.TimeoutError:
+            self.timed_out_calls += 1
+            Metrics.instance().inc('sd_ppp_call_events_total', event='timed_out')
+            print(f'SD-PPP: call {action}({call_id}) timed out after {timeout}s')
+            raise
+        except asyncio.CancelledError:
+            self.cancelled_calls += 1
+            Metrics.instance().inc('sd_ppp_call_events_total', event='cancelled')
+            print(f'SD-PPP: call {action}({call_id}) cancelled')
+            raise
+        finally:
+            # never leave the future behind, whatever happened
+            self.calls.pop(call_id, None)
     
-    def handle_call(self, call_id, result=None, error=None):
-        loop, call = self._get_call_and_remove(call_id)
-        if (call.cancelled()):
+    def _with_trace(self, action, params):
+        if action == 'batch':
+            return dict(params, trace=True, calls=[dict(call, params=dict(call['params'], trace=True)) for call in params['calls']])
+        return dict(params, trace=True)
+
+    def _trace_photoshop_timings(self, prompt_id, action, sent_at, result):
+        if not isinstance(result, dict):
             return
-        if (error is not None):
-            loop.call_soon_threadsafe(call.set_exception, ValueError(error))
+        tracer = Tracer.instance()
+        if action == 'batch':
+            for call_result in result.get('results', []):
+                tracer.add_photoshop_timings(prompt_id, action, sent_at, (call_result.get('result', None) or {}).get('timings', []))
+            return
+        tracer.add_photoshop_timings(prompt_id, action, sent_at, result.get('timings', []))
+
+    async def _send_message(self, payload):
+        if self.message_codec.binary:
+            await self._send_bytes(pack_binary_frame(BINARY_FRAME_MESSAGE, {}, self.message_codec.dumps(payload)))
         else:
-            loop.call_soon_threadsafe(call.set_result, result)
+            await self._send_str(self.message_codec.dumps(payload))
+
+    async def _send_bytes(self, data):
+        self._count_transfer('out', len(data))
+        await self.ws.send_bytes(data)
+
+    async def _send_str(self, data):
+        self._count_transfer('out', len(data))
+        await self.ws.send_str(data)
+
+    def _count_transfer(self, direction, nbytes):
+        metrics = Metrics.instance()
+        metrics.inc('sd_ppp_ws_messages_total', direction=direction)
+        metrics.inc('sd_ppp_transfer_bytes_total', nbytes, direction=direction, channel='websocket')
+
+    # at most MAX_CONCURRENT_CALLS calls are sent to photoshop at once, waiters are served by priority then arrival
+    async def _acquire_slot(self, priority):
+        if self.closed:
+            raise ConnectionError('photoshop disconnected')
+        if self.running_calls < self.MAX_CONCURRENT_CALLS and len(self.slot_waiters) == 0:
+            self.running_calls += 1
+            return
+        self.slot_waiter_seq += 1
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.slot_waiters, (priority, self.slot_waiter_seq, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # the slot was handed over right before the cancellation, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            raise
     
-    def _get_call_and_remove(self, call_id):
-        (loop, call) = self.calls.get(call_id, None)
-        if call is not None:
-            self.calls.pop(call_id)
-        else:
-            raise ValueError(f'call {call_id} not found')
-        return loop, call
+    def _release_slot(self):
+        while len(self.slot_waiters) > 0:
+            (_, _, waiter) = heapq.heappop(self.slot_waiters)
+            if not waiter.done():
+                # the slot goes to the waiter directly, running_calls stays the same
+                waiter.set_result(None)
+                return
+        self.running_calls -= 1
+    
+    def _on_single_flight_done(self, key, task):
+        if self.single_flight_calls.get(key, None) is task:
+            self.single_flight_calls.pop(key, None)
+        # mark the exception as retrieved in case every waiter gave up
+        if not task.cancelled():
+            task.exception()
+    
+    def _fail_pending_calls(self):
+        self.closed = True
+        for call_id in list(self.calls.keys()):
+            loop, call = self._get_call_and_remove(call_id)
+            if call is not None and not call.done():
+                call.set_exception(ConnectionError('photoshop disconnected'))
+        # calls still waiting for a slot would never be sent
+        slot_waiters = self.slot_waiters
+        self.slot_waiters = []
+        for (_, _, waiter) in slot_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionError('photoshop disconnected'))
     
     async def message_loop(self):
+        try:
+            await self._message_loop()
+        finally:
+            self._fail_pending_calls()
+    
+    async def _message_loop(self):
         async for msg in self.ws:
             if self.destroyed: break
-            if self.message_handler is not None and await self.message_handler(msg):
-                continue
-            if msg.type == WSMsgType.TEXT:
-                payload = json.loads(msg.data)
+            if msg.type == WSMsgType.TEXT or msg.type == WSMsgType.BINARY:
+                self._count_transfer('in', len(msg.data))
+            # every frame is decoded once here, whatever the codec, and dispatched by what it carries
+            if msg.type == WSMsgType.TEXT or (msg.type == WSMsgType.BINARY and len(msg.data) > 0 and msg.data[0] == BINARY_FRAME_MESSAGE):
+                try:
+                    payload = self._decode_message(msg)
+                except Exception as e:
+                    # a broken message doesn't take the connection down, photoshop is told like for a payload without call_id
+                    error = f'invalid message: {type(e).__name__} {e}'
+                    print('SD-PPP:', error)
+                    await self._send_message({'error': error})
+                    continue
+                if self.message_handler is not None and await self.message_handler(payload):
+                    continue
                 if 'call_id' in payload:
                     call_id = payload['call_id']
                     if 'error' not in payload and 'result' not in payload:
-                        await self.ws.send_str(json.dumps({ call_id: call_id, 'error': 'result not found in payload'}))
+                        await self._send_message({'call_id': call_id, 'error': 'result not found in payload'})
                     else:
                         self.handle_call(call_id, result=payload.get("result", None), error=payload.get("error", None))
                 else:
                     if 'error' in payload:
                         print('Remote error', payload['error'])
-                    await self.ws.send_str(json.dumps({ 'error': 'call_id not found in payload'}))
+                    await self._send_message({'error': 'call_id not found in payload'})
             elif msg.type == WSMsgType.ERROR:
                 print('ws connection closed with exception %s' % self.ws.exception())
             else:
                 await self.ws.send_str('invalid msg type')
 
+    def _decode_message(self, msg):
+        if msg.type == WSMsgType.TEXT:
+            payload = self.json_codec.loads(msg.data)
+        elif self.message_codec.binary:
+            _, _, data = unpack_binary_frame(msg.data)
+            payload = self.message_codec.loads(data)
+        else:
+            raise ValueError(f"binary message while {self.message_codec.name} was negotiated")
+        if not isinstance(payload, dict):
+            raise ValueError(f"message is {type(payload).__name__}, not a map")
+        return payload
+
     async def destroy(self):
         self.destroyed = True
         await self.ws.close()
@@ -191,125 +191,263 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony import */ var _events_send_images__WEBPACK_IMPORTED_MODULE_2__ = __webpack_require__(/*! ./events/send_images */ "./src/system/events/send_images.js");
 /* harmony import */ var _events_get_image__WEBPACK_IMPORTED_MODULE_3__ = __webpack_require__(/*! ./events/get_image */ "./src/system/events/get_image.js");
 /* harmony import */ var _events_get_active_history_state_id__WEBPACK_IMPORTED_MODULE_4__ = __webpack_require__(/*! ./events/get_active_history_state_id */ "./src/system/events/get_active_history_state_id.js");
+/* harmony import */ var _codecs__WEBPACK_IMPORTED_MODULE_5__ = __webpack_require__(/*! ./codecs */ "./src/system/codecs.js");
+/* harmony import */ var _msgpack__WEBPACK_IMPORTED_MODULE_6__ = __webpack_require__(/*! ./msgpack */ "./src/system/msgpack.js");
 
 
 
 
 
+
+
+
+const PROTOCOL_VERSION = 2;
+const PROTOCOL_FEATURES = ['binary_push', 'batch', 'layer_delta', 'bulk_images', 'tile_delta', 'resume'];
+const BINARY_FRAME_IMAGE = 1;
+const BINARY_FRAME_IMAGE_BUNDLE = 2;
+const BINARY_FRAME_MESSAGE = 3;
+
 class ComfyConnection {
-  static instance = null;
-  static _connectStateCallbacks = [];
-  static onConnectStateChange(callback) {
-    ComfyConnection._connectStateCallbacks.push(callback);
-  }
-  static _callConnectStateChange() {
-    ComfyConnection._connectStateCallbacks.forEach(cb => {
-      try {
-        cb(ComfyConnection.instance?.isConnected);
-      } catch (e) {
-        console.error(e);
-      }
-    });
-  }
-  static createInstance(comfyURL, userId) {
-    if (ComfyConnection.instance && ComfyConnection.instance.isConnected) {
-      ComfyConnection.instance.disconnect();
+    static instance = null;
+
+    static _connectStateCallbacks = [];
+    static onConnectStateChange(callback) {
+        ComfyConnection._connectStateCallbacks.push(callback);
     }
-    ComfyConnection.instance = new ComfyConnection(comfyURL, userId);
-  }
-  get isConnected() {
-    return this._isConnected === true;
-  }
-  comfyURL = '';
-  constructor(comfyURL, userId) {
-    ComfyConnection.instance = this;
-    if (!comfyURL) {
-      comfyURL = 'http://127.0.0.1:8188';
+    static _callConnectStateChange() {
+        ComfyConnection._connectStateCallbacks.forEach(cb => {
+            try {
+                cb(ComfyConnection.instance?.isConnected);
+            } catch (e) { console.error(e); }
+        });
     }
-    this.comfyURL = comfyURL.replace(/\/*$/, '');
-    if (!userId) {
-      userId = '';
+
+    static createInstance(comfyURL, userId) {
+        if (ComfyConnection.instance && ComfyConnection.instance.isConnected) {
+            ComfyConnection.instance.disconnect();
+        }
+        ComfyConnection.instance = new ComfyConnection(comfyURL, userId);
+    }
+
+    get isConnected() {
+        return this._isConnected === true;
+    }
+
+    comfyURL = '';
+    // features accepted by the server in the handshake
+    features = new Set();
+    // image encoding picked by the server in the handshake
+    codec = 'png';
+    // encoding of the messages after the handshake, json text frames or msgpack binary frames
+    messageCodec = 'json';
+    // binary frames received before their call, keyed by call_id then index
+    binaryFrames = {};
+    // token from the handshake, reconnecting with it lets the server reuse what it knows about this photoshop
+    session = '';
+    // set by disconnect, no reconnect after that
+    closed = false;
+    constructor(comfyURL, userId) {
+        ComfyConnection.instance = this;
+        if (!comfyURL) {
+            comfyURL = 'http://127.0.0.1:8188';
+        }
+        this.comfyURL = comfyURL.replace(/\/*$/, '');
+        if (!userId) {
+            userId = '';
+        }
+        this.userId = userId;
+        this.connect();
     }
-    this.userId = userId;
-    this.connect();
-  }
-  pushData(data) {
-    if (!this.socket || this.socket.readyState != WebSocket.OPEN) {
-      console.error('Connection not open');
-      return;
+
+    pushData(data) {
+        if (!this.socket || this.socket.readyState != WebSocket.OPEN) {
+            console.error('Connection not open');
+            return;
+        }
+        try {
+            this.sendMessage({
+                push_data: data,
+            });
+        } catch (e) { console.error(e); }
     }
-    try {
-      this.socket.send(JSON.stringify({
-        push_data: data
-      }));
-    } catch (e) {
-      console.error(e);
-    }
-  }
-  reconnectTimer = null;
-  connect() {
-    if (this.reconnectTimer) {
-      clearTimeout(this.reconnectTimer);
-      this.reconnectTimer = null;
-    }
-    // Create WebSocket connection.
-    const socket = this.socket = new WebSocket(this.comfyURL.replace('http://', 'ws://') + '/photoshop_instance?version=1&user_id=' + this.userId);
-    socket.addEventListener("open", ev => {
-      uxp__WEBPACK_IMPORTED_MODULE_0__.storage.secureStorage.setItem('comfyURL', this.comfyURL);
-      console.log('Connection open');
-      this._isConnected = true;
-      ComfyConnection._callConnectStateChange();
-    });
-    socket.addEventListener("message", this.onMessage.bind(this));
-    socket.addEventListener("close", event => {
-      console.log("Connection close", event.reason);
-      this._isConnected = false;
-      ComfyConnection._callConnectStateChange();
-    });
-    socket.addEventListener('error', event => {
-      console.log("Connection error", event);
-      this.reconnectTimer = setTimeout(() => {
-        console.log(`Reconnecting to ${this.comfyURL.replace('http://', 'ws://').replace(/\/*$/, '')}`);
-        this.connect();
-      }, 3000);
-    });
-  }
-  disconnect() {
-    if (this.socket) {
-      this.socket.close();
+    reconnectTimer = null;
+
+    scheduleReconnect() {
+        if (this.closed || this.reconnectTimer) return;
+        this.reconnectTimer = setTimeout(() => {
+            console.log(`Reconnecting to ${this.comfyURL.replace('http://', 'ws://').replace(/\/*$/, '')}`);
+            this.connect();
+        }, 3000);
     }
-  }
-  async onMessage(event) {
-    console.log("Message from comfy ", event.data);
-    let payload;
-    try {
-      let result = {};
-      payload = JSON.parse(event.data);
-      if (payload.error) {
-        throw new Error(payload.error);
-      } else if (payload.action == 'get_layers') {
-        result = await _events_get_layers__WEBPACK_IMPORTED_MODULE_1__["default"].call(this, payload);
-      } else if (payload.action == 'send_images') {
-        result = await _events_send_images__WEBPACK_IMPORTED_MODULE_2__["default"].call(this, payload);
-      } else if (payload.action == 'get_image') {
-        result = await _events_get_image__WEBPACK_IMPORTED_MODULE_3__["default"].call(this, payload);
-      } else if (payload.action == 'get_active_history_state_id') {
-        result = await _events_get_active_history_state_id__WEBPACK_IMPORTED_MODULE_4__["default"].call(this, payload);
-      }
-      this.socket.send(JSON.stringify({
-        call_id: payload.call_id,
-        result: result
-      }));
-    } catch (e) {
-      console.error("onMessage", e);
-      if (payload && payload.call_id) {
-        this.socket.send(JSON.stringify({
-          call_id: payload.call_id,
-          error: e.message
-        }));
-      }
+
+    supports(feature) {
+        return this.features.has(feature);
+    }
+
+    sendMessage(payload) {
+        if (this.messageCodec != 'msgpack') {
+            this.socket.send(JSON.stringify(payload));
+            return;
+        }
+        // same layout as the image frames, with an empty header
+        const header = '{}';
+        const body = (0,_msgpack__WEBPACK_IMPORTED_MODULE_6__.encodeMessage)(payload);
+        const frame = new Uint8Array(5 + header.length + body.length);
+        const view = new DataView(frame.buffer);
+        view.setUint8(0, BINARY_FRAME_MESSAGE);
+        view.setUint32(1, header.length);
+        for (let index = 0; index < header.length; index++) frame[5 + index] = header.charCodeAt(index);
+        frame.set(body, 5 + header.length);
+        this.socket.send(frame.buffer);
+    }
+
+    decodeMessageFrame(data) {
+        const headerLength = new DataView(data).getUint32(1);
+        return (0,_msgpack__WEBPACK_IMPORTED_MODULE_6__.decodeMessage)(new Uint8Array(data, 5 + headerLength));
+    }
+
+    takeBinaryFrames(callId) {
+        const frames = this.binaryFrames[callId] || [];
+        delete this.binaryFrames[callId];
+        return frames;
+    }
+
+    onBinaryMessage(data) {
+        const view = new DataView(data);
+        const kind = view.getUint8(0);
+        const headerLength = view.getUint32(1);
+        const headerStart = 5;
+        // header is plain ascii json
+        const header = JSON.parse(String.fromCharCode.apply(null, new Uint8Array(data, headerStart, headerLength)));
+        const payload = new Uint8Array(data, headerStart + headerLength);
+        const frames = this.binaryFrames[header.call_id] = this.binaryFrames[header.call_id] || [];
+        if (kind == BINARY_FRAME_IMAGE) {
+            frames[header.index] = { header, data: payload };
+        } else if (kind == BINARY_FRAME_IMAGE_BUNDLE) {
+            // views into the bundle, no copy, big batches come in several bundles
+            const first = header.first || 0;
+            header.frames.forEach((frameHeader, index) => {
+                frames[first + index] = { header: frameHeader, data: payload.subarray(frameHeader.offset, frameHeader.offset + frameHeader.length) };
+            });
+        } else {
+            console.error('Unknown binary frame kind', kind);
+        }
+    }
+
+    connect() {
+        if (this.reconnectTimer) {
+            clearTimeout(this.reconnectTimer);
+            this.reconnectTimer = null;
+        }
+        // Create WebSocket connection.
+        const socket = this.socket = new WebSocket(this.comfyURL.replace('http://', 'ws://') + '/photoshop_instance?version=' + PROTOCOL_VERSION + '&features=' + PROTOCOL_FEATURES.join(',') + '&codecs=' + _codecs__WEBPACK_IMPORTED_MODULE_5__.SUPPORTED_CODECS.join(',') + '&message_codecs=' + _msgpack__WEBPACK_IMPORTED_MODULE_6__.SUPPORTED_MESSAGE_CODECS.join(',') + '&user_id=' + this.userId + (this.session ? '&session=' + encodeURIComponent(this.session) : ''));
+        socket.binaryType = 'arraybuffer';
+        this.features = new Set();
+        this.codec = 'png';
+        this.messageCodec = 'json';
+        this.binaryFrames = {};
+
+        socket.addEventListener("open", (ev) => {
+            uxp__WEBPACK_IMPORTED_MODULE_0__.storage.secureStorage.setItem('comfyURL', this.comfyURL);
+            console.log('Connection open');
+            this._isConnected = true;
+            ComfyConnection._callConnectStateChange();
+        });
+
+        socket.addEventListener("message", this.onMessage.bind(this));
+
+        socket.addEventListener("close", (event) => {
+            console.log("Connection close", event.reason);
+            this._isConnected = false;
+            ComfyConnection._callConnectStateChange();
+            // the server drops peers that miss heartbeats, come back with the session
+            if (this.socket === socket) this.scheduleReconnect();
+        });
+
+        socket.addEventListener('error', (event) => {
+            console.log("Connection error", event);
+            if (this.socket === socket) this.scheduleReconnect();
+        });
+    }
+
+    disconnect() {
+        this.closed = true;
+        if (this.reconnectTimer) {
+            clearTimeout(this.reconnectTimer);
+            this.reconnectTimer = null;
+        }
+        if (this.socket) {
+            this.socket.close();
+        }
+    }
+
+    async runAction(payload) {
+        if (payload.action == 'get_layers') {
+            return await _events_get_layers__WEBPACK_IMPORTED_MODULE_1__["default"].call(this, payload);
+        } else if (payload.action == 'send_images') {
+            return await _events_send_images__WEBPACK_IMPORTED_MODULE_2__["default"].call(this, payload);
+        } else if (payload.action == 'get_image') {
+            return await _events_get_image__WEBPACK_IMPORTED_MODULE_3__["default"].call(this, payload);
+        } else if (payload.action == 'get_active_history_state_id') {
+            return await _events_get_active_history_state_id__WEBPACK_IMPORTED_MODULE_4__["default"].call(this, payload);
+        }
+        return {};
+    }
+
+    // run calls in order, one failing call doesn't stop the rest
+    async runBatch(payload) {
+        const results = [];
+        for (const call of payload.params.calls) {
+            try {
+                results.push({ result: await this.runAction({ call_id: payload.call_id, action: call.action, params: call.params, received_at: payload.received_at }) });
+            } catch (e) {
+                console.error("runBatch", call.action, e);
+                results.push({ error: e.message });
+            }
+        }
+        return { results };
+    }
+
+    async onMessage(event) {
+        const isBinary = event.data instanceof ArrayBuffer;
+        if (isBinary && new DataView(event.data).getUint8(0) != BINARY_FRAME_MESSAGE) {
+            this.onBinaryMessage(event.data);
+            return;
+        }
+        if (!isBinary) console.log("Message from comfy ", event.data);
+        let payload;
+        try {
+            let result = {};
+            // decoded once, whatever the encoding
+            payload = isBinary ? this.decodeMessageFrame(event.data) : JSON.parse(event.data);
+            payload.received_at = Date.now();
+            if (payload.handshake) {
+                this.features = new Set(payload.handshake.features || []);
+                this.codec = payload.handshake.codec || 'png';
+                this.session = payload.handshake.session || '';
+                this.messageCodec = payload.handshake.message_codec || 'json';
+                return;
+            } else if (payload.error){
+                throw new Error(payload.error);
+            } else if (payload.action == 'batch') {
+                result = await this.runBatch(payload);
+            } else {
+                result = await this.runAction(payload);
+            }
+            this.sendMessage({
+                call_id: payload.call_id,
+                result: result
+            });
+        } catch (e) {
+            console.error("onMessage", e);
+            if (payload && payload.call_id){
+                this.sendMessage({
+                    call_id: payload.call_id,
+                    error: e.message
+                });
+            }
+        }
     }
-  }
 }
 
 /***/ }),
@@ -330,54 +468,105 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony import */ var _util__WEBPACK_IMPORTED_MODULE_1__ = __webpack_require__(/*! ./util */ "./src/system/util.js");
 
 
+
 class HistoryChecker {
-  static instance = null;
-  static createInstance() {
-    if (HistoryChecker.instance) {
-      return HistoryChecker.instance;
-    }
-    return new HistoryChecker();
-  }
-  constructor() {
-    HistoryChecker.instance = this;
-    this.lastCheckId = {};
-    this.changeCallback = null;
-    photoshop__WEBPACK_IMPORTED_MODULE_0__.action.addNotificationListener(["historyStateChanged"], () => {
-      this.checkHistoryState();
-    });
-  }
-  destroy() {
-    clearInterval(this.timer);
-    this.timer = null;
-    this.changeCallback = null;
-    HistoryChecker.instance = null;
-  }
-  setChangeCallback(callback) {
-    this.changeCallback = callback;
-  }
-  checkHistoryState() {
-    console.log('checkHistoryState', photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents?.length);
-    let changedDocIdToHistoryId = {};
-    photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents?.forEach(doc => {
-      const historyState = (0,_util__WEBPACK_IMPORTED_MODULE_1__.getLastHistoryState)(doc);
-      console.log('checkHistoryState historyState:', historyState?.id, 'doc.id:', historyState?.docId);
-      if (!historyState) return;
-      const oldHistoryStateId = this.lastCheckId[doc.id];
-      console.log('checkHistoryState oldHistoryStateId:', oldHistoryStateId);
-      if (oldHistoryStateId == historyState.id) return;
-      changedDocIdToHistoryId[doc.id] = historyState.id;
-      this.lastCheckId[doc.id] = historyState.id;
-    });
-    console.log('checkHistoryState changedDocIdToHistoryId:', changedDocIdToHistoryId);
-    if (Object.keys(changedDocIdToHistoryId).length == 0) return;
-    console.log('changedDocIdToHistoryId:', changedDocIdToHistoryId);
-    if (this.changeCallback) this.changeCallback(changedDocIdToHistoryId);
-  }
+    static instance = null;
+    static createInstance() {
+        if (HistoryChecker.instance) {
+            return HistoryChecker.instance;
+        }
+        return new HistoryChecker();
+    }
+    constructor() {
+        HistoryChecker.instance = this;
+        this.lastCheckId = {};
+        this.changeCallback = null;
+        // opening or closing a document changes the document list the comfyui tabs show
+        photoshop__WEBPACK_IMPORTED_MODULE_0__.action.addNotificationListener(["historyStateChanged", "open", "close", "newDocument"], () => {
+            this.checkHistoryState();
+        });
+    }
+
+    destroy() {
+        clearInterval(this.timer);
+        this.timer = null;
+        this.changeCallback = null;
+        HistoryChecker.instance = null;
+    }
+
+    setChangeCallback(callback) {
+        this.changeCallback = callback;
+    }
+
+    checkHistoryState() {
+        console.log('checkHistoryState', photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents?.length)
+        let changedDocIdToHistoryId = {};
+        const openDocIds = new Set((photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents || []).map(doc => String(doc.id)));
+        Object.keys(this.lastCheckId).forEach(docId => {
+            if (openDocIds.has(docId)) return;
+            // closed, null tells the server there's no pushed state for it anymore
+            changedDocIdToHistoryId[docId] = null;
+            delete this.lastCheckId[docId];
+        });
+        photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents?.forEach(doc => {
+            const historyState = (0,_util__WEBPACK_IMPORTED_MODULE_1__.getLastHistoryState)(doc);
+            console.log('checkHistoryState historyState:', historyState?.id, 'doc.id:', historyState?.docId)
+            if (!historyState) return;
+            const oldHistoryStateId = this.lastCheckId[doc.id];
+            console.log('checkHistoryState oldHistoryStateId:', oldHistoryStateId)
+            if (oldHistoryStateId == historyState.id) return;
+            changedDocIdToHistoryId[doc.id] = historyState.id;
+            this.lastCheckId[doc.id] = historyState.id;
+        });
+        console.log('checkHistoryState changedDocIdToHistoryId:', changedDocIdToHistoryId)
+        if (Object.keys(changedDocIdToHistoryId).length == 0) return;
+        console.log('changedDocIdToHistoryId:', changedDocIdToHistoryId)
+        if (this.changeCallback) 
+            this.changeCallback(changedDocIdToHistoryId);
+    }
 }
+
 /* harmony default export */ const __WEBPACK_DEFAULT_EXPORT__ = (HistoryChecker);
 
 /***/ }),
 
+/***/ "./src/system/codecs.js":
+/*!******************************!*\
+  !*** ./src/system/codecs.js ***!
+  \******************************/
+/***/ ((__unused_webpack_module, __webpack_exports__, __webpack_require__) => {
+
+"use strict";
+__webpack_require__.r(__webpack_exports__);
+/* harmony export */ __webpack_require__.d(__webpack_exports__, {
+/* harmony export */   SUPPORTED_CODECS: () => (/* binding */ SUPPORTED_CODECS),
+/* harmony export */   compressRGBA: () => (/* binding */ compressRGBA),
+/* harmony export */   decompressRGBA: () => (/* binding */ decompressRGBA),
+/* harmony export */   isRGBACodec: () => (/* binding */ isRGBACodec)
+/* harmony export */ });
+/* harmony import */ var _zlib__WEBPACK_IMPORTED_MODULE_0__ = __webpack_require__(/*! ./zlib */ "./src/system/zlib.js");
+
+
+// image encodings this plugin understands, the server picks one per connection in the handshake
+const SUPPORTED_CODECS = ['zlib', 'raw', 'png'];
+
+// raw and zlib carry bare rgba rows and their size travels next to them, png goes through jimp
+function isRGBACodec(encoding) {
+    return encoding == 'raw' || encoding == 'zlib';
+}
+
+function compressRGBA(data, encoding) {
+    if (encoding == 'zlib') return (0,_zlib__WEBPACK_IMPORTED_MODULE_0__.deflate)(data);
+    return data;
+}
+
+function decompressRGBA(data, encoding) {
+    if (encoding == 'zlib') return (0,_zlib__WEBPACK_IMPORTED_MODULE_0__.inflate)(data);
+    return data;
+}
+
+/***/ }),
+
 /***/ "./src/system/events/get_active_history_state_id.js":
 /*!**********************************************************!*\
   !*** ./src/system/events/get_active_history_state_id.js ***!
@@ -427,204 +616,334 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony export */ });
 /* harmony import */ var photoshop__WEBPACK_IMPORTED_MODULE_0__ = __webpack_require__(/*! photoshop */ "photoshop");
 /* harmony import */ var photoshop__WEBPACK_IMPORTED_MODULE_0___default = /*#__PURE__*/__webpack_require__.n(photoshop__WEBPACK_IMPORTED_MODULE_0__);
-/* harmony import */ var _util_js__WEBPACK_IMPORTED_MODULE_1__ = __webpack_require__(/*! ../util */ "./src/system/util.js");
+/* harmony import */ var _util_js__WEBPACK_IMPORTED_MODULE_1__ = __webpack_require__(/*! ../util.js */ "./src/system/util.js");
 /* harmony import */ var _library_jimp_min__WEBPACK_IMPORTED_MODULE_2__ = __webpack_require__(/*! ../library/jimp.min */ "./src/system/library/jimp.min.js");
 /* harmony import */ var _library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default = /*#__PURE__*/__webpack_require__.n(_library_jimp_min__WEBPACK_IMPORTED_MODULE_2__);
+/* harmony import */ var _codecs__WEBPACK_IMPORTED_MODULE_3__ = __webpack_require__(/*! ../codecs */ "./src/system/codecs.js");
 
 
 
 
-function isLayerFolder(layer) {
-  return layer.layers && layer.layers.length > 0;
+
+
+function isLayerFolder(layer){
+    return layer.layers && layer.layers.length > 0;
 }
-async function findLayer(layerID) {
-  let layer;
-  let isFolder = false;
-  if (layerID <= 0) return [layer, isFolder];
-  layer = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findInAllSubLayer)(this.targetDocument, layerID);
-  if (!layer) throw new Error(`Layer(id: ${layerID}) not found`);
-  if (!isLayerFolder(layer)) return [layer, isFolder];
-  // layer is folder
-  const dupLayer = await layer.duplicate();
-  const mergedLayer = await dupLayer.merge();
-  isFolder = true;
-  return [mergedLayer, isFolder];
+
+async function findLayer(targetDocument, layerID) {
+    let layer;
+    let isFolder = false;
+    if (layerID <= 0) return [layer, isFolder];
+    layer = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findInAllSubLayer)(targetDocument, layerID)
+    if (!layer) throw new Error(`Layer(id: ${layerID}) not found`);
+    if (!isLayerFolder(layer)) return [layer, isFolder];
+    // layer is folder
+    const dupLayer = await layer.duplicate();
+    const mergedLayer = await dupLayer.merge()
+    isFolder = true;
+    return [mergedLayer, isFolder];
 }
 
 // ps returns trimmed data so need padding
-function padAndTrimLayerDataToDesireBounds(layer, pixelDataFromAPI, desireBounds) {
-  if (pixelDataFromAPI.length == desireBounds.width * desireBounds.height * 4) {
-    return pixelDataFromAPI;
-  }
-  let pixelDataForReturn = new Uint8Array(desireBounds.width * desireBounds.height * 4);
-  let bounds = {
-    left: 0,
-    top: 0,
-    right: this.targetDocument.width,
-    bottom: this.targetDocument.height
-  };
-  if (layer) bounds = layer.bounds;
-  (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.unTrimImageData)(pixelDataFromAPI, pixelDataForReturn, bounds, desireBounds);
-  return pixelDataForReturn;
-}
-async function getPixelsDataHelper(layer, desireBounds) {
-  let options = {
-    documentID: this.targetDocument.id,
-    applyAlpha: false,
-    sourceBounds: desireBounds
-  };
-  if (layer) options.layerID = layer.id;
-  let pixels;
-  try {
-    pixels = await photoshop__WEBPACK_IMPORTED_MODULE_0__.imaging.getPixels(options);
-  } catch (e) {
-    console.error(e.message);
-    return new Uint8Array(desireBounds.width * desireBounds.height * 4);
-  }
-  let psImageData = pixels.imageData;
-  const pixelDataFromAPI = await psImageData.getData();
-  Promise.resolve().then(() => {
-    psImageData.dispose();
-  });
-  return pixelDataFromAPI;
-}
-async function getPixelsData(layer, desireBounds) {
-  // layer null = document data
-  if (!layer) {
-    return await getPixelsDataHelper.call(this, null, desireBounds);
-  }
-  // normal layer
-  return await getPixelsDataHelper.call(this, layer, desireBounds);
-}
-function getDesiredBounds(boundsLayerID) {
-  const docBounds = {
-    left: 0,
-    top: 0,
-    right: this.targetDocument.width,
-    bottom: this.targetDocument.height,
-    width: this.targetDocument.width,
-    height: this.targetDocument.height
-  };
-  // use selection bounds
-  if (boundsLayerID == _util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_NAME_TO_ID[_util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_USE_SELECTION]) {
-    // if no selection use document bounds
-    const selectionBounds = this.targetDocument.selection?.bounds;
-    if (!selectionBounds) return docBounds;
-    return {
-      left: selectionBounds.left,
-      top: selectionBounds.top,
-      right: selectionBounds.right,
-      bottom: selectionBounds.bottom,
-      width: selectionBounds.width,
-      height: selectionBounds.height
+function padAndTrimLayerDataToDesireBounds(targetDocument, layer, pixelDataFromAPI, desireBounds) {
+    if (pixelDataFromAPI.length == desireBounds.width * desireBounds.height * 4) {
+        return pixelDataFromAPI;
+    }
+    let pixelDataForReturn = new Uint8Array(desireBounds.width * desireBounds.height * 4);
+    let bounds = {
+        left: 0,
+        top: 0,
+        right: targetDocument.width,
+        bottom: targetDocument.height,
+    }
+    if (layer) bounds = layer.bounds;
+    (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.unTrimImageData)(
+        pixelDataFromAPI,
+        pixelDataForReturn, 
+        bounds,
+        desireBounds
+    )
+    return pixelDataForReturn;
+}
+
+async function getPixelsDataHelper(targetDocument, layer, desireBounds) {
+    let options = {
+        documentID: targetDocument.id,
+        applyAlpha: false,
+        sourceBounds: desireBounds,
+    }
+    if (layer) options.layerID = layer.id
+    let pixels;
+    try {
+        pixels = await photoshop__WEBPACK_IMPORTED_MODULE_0__.imaging.getPixels(options)
+    } catch (e) {
+        console.error(e.message)
+        return new Uint8Array(desireBounds.width * desireBounds.height * 4);
+    }
+    let psImageData = pixels.imageData
+    const pixelDataFromAPI = await psImageData.getData()
+    Promise.resolve().then(() => { psImageData.dispose() })
+    return pixelDataFromAPI
+}
+
+async function getPixelsData(targetDocument, layer, desireBounds) {
+    // layer null = document data
+    if (!layer) {
+        return await getPixelsDataHelper(targetDocument, null, desireBounds);
+    }
+    // normal layer
+    return await getPixelsDataHelper(targetDocument, layer, desireBounds);
+}
+
+
+function getDesiredBounds(targetDocument, boundsLayerID) {
+    const docBounds = {
+        left: 0, 
+        top: 0, 
+        right: targetDocument.width, 
+        bottom: targetDocument.height,
+        width: targetDocument.width,
+        height: targetDocument.height
     };
-  }
-  let boundsLayer;
-  if (boundsLayerID > 0) {
-    boundsLayer = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findInAllSubLayer)(this.targetDocument, boundsLayerID);
-    if (!boundsLayer) throw new Error(`Bounds layer(id: ${boundsLayerID}) not found`);
-  }
-  // null boundsLayer = document bounds
-  if (!boundsLayer) return docBounds;
-  // empty boundsLayer = document bounds
-  const boundsLayerBounds = boundsLayer.bounds;
-  const isEmptyBoundsLayer = boundsLayerBounds.left == 0 && boundsLayerBounds.top == 0 && boundsLayerBounds.right == 0 && boundsLayerBounds.bottom == 0;
-  if (isEmptyBoundsLayer) return docBounds;
-  // normal layer
-  let desireBounds = {
-    left: boundsLayerBounds.left,
-    top: boundsLayerBounds.top,
-    right: boundsLayerBounds.right,
-    bottom: boundsLayerBounds.bottom,
-    width: boundsLayerBounds.width,
-    height: boundsLayerBounds.height
-  };
-  return desireBounds;
+    // use selection bounds
+    if (boundsLayerID == _util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_NAME_TO_ID[_util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_USE_SELECTION]) {
+        // if no selection use document bounds
+        const selectionBounds = targetDocument.selection?.bounds;
+        if (!selectionBounds) return docBounds;
+        return {
+            left: selectionBounds.left,
+            top: selectionBounds.top,
+            right: selectionBounds.right,
+            bottom: selectionBounds.bottom,
+            width: selectionBounds.width,
+            height: selectionBounds.height
+        }
+    }
+    let boundsLayer;
+    if (boundsLayerID > 0) {
+        boundsLayer = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findInAllSubLayer)(targetDocument, boundsLayerID)
+        if (!boundsLayer) throw new Error(`Bounds layer(id: ${boundsLayerID}) not found`);
+    }
+    // null boundsLayer = document bounds
+    if (!boundsLayer) return docBounds;
+    // empty boundsLayer = document bounds
+    const boundsLayerBounds = boundsLayer.bounds
+    const isEmptyBoundsLayer = boundsLayerBounds.left == 0 && boundsLayerBounds.top == 0 && boundsLayerBounds.right == 0 && boundsLayerBounds.bottom == 0;
+    if (isEmptyBoundsLayer) return docBounds;
+    // normal layer
+    let desireBounds = {
+        left: boundsLayerBounds.left,
+        top: boundsLayerBounds.top,
+        right: boundsLayerBounds.right,
+        bottom: boundsLayerBounds.bottom,
+        width: boundsLayerBounds.width,
+        height: boundsLayerBounds.height
+    };
+    return desireBounds
+}
+
+// two 32 bit fnv-1a lanes per tile, row major, edge tiles clipped to the image
+function hashTiles(pixels, width, height, tileSize) {
+    const aligned = pixels.byteOffset % 4 == 0 ? pixels : pixels.slice();
+    const words = new Uint32Array(aligned.buffer, aligned.byteOffset, width * height);
+    const tilesX = Math.ceil(width / tileSize);
+    const tilesY = Math.ceil(height / tileSize);
+    const hashes = [];
+    for (let tileY = 0; tileY < tilesY; tileY++) {
+        for (let tileX = 0; tileX < tilesX; tileX++) {
+            let hashA = 2166136261;
+            let hashB = 3735928559;
+            const right = Math.min(width, (tileX + 1) * tileSize);
+            const bottom = Math.min(height, (tileY + 1) * tileSize);
+            for (let y = tileY * tileSize; y < bottom; y++) {
+                for (let i = y * width + tileX * tileSize, end = y * width + right; i < end; i++) {
+                    hashA = Math.imul(hashA ^ words[i], 16777619);
+                    hashB = Math.imul(hashB ^ words[i], 2246822519);
+                }
+            }
+            hashes.push((hashA >>> 0).toString(16).padStart(8, '0') + (hashB >>> 0).toString(16).padStart(8, '0'));
+        }
+    }
+    return hashes;
+}
+
+// rgba rows of the given tiles back to back
+function collectTiles(pixels, width, height, tileSize, tiles) {
+    const tilesX = Math.ceil(width / tileSize);
+    const chunks = [];
+    let length = 0;
+    for (const index of tiles) {
+        const left = (index % tilesX) * tileSize;
+        const top = Math.floor(index / tilesX) * tileSize;
+        const right = Math.min(width, left + tileSize);
+        const bottom = Math.min(height, top + tileSize);
+        for (let y = top; y < bottom; y++) {
+            const row = pixels.subarray((y * width + left) * 4, (y * width + right) * 4);
+            chunks.push(row);
+            length += row.length;
+        }
+    }
+    const data = new Uint8Array(length);
+    let offset = 0;
+    for (const chunk of chunks) {
+        data.set(chunk, offset);
+        offset += chunk.length;
+    }
+    return data;
 }
-async function get_image(payload) {
-  const documentID = payload.params.document_id;
-  const layerID = payload.params.layer_id;
-  const boundsLayerID = payload.params.use_layer_bounds;
-  let uploadName = 0;
-  let layerOpacity = 100;
-  this.targetDocument = undefined;
-  await (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.executeAsModalUntilSuccess)(async executionContext => {
-    let hostControl;
-    let suspensionID;
-    const startTime = Date.now();
-    let layer;
-    let isFolder = false;
-    let activeLayers;
-    try {
-      this.targetDocument = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findDocument)(documentID);
-      console.log("targetDocument: ", this.targetDocument, this.targetDocument?.id, this.targetDocument?.name);
-      activeLayers = this.targetDocument.activeLayers;
-      hostControl = executionContext.hostControl;
-      suspensionID = await hostControl.suspendHistory({
-        "documentID": this.targetDocument.id,
-        "name": "Image To ComfyUI"
-      });
-      [layer, isFolder] = await findLayer.call(this, layerID);
-      layerOpacity = layer?.opacity ?? 100;
-      const desireBounds = getDesiredBounds.call(this, boundsLayerID);
-      const pixelDataFromAPI = await getPixelsData.call(this, layer, desireBounds);
-      const pixelDataForReturn = padAndTrimLayerDataToDesireBounds.call(this, layer, pixelDataFromAPI, desireBounds);
-      // console.log('getPixels', Date.now() - startTime, 'ms');
-      // log desire size
-      const image = await new Promise((resolve, reject) => {
-        new (_library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default())({
-          data: pixelDataForReturn,
-          width: desireBounds.width,
-          height: desireBounds.height
-        }, (err, image) => {
-          err ? reject(err) : resolve(image);
-        });
-      });
-      // console.log('new Jimp', Date.now() - startTime, 'ms');
-      image.quality(100);
-      // console.log('quality', Date.now() - startTime, 'ms');
-      const file = await image.getBufferAsync((_library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default().MIME_PNG));
-      // console.log('create pngfile', Date.now() - startTime, 'ms');
-
-      const fd = new FormData();
-      const PhotoshopBlob = new Blob([file], {
-        type: "image/png"
-      });
-      fd.append('image', PhotoshopBlob, "PhotoshopBlob.png");
-      fd.append('overwrite', "true");
-      // console.log('start upload', Date.now() - startTime, 'ms');
-      const promise = fetch(this.comfyURL + '/upload/image', {
-        method: 'POST',
-        body: fd
-      }).then(res => {
-        if (res.status == 200) return res.json();else throw new Error('HTTP ' + res.status);
-      });
-      // console.log('finish upload', Date.now() - startTime, 'ms')
-      const result = await promise;
-      // console.log('upload resulted', Date.now() - startTime, 'ms')
 
-      if (result.error) throw new Error(result.error);
-      if (!result.name) throw new Error('No upload_name');
-      uploadName = result.name;
-    } catch (e) {
-      console.error(e);
-      throw e;
-    } finally {
-      if (layer && isFolder) layer.delete();
-      if (activeLayers && activeLayers.length > 0) {
-        for (let i = 0; i < activeLayers.length; i++) {
-          activeLayers[i].selected = true;
+async function get_image(payload) {
+    const documentID = payload.params.document_id;
+    const layerID = payload.params.layer_id;
+    const boundsLayerID = payload.params.use_layer_bounds;
+    // in memory upload endpoint, falls back to comfy's /upload/image on older servers
+    const uploadURL = payload.params.upload_url;
+    let uploadName = 0;
+    let uploadKey = 0;
+    let layerOpacity = 100;
+    // per call, calls run concurrently and must not share the document
+    let targetDocument = undefined;
+    // the server keeps the pixels of the last fetch, only changed tiles are uploaded when its size still matches
+    const tileDelta = payload.params.tile_delta;
+    let tileResult = {};
+    // png unless the server negotiated an rgba encoding, tiles are always rgba
+    const encoding = payload.params.encoding || 'png';
+    const tileEncoding = (0,_codecs__WEBPACK_IMPORTED_MODULE_3__.isRGBACodec)(encoding) ? encoding : 'raw';
+    let uploadEncoding = encoding;
+    let imageWidth = 0;
+    let imageHeight = 0;
+    const timings = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.createTimings)(payload);
+
+    // pipelined with a history check, nothing to do if the document didn't change since the server's copy
+    const skipIfHistoryStateID = payload.params.skip_if_history_state_id;
+    if (skipIfHistoryStateID) {
+        const historyStateID = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.getLastHistoryState)((0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findDocument)(documentID))?.id;
+        if (historyStateID == skipIfHistoryStateID) {
+            return { skipped: true, history_state_id: historyStateID };
         }
-      }
-      if (hostControl && suspensionID) hostControl.resumeHistory(suspensionID);
     }
-  }, {
-    commandName: "get content of layer " + layerID
-  });
-  return {
-    upload_name: uploadName,
-    layer_opacity: layerOpacity
-  };
+
+    const modalStartTime = Date.now();
+    await (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.executeAsModalUntilSuccess)(async (executionContext) => {
+        let hostControl;
+        let suspensionID;
+        const startTime = Date.now();
+        timings.add('wait modal', modalStartTime);
+        let layer;
+        let isFolder = false;
+        let activeLayers;
+        try {
+            targetDocument = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findDocument)(documentID);
+            console.log("targetDocument: ", targetDocument, targetDocument?.id, targetDocument?.name)
+            activeLayers = targetDocument.activeLayers;
+            hostControl = executionContext.hostControl;
+            suspensionID = await hostControl.suspendHistory({
+                "documentID": targetDocument.id,
+                "name": "Image To ComfyUI"
+            });
+            [layer, isFolder] = await findLayer(targetDocument, layerID);
+            layerOpacity = layer?.opacity ?? 100;
+            const desireBounds =  getDesiredBounds(targetDocument, boundsLayerID);
+            imageWidth = desireBounds.width;
+            imageHeight = desireBounds.height;
+            let phaseStartTime = Date.now();
+            const pixelDataFromAPI = await getPixelsData(targetDocument, layer, desireBounds);
+            const pixelDataForReturn = padAndTrimLayerDataToDesireBounds(targetDocument, layer, pixelDataFromAPI, desireBounds);
+            // console.log('getPixels', Date.now() - startTime, 'ms');
+            timings.add('getPixels', phaseStartTime);
+            phaseStartTime = Date.now();
+            let PhotoshopBlob;
+            if (tileDelta) {
+                const tileHashes = hashTiles(pixelDataForReturn, desireBounds.width, desireBounds.height, tileDelta.tile_size);
+                tileResult = { tile_hashes: tileHashes, tile_size: tileDelta.tile_size };
+                if (tileDelta.hashes && tileDelta.width == desireBounds.width && tileDelta.height == desireBounds.height) {
+                    const tiles = [];
+                    tileHashes.forEach((hash, index) => { if (hash !== tileDelta.hashes[index]) tiles.push(index); });
+                    tileResult.delta = true;
+                    tileResult.tiles = tiles;
+                    uploadEncoding = tileEncoding;
+                    if (tiles.length > 0) PhotoshopBlob = new Blob([(0,_codecs__WEBPACK_IMPORTED_MODULE_3__.compressRGBA)(collectTiles(pixelDataForReturn, desireBounds.width, desireBounds.height, tileDelta.tile_size, tiles), tileEncoding)], { type: "application/octet-stream" });
+                }
+            }
+            if (!tileResult.delta && (0,_codecs__WEBPACK_IMPORTED_MODULE_3__.isRGBACodec)(encoding)) {
+                PhotoshopBlob = new Blob([(0,_codecs__WEBPACK_IMPORTED_MODULE_3__.compressRGBA)(pixelDataForReturn, encoding)], { type: "application/octet-stream" });
+            } else if (!tileResult.delta) {
+                // log desire size
+                const image = await new Promise((resolve, reject) => {
+                    new (_library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default())({
+                        data: pixelDataForReturn,
+                        width: desireBounds.width,
+                        height: desireBounds.height
+                    }, (err, image) => {
+                        err ? reject(err) : resolve(image);
+                    })
+                })
+                // console.log('new Jimp', Date.now() - startTime, 'ms');
+                image.quality(100);
+                // console.log('quality', Date.now() - startTime, 'ms');
+                const file = await image.getBufferAsync(_library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default().MIME_PNG);
+                // console.log('create pngfile', Date.now() - startTime, 'ms');
+                PhotoshopBlob = new Blob([file], { type: "image/png" });
+            }
+            timings.add(tileResult.delta ? 'encode tiles' : 'encode ' + encoding, phaseStartTime);
+            // nothing changed at all, nothing to upload
+            if (!PhotoshopBlob) return;
+
+            const fd = new FormData();
+            fd.append('image', PhotoshopBlob, "PhotoshopBlob.png")              ;
+            if (!uploadURL) fd.append('overwrite', "true");
+            // console.log('start upload', Date.now() - startTime, 'ms');
+            phaseStartTime = Date.now();
+            const promise = fetch(this.comfyURL + (uploadURL || '/upload/image'), {
+                method: 'POST',
+                body: fd,
+            }).then(res => {
+                                if (res.status == 200)
+                    return res.json()
+                else
+                    throw new Error('HTTP ' + res.status)
+            })
+            // console.log('finish upload', Date.now() - startTime, 'ms')
+            const result = await promise
+            // console.log('upload resulted', Date.now() - startTime, 'ms')
+            timings.add('upload', phaseStartTime);
+
+            if (result.error) throw new Error(result.error);
+            if (uploadURL) {
+                if (!result.upload_key) throw new Error('No upload_key')
+                uploadKey = result.upload_key
+            } else {
+                if (!result.name) throw new Error('No upload_name')
+                uploadName = result.name
+            }
+
+        } catch (e) {
+            console.error(e);
+            throw e
+
+        } finally {
+            if (layer && isFolder) layer.delete();
+            if (activeLayers && activeLayers.length > 0) {
+                for (let i = 0; i < activeLayers.length; i++) {
+                    activeLayers[i].selected = true;
+                }
+            }
+            if (hostControl && suspensionID) hostControl.resumeHistory(suspensionID);
+        }
+        
+    }, { commandName: "get content of layer " + layerID })
+    timings.add('modal', modalStartTime);
+
+    return Object.assign({
+            upload_name: uploadName,
+            upload_key: uploadKey,
+            layer_opacity: layerOpacity,
+            history_state_id: (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.getLastHistoryState)(targetDocument)?.id,
+            encoding: uploadEncoding,
+            width: imageWidth,
+            height: imageHeight,
+            timings: payload.params.trace ? timings.timings : undefined,
+        }, tileResult)
 }
 
 /***/ }),
@@ -645,29 +964,55 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony import */ var photoshop__WEBPACK_IMPORTED_MODULE_1___default = /*#__PURE__*/__webpack_require__.n(photoshop__WEBPACK_IMPORTED_MODULE_1__);
 
 
+
+// last tree sent per document id, base of the next delta
+const sentLayerTrees = {};
+
+function getLayerTreeVersion(doc) {
+    return doc.activeHistoryState?.id || (0,_util__WEBPACK_IMPORTED_MODULE_0__.getLastHistoryState)(doc)?.id || 0;
+}
+
+function getLayerTree(doc, knownVersions) {
+    const version = getLayerTreeVersion(doc);
+    const knownVersion = knownVersions[doc.id];
+    if (version && knownVersion == version) {
+        return { id: doc.id, version, unchanged: true };
+    }
+    const layers = (0,_util__WEBPACK_IMPORTED_MODULE_0__.getAllSubLayer)(doc);
+    const sentLayerTree = sentLayerTrees[doc.id];
+    if (version) sentLayerTrees[doc.id] = { version, layers };
+    if (!version || !knownVersion || !sentLayerTree || sentLayerTree.version != knownVersion) {
+        return { id: doc.id, version, layers };
+    }
+    // only new or renamed layers are sent with their names, the rest by id
+    const sentNames = {};
+    sentLayerTree.layers.forEach(layer => { sentNames[layer.id] = layer.name; });
+    return {
+        id: doc.id,
+        version,
+        base_version: knownVersion,
+        order: layers.map(layer => layer.id),
+        changed: layers.filter(layer => sentNames[layer.id] !== layer.name),
+    };
+}
+
 async function get_layers(payload) {
-  const documentIdsToSyncLayers = payload.params.document_ids_to_sync_layers;
-  const documents = photoshop__WEBPACK_IMPORTED_MODULE_1__.app.documents;
-  const allDocumentInfo = photoshop__WEBPACK_IMPORTED_MODULE_1__.app.documents.map(doc => ({
-    name: doc.name,
-    id: doc.id
-  }));
-  const targetDocuments = documents.filter(doc => documentIdsToSyncLayers.includes(doc.id));
-  const allLayers = targetDocuments.map(doc => ({
-    id: doc.id,
-    layers: (0,_util__WEBPACK_IMPORTED_MODULE_0__.getAllSubLayer)(doc)
-  }));
-  if (photoshop__WEBPACK_IMPORTED_MODULE_1__.app.activeDocument) {
-    allLayers.push({
-      id: _util__WEBPACK_IMPORTED_MODULE_0__.SPECIAL_DOCUMENT_TO_ID[_util__WEBPACK_IMPORTED_MODULE_0__.SPECIAL_DOCUMENT_USE_ACTIVE],
-      layers: (0,_util__WEBPACK_IMPORTED_MODULE_0__.getAllSubLayer)(photoshop__WEBPACK_IMPORTED_MODULE_1__.app.activeDocument)
-    });
-  }
-  // const allLayers = getAllSubLayer(app.activeDocument);
-  return {
-    layers: allLayers,
-    documents: allDocumentInfo
-  };
+    const documentIdsToSyncLayers = payload.params.document_ids_to_sync_layers
+    const documents = photoshop__WEBPACK_IMPORTED_MODULE_1__.app.documents;
+    const allDocumentInfo = photoshop__WEBPACK_IMPORTED_MODULE_1__.app.documents.map(doc => ({ name: doc.name, id: doc.id }));
+    // older servers don't send known_versions and get full trees
+    if (!payload.params.known_versions) {
+        const targetDocuments = documents.filter(doc => documentIdsToSyncLayers.includes(doc.id));
+        const allLayers = targetDocuments.map(doc => ({id: doc.id, layers: (0,_util__WEBPACK_IMPORTED_MODULE_0__.getAllSubLayer)(doc)}));
+        if (photoshop__WEBPACK_IMPORTED_MODULE_1__.app.activeDocument) {
+            allLayers.push({id: _util__WEBPACK_IMPORTED_MODULE_0__.SPECIAL_DOCUMENT_TO_ID[_util__WEBPACK_IMPORTED_MODULE_0__.SPECIAL_DOCUMENT_USE_ACTIVE], layers: (0,_util__WEBPACK_IMPORTED_MODULE_0__.getAllSubLayer)(photoshop__WEBPACK_IMPORTED_MODULE_1__.app.activeDocument)});
+        }
+        return { layers: allLayers, documents: allDocumentInfo };
+    }
+    const knownVersions = payload.params.known_versions;
+    const targetDocuments = documents.filter(doc => documentIdsToSyncLayers.includes(doc.id) || doc.id == photoshop__WEBPACK_IMPORTED_MODULE_1__.app.activeDocument?.id);
+    const allLayers = targetDocuments.map(doc => getLayerTree(doc, knownVersions));
+    return { layers: allLayers, documents: allDocumentInfo, active_document_id: photoshop__WEBPACK_IMPORTED_MODULE_1__.app.activeDocument?.id };
 }
 
 /***/ }),
@@ -688,101 +1033,163 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony import */ var _util_js__WEBPACK_IMPORTED_MODULE_1__ = __webpack_require__(/*! ../util.js */ "./src/system/util.js");
 /* harmony import */ var _library_jimp_min__WEBPACK_IMPORTED_MODULE_2__ = __webpack_require__(/*! ../library/jimp.min */ "./src/system/library/jimp.min.js");
 /* harmony import */ var _library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default = /*#__PURE__*/__webpack_require__.n(_library_jimp_min__WEBPACK_IMPORTED_MODULE_2__);
+/* harmony import */ var _codecs_js__WEBPACK_IMPORTED_MODULE_3__ = __webpack_require__(/*! ../codecs.js */ "./src/system/codecs.js");
+
+
+
 
 
 
 
 function autocrop(jimp) {
-  let minX = jimp.bitmap.width - 1;
-  let minY = jimp.bitmap.height - 1;
-  let maxX = 0;
-  let maxY = 0;
-  jimp.scan(0, 0, jimp.bitmap.width, jimp.bitmap.height, function (x, y, idx) {
-    const alpha = this.bitmap.data[idx + 3];
-    if (alpha !== 0) {
-      minX = Math.min(minX, x);
-      minY = Math.min(minY, y);
-      maxX = Math.max(maxX, x);
-      maxY = Math.max(maxY, y);
+    let minX = jimp.bitmap.width - 1;
+    let minY = jimp.bitmap.height - 1;
+    let maxX = 0;
+    let maxY = 0;
+
+    jimp.scan(0, 0, jimp.bitmap.width, jimp.bitmap.height, function(x, y, idx) {
+        const alpha = this.bitmap.data[idx + 3];
+        if (alpha !== 0) {
+            minX = Math.min(minX, x);
+            minY = Math.min(minY, y);
+            maxX = Math.max(maxX, x);
+            maxY = Math.max(maxY, y);
+        }
+    });
+
+    const width = maxX - minX + 1;
+    const height = maxY - minY + 1;
+    jimp.crop(minX, minY, width, height);
+    return jimp;
+}
+
+function jimpFromRGBA(data, width, height) {
+    return new Promise((resolve, reject) => {
+        new (_library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default())({ data, width, height }, (err, image) => {
+            err ? reject(err) : resolve(image);
+        })
+    })
+}
+
+// encoding and crop come with the call, rgba encodings need the crop's size
+async function readImage(imageId, binaryFrame, encoding, crop) {
+    if (!binaryFrame) {
+        const url = this.comfyURL + '/finished_images?id=' + imageId;
+        if (!(0,_codecs_js__WEBPACK_IMPORTED_MODULE_3__.isRGBACodec)(encoding)) return await _library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default().read(url);
+        const res = await fetch(url);
+        if (res.status != 200) throw new Error('HTTP ' + res.status);
+        if (res.headers.get('content-type')?.includes('json')) throw new Error((await res.json()).error);
+        const data = (0,_codecs_js__WEBPACK_IMPORTED_MODULE_3__.decompressRGBA)(new Uint8Array(await res.arrayBuffer()), encoding);
+        return await jimpFromRGBA(data, crop.width, crop.height);
     }
-  });
-  const width = maxX - minX + 1;
-  const height = maxY - minY + 1;
-  jimp.crop(minX, minY, width, height);
-  return jimp;
+    // rgba pushed over the websocket before the call
+    return await jimpFromRGBA((0,_codecs_js__WEBPACK_IMPORTED_MODULE_3__.decompressRGBA)(binaryFrame.data, binaryFrame.header.encoding), binaryFrame.header.width, binaryFrame.header.height);
 }
-async function send_images(payload) {
-  const documentId = payload.params.document_id;
-  const imageIds = payload.params.image_ids;
-  const layerId = payload.params.layer_id;
-  let targetDocument = undefined;
-  console.log("send_images layerId: ", layerId);
-  try {
-    targetDocument = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findDocument)(documentId);
-  } catch (e) {
-    console.error(e.message);
-    throw e;
-  }
-  await Promise.all(imageIds.map(async imageId => {
+
+// crop: set when the server already cropped the image to its non transparent pixels
+async function placeImage(targetDocument, layerId, imageIds, imageId, jimp, crop) {
     let layer;
     let existingLayerName;
     let newLayerName;
-    await (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.executeAsModalUntilSuccess)(async () => {
-      if (layerId && layerId != _util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_NAME_TO_ID[_util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_NEW_LAYER]) {
-        layer = await targetDocument.layers.find(l => l.id == layerId);
+    if (layerId && layerId != _util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_NAME_TO_ID[_util_js__WEBPACK_IMPORTED_MODULE_1__.SPECIAL_LAYER_NEW_LAYER]) {
+        layer = await targetDocument.layers.find(l => l.id == layerId)
         // deal with multiple images
-        let imageIndexSuffix = "";
-        console.log("imageIds.length: ", imageIds.length);
-        if (imageIds.length > 1) {
-          index = imageIds.indexOf(imageId);
-          console.log("imageIds.index: ", index);
-          if (index > 0) imageIndexSuffix = ` ${index}`;
-        }
-        if (imageIndexSuffix != "" && layer != null) {
-          const layerName = layer?.name;
-          existingLayerName = layerName + imageIndexSuffix;
-          console.log("existingLayerName: ", existingLayerName);
-          layer = await targetDocument.layers.find(l => l.name == existingLayerName);
-        }
-      }
-      // deal with new layer or id/name not found layer
-      if (!layer) {
-        newLayerName = existingLayerName ?? 'Comfy Images ' + imageId;
-        console.log("newLayerName: ", newLayerName);
+        let imageIndexSuffix = ""
+        console.log("imageIds.length: ", imageIds.length)
+        if (imageIds.length > 1){
+            const index = imageIds.indexOf(imageId)
+            console.log("imageIds.index: ", index)
+            if (index > 0)
+                imageIndexSuffix = ` ${index}`
+        }
+        if (imageIndexSuffix != "" && layer != null){
+            const layerName = layer?.name;
+            existingLayerName = layerName + imageIndexSuffix
+            console.log("existingLayerName: ", existingLayerName)
+            layer = await targetDocument.layers.find(l => l.name == existingLayerName)
+        }
+    }
+    // deal with new layer or id/name not found layer
+    if (!layer) {
+        newLayerName = existingLayerName ?? 'Comfy Images ' + imageId
+        console.log("newLayerName: ", newLayerName)
         layer = await targetDocument.createLayer("pixel", {
-          name: newLayerName
-        });
-      }
-      const jimp = await _library_jimp_min__WEBPACK_IMPORTED_MODULE_2___default().read(this.comfyURL + '/finished_images?id=' + imageId);
-      autocrop(jimp);
-      let putPixelsOptions = {
+            name: newLayerName
+        })
+    }
+    if (!crop) autocrop(jimp)
+    let putPixelsOptions = {
         layerID: layer.id,
-        imageData: await photoshop__WEBPACK_IMPORTED_MODULE_0__.imaging.createImageDataFromBuffer(jimp.bitmap.data, {
-          width: jimp.bitmap.width,
-          height: jimp.bitmap.height,
-          components: 4,
-          colorSpace: "RGB"
-        }),
-        replace: true
-      };
-      if (!newLayerName) {
-        let bounds = layer.bounds;
+        imageData: await photoshop__WEBPACK_IMPORTED_MODULE_0__.imaging.createImageDataFromBuffer(
+            jimp.bitmap.data,
+            {
+                width: jimp.bitmap.width,
+                height: jimp.bitmap.height,
+                components: 4,
+                colorSpace: "RGB"
+            }
+        ),
+        replace: true,
+    }
+    if (!newLayerName) {
+        let bounds = layer.bounds
         if (bounds.width != jimp.bitmap.width || bounds.height != jimp.bitmap.height) {
-          let centerBounds = {};
-          centerBounds.left = bounds.left + (bounds.width - jimp.bitmap.width) / 2;
-          centerBounds.top = bounds.top + (bounds.height - jimp.bitmap.height) / 2;
-          centerBounds.right = bounds.left + jimp.bitmap.width;
-          centerBounds.bottom = bounds.top + jimp.bitmap.height;
-          centerBounds.width = jimp.bitmap.width;
-          centerBounds.height = jimp.bitmap.height;
-          bounds = centerBounds;
-        }
-        putPixelsOptions.targetBounds = bounds;
-      }
-      await photoshop__WEBPACK_IMPORTED_MODULE_0__.imaging.putPixels(putPixelsOptions);
-    });
-  }));
-  return {};
+            let centerBounds = {}
+            centerBounds.left = bounds.left + (bounds.width - jimp.bitmap.width) / 2
+            centerBounds.top = bounds.top + (bounds.height - jimp.bitmap.height) / 2
+            centerBounds.right = bounds.left + jimp.bitmap.width
+            centerBounds.bottom = bounds.top + jimp.bitmap.height
+            centerBounds.width = jimp.bitmap.width
+            centerBounds.height = jimp.bitmap.height
+            bounds = centerBounds
+        }
+        putPixelsOptions.targetBounds = bounds
+    }
+    await photoshop__WEBPACK_IMPORTED_MODULE_0__.imaging.putPixels(putPixelsOptions)
+}
+
+async function send_images(payload) {
+    const documentId = payload.params.document_id
+    const imageIds = payload.params.image_ids
+    const layerId = payload.params.layer_id
+    const binaryFrames = payload.params.binary ? this.takeBinaryFrames(payload.call_id) : [];
+    let targetDocument = undefined;
+    const timings = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.createTimings)(payload);
+    console.log("send_images layerId: ", layerId)
+    try {
+        targetDocument = (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.findDocument)(documentId);
+    }catch(e){
+        console.error(e.message)
+        throw e;
+    }
+    if (payload.params.binary) {
+        // every pixel is already here, place the whole batch in one modal session
+        let phaseStartTime = Date.now();
+        const jimps = await Promise.all(imageIds.map((imageId, index) => readImage.call(this, imageId, binaryFrames[index])));
+        timings.add('read images', phaseStartTime);
+        phaseStartTime = Date.now();
+        await (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.executeAsModalUntilSuccess)(async () => {
+            for (let index = 0; index < imageIds.length; index++) {
+                await placeImage(targetDocument, layerId, imageIds, imageIds[index], jimps[index], binaryFrames[index]?.header.crop);
+            }
+        })
+        timings.add('place images', phaseStartTime);
+    } else {
+        const phaseStartTime = Date.now();
+        await Promise.all(
+            imageIds.map(async (imageId, index) => {
+                await (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.executeAsModalUntilSuccess)(async () => {
+                    const jimp = await readImage.call(this, imageId, null, payload.params.encoding, payload.params.crops?.[index])
+                    await placeImage(targetDocument, layerId, imageIds, imageId, jimp, payload.params.crops?.[index]);
+                })
+            })
+        )
+        timings.add('read and place images', phaseStartTime);
+    }
+    return {
+        history_state_id: (0,_util_js__WEBPACK_IMPORTED_MODULE_1__.getLastHistoryState)(targetDocument)?.id,
+        timings: payload.params.trace ? timings.timings : undefined,
+    };
 }
 
 /***/ }),
@@ -797,6 +1204,230 @@ function ownKeys(e,r){var t=Object.keys(e);if(Object.getOwnPropertySymbols){var
 
 /***/ }),
 
+/***/ "./src/system/msgpack.js":
+/*!*******************************!*\
+  !*** ./src/system/msgpack.js ***!
+  \*******************************/
+/***/ ((__unused_webpack_module, __webpack_exports__, __webpack_require__) => {
+
+"use strict";
+__webpack_require__.r(__webpack_exports__);
+/* harmony export */ __webpack_require__.d(__webpack_exports__, {
+/* harmony export */   SUPPORTED_MESSAGE_CODECS: () => (/* binding */ SUPPORTED_MESSAGE_CODECS),
+/* harmony export */   decodeMessage: () => (/* binding */ decodeMessage),
+/* harmony export */   encodeMessage: () => (/* binding */ encodeMessage)
+/* harmony export */ });
+// minimal messagepack for the websocket messages: nil, booleans, numbers, strings, binary, arrays and maps
+// numbers that aren't 32 bit integers are sent as float64, decoding understands every format the server's msgpack writes
+
+// message encodings this plugin understands, the server picks one per connection in the handshake
+const SUPPORTED_MESSAGE_CODECS = ['msgpack', 'json'];
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+class Writer {
+    constructor() {
+        this.buffer = new Uint8Array(1024);
+        this.view = new DataView(this.buffer.buffer);
+        this.length = 0;
+    }
+
+    reserve(size) {
+        if (this.length + size <= this.buffer.length) return;
+        let capacity = this.buffer.length * 2;
+        while (capacity < this.length + size) capacity *= 2;
+        const buffer = new Uint8Array(capacity);
+        buffer.set(this.buffer.subarray(0, this.length));
+        this.buffer = buffer;
+        this.view = new DataView(buffer.buffer);
+    }
+
+    uint8(value) {
+        this.reserve(1);
+        this.view.setUint8(this.length, value);
+        this.length += 1;
+    }
+
+    uint16(value) {
+        this.reserve(2);
+        this.view.setUint16(this.length, value);
+        this.length += 2;
+    }
+
+    uint32(value) {
+        this.reserve(4);
+        this.view.setUint32(this.length, value);
+        this.length += 4;
+    }
+
+    int32(value) {
+        this.reserve(4);
+        this.view.setInt32(this.length, value);
+        this.length += 4;
+    }
+
+    float64(value) {
+        this.reserve(8);
+        this.view.setFloat64(this.length, value);
+        this.length += 8;
+    }
+
+    bytes(data) {
+        this.reserve(data.length);
+        this.buffer.set(data, this.length);
+        this.length += data.length;
+    }
+
+    // type byte plus a length fitting 8, 16 or 32 bits
+    header(type8, type16, type32, length) {
+        if (type8 !== null && length < 0x100) {
+            this.uint8(type8);
+            this.uint8(length);
+        } else if (length < 0x10000) {
+            this.uint8(type16);
+            this.uint16(length);
+        } else {
+            this.uint8(type32);
+            this.uint32(length);
+        }
+    }
+
+    value(value) {
+        if (value === null || value === undefined) {
+            this.uint8(0xc0);
+        } else if (value === false) {
+            this.uint8(0xc2);
+        } else if (value === true) {
+            this.uint8(0xc3);
+        } else if (typeof value == 'number') {
+            this.number(value);
+        } else if (typeof value == 'string') {
+            const data = textEncoder.encode(value);
+            if (data.length < 32) this.uint8(0xa0 | data.length);
+            else this.header(0xd9, 0xda, 0xdb, data.length);
+            this.bytes(data);
+        } else if (value instanceof Uint8Array) {
+            this.header(0xc4, 0xc5, 0xc6, value.length);
+            this.bytes(value);
+        } else if (Array.isArray(value)) {
+            if (value.length < 16) this.uint8(0x90 | value.length);
+            else this.header(null, 0xdc, 0xdd, value.length);
+            value.forEach(item => this.value(item));
+        } else if (typeof value.toJSON == 'function') {
+            this.value(value.toJSON());
+        } else {
+            // like JSON.stringify, undefined members are left out
+            const keys = Object.keys(value).filter(key => value[key] !== undefined);
+            if (keys.length < 16) this.uint8(0x80 | keys.length);
+            else this.header(null, 0xde, 0xdf, keys.length);
+            keys.forEach(key => {
+                this.value(key);
+                this.value(value[key]);
+            });
+        }
+    }
+
+    number(value) {
+        if (Number.isInteger(value) && value >= -0x80000000 && value <= 0xffffffff) {
+            if (value >= 0 && value < 0x80) {
+                this.uint8(value);
+            } else if (value < 0 && value >= -32) {
+                this.uint8(value & 0xff);
+            } else if (value >= 0) {
+                this.uint8(0xce);
+                this.uint32(value);
+            } else {
+                this.uint8(0xd2);
+                this.int32(value);
+            }
+        } else {
+            this.uint8(0xcb);
+            this.float64(value);
+        }
+    }
+}
+
+function encodeMessage(value) {
+    const writer = new Writer();
+    writer.value(value);
+    return writer.buffer.subarray(0, writer.length);
+}
+
+class Reader {
+    constructor(data) {
+        this.data = data;
+        this.view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+        this.offset = 0;
+    }
+
+    skip(size) {
+        const offset = this.offset;
+        this.offset += size;
+        return offset;
+    }
+
+    string(length) {
+        return textDecoder.decode(this.data.subarray(this.skip(length), this.offset));
+    }
+
+    array(length) {
+        const array = new Array(length);
+        for (let index = 0; index < length; index++) array[index] = this.value();
+        return array;
+    }
+
+    map(length) {
+        const map = {};
+        for (let index = 0; index < length; index++) {
+            const key = this.value();
+            map[key] = this.value();
+        }
+        return map;
+    }
+
+    value() {
+        const type = this.view.getUint8(this.skip(1));
+        if (type < 0x80) return type;
+        if (type < 0x90) return this.map(type & 0x0f);
+        if (type < 0xa0) return this.array(type & 0x0f);
+        if (type < 0xc0) return this.string(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return this.data.slice(this.skip(this.view.getUint8(this.skip(1))), this.offset);
+            case 0xc5: return this.data.slice(this.skip(this.view.getUint16(this.skip(2))), this.offset);
+            case 0xc6: return this.data.slice(this.skip(this.view.getUint32(this.skip(4))), this.offset);
+            case 0xca: return this.view.getFloat32(this.skip(4));
+            case 0xcb: return this.view.getFloat64(this.skip(8));
+            case 0xcc: return this.view.getUint8(this.skip(1));
+            case 0xcd: return this.view.getUint16(this.skip(2));
+            case 0xce: return this.view.getUint32(this.skip(4));
+            case 0xcf: return Number(this.view.getBigUint64(this.skip(8)));
+            case 0xd0: return this.view.getInt8(this.skip(1));
+            case 0xd1: return this.view.getInt16(this.skip(2));
+            case 0xd2: return this.view.getInt32(this.skip(4));
+            case 0xd3: return Number(this.view.getBigInt64(this.skip(8)));
+            case 0xd9: return this.string(this.view.getUint8(this.skip(1)));
+            case 0xda: return this.string(this.view.getUint16(this.skip(2)));
+            case 0xdb: return this.string(this.view.getUint32(this.skip(4)));
+            case 0xdc: return this.array(this.view.getUint16(this.skip(2)));
+            case 0xdd: return this.array(this.view.getUint32(this.skip(4)));
+            case 0xde: return this.map(this.view.getUint16(this.skip(2)));
+            case 0xdf: return this.map(this.view.getUint32(this.skip(4)));
+        }
+        throw new Error('Unsupported msgpack type 0x' + type.toString(16));
+    }
+}
+
+function decodeMessage(data) {
+    return new Reader(data).value();
+}
+
+/***/ }),
+
 /***/ "./src/system/util.js":
 /*!****************************!*\
   !*** ./src/system/util.js ***!
@@ -813,6 +1444,7 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony export */   SPECIAL_LAYER_SAME_AS_LAYER: () => (/* binding */ SPECIAL_LAYER_SAME_AS_LAYER),
 /* harmony export */   SPECIAL_LAYER_USE_CANVAS: () => (/* binding */ SPECIAL_LAYER_USE_CANVAS),
 /* harmony export */   SPECIAL_LAYER_USE_SELECTION: () => (/* binding */ SPECIAL_LAYER_USE_SELECTION),
+/* harmony export */   createTimings: () => (/* binding */ createTimings),
 /* harmony export */   executeAsModalUntilSuccess: () => (/* binding */ executeAsModalUntilSuccess),
 /* harmony export */   findDocument: () => (/* binding */ findDocument),
 /* harmony export */   findInAllSubLayer: () => (/* binding */ findInAllSubLayer),
@@ -823,114 +1455,604 @@ __webpack_require__.r(__webpack_exports__);
 /* harmony import */ var photoshop__WEBPACK_IMPORTED_MODULE_0__ = __webpack_require__(/*! photoshop */ "photoshop");
 /* harmony import */ var photoshop__WEBPACK_IMPORTED_MODULE_0___default = /*#__PURE__*/__webpack_require__.n(photoshop__WEBPACK_IMPORTED_MODULE_0__);
 
-const SPECIAL_DOCUMENT_USE_ACTIVE = '### Use Active Document ###';
+
+const SPECIAL_DOCUMENT_USE_ACTIVE = '### Use Active Document ###'
 const SPECIAL_DOCUMENT_TO_ID = {
-  [SPECIAL_DOCUMENT_USE_ACTIVE]: 0
-};
-const SPECIAL_LAYER_USE_CANVAS = '### Use Canvas ###';
-const SPECIAL_LAYER_USE_SELECTION = '### Use Selection ###';
-const SPECIAL_LAYER_NEW_LAYER = '### New Layer ###';
-const SPECIAL_LAYER_SAME_AS_LAYER = '### Same as Layer ###';
+    [SPECIAL_DOCUMENT_USE_ACTIVE]: 0
+}
+const SPECIAL_LAYER_USE_CANVAS = '### Use Canvas ###'
+const SPECIAL_LAYER_USE_SELECTION = '### Use Selection ###'
+const SPECIAL_LAYER_NEW_LAYER = '### New Layer ###'
+const SPECIAL_LAYER_SAME_AS_LAYER = '### Same as Layer ###'
 const SPECIAL_LAYER_NAME_TO_ID = {
-  [SPECIAL_LAYER_USE_CANVAS]: 0,
-  [SPECIAL_LAYER_USE_SELECTION]: -1,
-  [SPECIAL_LAYER_NEW_LAYER]: -2,
-  [SPECIAL_LAYER_SAME_AS_LAYER]: -3
-};
-function unTrimImageData(intersectImageDataArray, toImageDataArray, fromImageBounds, toImageBounds) {
-  const fromLeft = fromImageBounds.left;
-  const fromTop = fromImageBounds.top;
-  const fromRight = fromImageBounds.right;
-  const fromBottom = fromImageBounds.bottom;
-  const fromWidth = fromRight - fromLeft;
-  const fromHeight = fromBottom - fromTop;
-  const toLeft = toImageBounds.left;
-  const toTop = toImageBounds.top;
-  const toRight = toImageBounds.right;
-  const toBottom = toImageBounds.bottom;
-  const toWidth = toRight - toLeft;
-  const toHeight = toBottom - toTop;
-  const intersectLeft = Math.max(fromLeft, toLeft);
-  const intersectTop = Math.max(fromTop, toTop);
-  const intersectRight = Math.min(fromRight, toRight);
-  const intersectBottom = Math.min(fromBottom, toBottom);
-  const intersectWidth = intersectRight - intersectLeft;
-  const intersectHeight = intersectBottom - intersectTop;
-  const toLength = toWidth * toHeight * 4;
-  if (toImageDataArray.length !== toLength) {
-    throw new Error(`toImageDataArray.length(${toImageDataArray.length}) !== toLength(${toLength})`);
-  }
-  const intersectLength = intersectWidth * intersectHeight * 4;
-  if (intersectImageDataArray.length !== intersectLength) {
-    throw new Error(`fromImageDataArray.length(${intersectImageDataArray.length}) !== fromLength(${intersectLength})`);
-  }
-  for (let i = 0; i < toLength; i += 4) {
-    const currentLeft = i / 4 % toWidth + toLeft;
-    const currentTop = Math.floor(i / 4 / toWidth) + toTop;
-    if (currentLeft >= fromLeft && currentLeft < fromRight && currentTop >= fromTop && currentTop < fromBottom) {
-      const fromIndex = ((currentTop - intersectTop) * intersectWidth + (currentLeft - intersectLeft)) * 4;
-      const alpha = intersectImageDataArray[fromIndex + 3];
-      toImageDataArray[i] = alpha == 0 ? 0 : intersectImageDataArray[fromIndex];
-      toImageDataArray[i + 1] = alpha == 0 ? 0 : intersectImageDataArray[fromIndex + 1];
-      toImageDataArray[i + 2] = alpha == 0 ? 0 : intersectImageDataArray[fromIndex + 2];
-      toImageDataArray[i + 3] = alpha;
-    }
-  }
-  return toImageDataArray;
+    [SPECIAL_LAYER_USE_CANVAS]: 0,
+    [SPECIAL_LAYER_USE_SELECTION]: -1,
+    [SPECIAL_LAYER_NEW_LAYER]: -2,
+    [SPECIAL_LAYER_SAME_AS_LAYER]: -3
+}
+
+function unTrimImageData(
+    intersectImageDataArray,
+    toImageDataArray,
+    fromImageBounds,
+    toImageBounds
+) {
+    const fromLeft = fromImageBounds.left;
+    const fromTop = fromImageBounds.top;
+    const fromRight = fromImageBounds.right;
+    const fromBottom = fromImageBounds.bottom;
+    const fromWidth = fromRight - fromLeft;
+    const fromHeight = fromBottom - fromTop;
+
+    const toLeft = toImageBounds.left;
+    const toTop = toImageBounds.top;
+    const toRight = toImageBounds.right;
+    const toBottom = toImageBounds.bottom;
+    const toWidth = toRight - toLeft;
+    const toHeight = toBottom - toTop;
+
+    const intersectLeft = Math.max(fromLeft, toLeft);
+    const intersectTop = Math.max(fromTop, toTop);
+    const intersectRight = Math.min(fromRight, toRight);
+    const intersectBottom = Math.min(fromBottom, toBottom);
+    const intersectWidth = intersectRight - intersectLeft;
+    const intersectHeight = intersectBottom - intersectTop;
+
+    const toLength = toWidth * toHeight * 4;
+    if (toImageDataArray.length !== toLength) {
+        throw new Error(`toImageDataArray.length(${toImageDataArray.length}) !== toLength(${toLength})`);
+    }
+    const intersectLength = intersectWidth * intersectHeight * 4;
+    if (intersectImageDataArray.length !== intersectLength) {
+        throw new Error(`fromImageDataArray.length(${intersectImageDataArray.length}) !== fromLength(${intersectLength})`);
+    }
+
+    for (let i = 0; i < toLength; i += 4) {
+        const currentLeft = (i / 4) % toWidth + toLeft;
+        const currentTop = Math.floor((i / 4) / toWidth) + toTop;
+        if (
+            currentLeft >= fromLeft &&
+            currentLeft < fromRight &&
+            currentTop >= fromTop &&
+            currentTop < fromBottom
+        ) {
+            const fromIndex = ((currentTop - intersectTop) * intersectWidth + (currentLeft - intersectLeft)) * 4;
+            const alpha = intersectImageDataArray[fromIndex + 3];
+            toImageDataArray[i] = alpha == 0 ? 0 : intersectImageDataArray[fromIndex];
+            toImageDataArray[i + 1] = alpha == 0 ? 0 : intersectImageDataArray[fromIndex + 1];
+            toImageDataArray[i + 2] = alpha == 0 ? 0 : intersectImageDataArray[fromIndex + 2];
+            toImageDataArray[i + 3] = alpha;
+        }
+    }
+    return toImageDataArray;
 }
+
 function getAllSubLayer(layer, level = 0) {
-  if (!layer?.layers) return [];
-  return layer.layers.reduce((ret, layer) => {
-    ret.push({
-      name: '-'.repeat(level) + layer.name,
-      id: layer.id
-    });
-    return ret.concat(getAllSubLayer(layer, level + 1));
-  }, []);
+    if (!layer?.layers) return [];
+    return layer.layers.reduce((ret, layer) => {
+        ret.push({
+            name: '-'.repeat(level) + layer.name,
+            id: layer.id
+        });
+        return ret.concat(getAllSubLayer(layer, level + 1));
+    }, []);
 }
+
 function findInAllSubLayer(layer, layerid) {
-  if (!layer?.layers) return null;
-  for (let i = 0; i < layer.layers.length; i++) {
-    if (layer.layers[i].id === layerid) return layer.layers[i];
-    const result = findInAllSubLayer(layer.layers[i], layerid);
-    if (result) return result;
-  }
-  return null;
+    if (!layer?.layers) return null;
+    for (let i = 0; i < layer.layers.length; i++) {
+        if (layer.layers[i].id === layerid) return layer.layers[i];
+
+        const result = findInAllSubLayer(layer.layers[i], layerid)
+        if (result) return result;
+    }
+    return null;
 }
+
 function findDocument(documentID) {
-  let document;
-  if (!photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents.length) throw new Error('No document opened');
-  if (documentID == SPECIAL_DOCUMENT_TO_ID[SPECIAL_DOCUMENT_USE_ACTIVE]) {
-    document = photoshop__WEBPACK_IMPORTED_MODULE_0__.app.activeDocument;
-  } else {
-    document = photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents.find(doc => doc.id == documentID);
-  }
-  if (!document) throw new Error(`Document(id: ${documentID}) not found`);
-  return document;
+    let document;
+    if (!photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents.length) throw new Error('No document opened');
+    if (documentID == SPECIAL_DOCUMENT_TO_ID[SPECIAL_DOCUMENT_USE_ACTIVE]) {
+        document = photoshop__WEBPACK_IMPORTED_MODULE_0__.app.activeDocument;
+    } else {
+        document = photoshop__WEBPACK_IMPORTED_MODULE_0__.app.documents.find(doc => doc.id == documentID);
+    }
+    if (!document) throw new Error(`Document(id: ${documentID}) not found`);
+    return document;
 }
+
 function getLastHistoryState(document) {
-  const historyStates = document?.historyStates;
-  if (!historyStates || historyStates.length <= 0) return;
-  const filteredHistoryStates = historyStates.filter(state => state?.id);
-  if (filteredHistoryStates.length <= 0) return;
-  const historyState = filteredHistoryStates[filteredHistoryStates.length - 1];
-  return historyState;
+    const historyStates = document?.historyStates;
+    if (!historyStates || historyStates.length <= 0)
+        return;
+    const filteredHistoryStates = historyStates.filter(state => state?.id);
+    if (filteredHistoryStates.length <= 0)
+        return;
+    const historyState = filteredHistoryStates[filteredHistoryStates.length - 1];
+    return historyState;
 }
+
 async function executeAsModalUntilSuccess(...args) {
-  let result;
-  let failed = true;
-  while (failed) {
-    try {
-      result = await photoshop__WEBPACK_IMPORTED_MODULE_0__.core.executeAsModal(...args);
-      failed = false;
-    } catch (e) {
-      if (e.number != 9) {
-        failed = false; // This case is hit if the targetFunction throws an exception
-      }
+    let result;
+    let failed = true;
+    while(failed) {
+        try {
+            result = await photoshop__WEBPACK_IMPORTED_MODULE_0__.core.executeAsModal(...args);
+            failed = false;
+        } catch (e) {
+            if (e.number != 9) {
+                failed = false; // This case is hit if the targetFunction throws an exception
+            }
+        }
+        await new Promise(r => setTimeout(r, 200));
     }
-    await new Promise(r => setTimeout(r, 200));
-  }
-  return result;
+    return result;
+}
+
+// phase timings returned to the server when it traces the call, in ms from when the call arrived
+function createTimings(payload) {
+    const enabled = payload.params.trace;
+    const callStart = payload.received_at || Date.now();
+    const timings = [];
+    return {
+        timings,
+        add(name, start) {
+            if (enabled) timings.push({ name, start: start - callStart, duration: Date.now() - start });
+        },
+    };
+}
+
+/***/ }),
+
+/***/ "./src/system/zlib.js":
+/*!****************************!*\
+  !*** ./src/system/zlib.js ***!
+  \****************************/
+/***/ ((__unused_webpack_module, __webpack_exports__, __webpack_require__) => {
+
+"use strict";
+__webpack_require__.r(__webpack_exports__);
+/* harmony export */ __webpack_require__.d(__webpack_exports__, {
+/* harmony export */   deflate: () => (/* binding */ deflate),
+/* harmony export */   inflate: () => (/* binding */ inflate)
+/* harmony export */ });
+// minimal zlib streams for the 'zlib' pixel encoding, read and written by python's zlib on the server
+// deflate matches greedily against one candidate per hash like zlib's fastest level, every block gets its own huffman codes
+
+const LENGTH_BASE = [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258];
+const LENGTH_EXTRA = [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0];
+const DISTANCE_BASE = [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193, 257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145, 8193, 12289, 16385, 24577];
+const DISTANCE_EXTRA = [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13];
+// order the lengths of the code length code are stored in
+const CODE_LENGTH_ORDER = [16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15];
+
+const WINDOW_SIZE = 32768;
+const HASH_BITS = 15;
+const MIN_MATCH = 3;
+const MAX_MATCH = 258;
+// matches up to this long also index the positions they cover
+const MAX_INSERT_LENGTH = 4;
+const BLOCK_SYMBOLS = 16384;
+
+// length and distance to their code
+const LENGTH_CODE = new Uint8Array(MAX_MATCH + 1);
+for (let code = 0; code < LENGTH_BASE.length; code++) {
+    for (let length = LENGTH_BASE[code]; length < LENGTH_BASE[code] + (1 << LENGTH_EXTRA[code]) && length <= MAX_MATCH; length++) LENGTH_CODE[length] = code;
+}
+const DISTANCE_CODE = new Uint8Array(WINDOW_SIZE + 1);
+for (let code = 0; code < DISTANCE_BASE.length; code++) {
+    for (let distance = DISTANCE_BASE[code]; distance < DISTANCE_BASE[code] + (1 << DISTANCE_EXTRA[code]); distance++) DISTANCE_CODE[distance] = code;
+}
+
+function adler32(data) {
+    let a = 1;
+    let b = 0;
+    for (let index = 0; index < data.length;) {
+        // the sums can't overflow before the modulo within 5552 bytes
+        const end = Math.min(index + 5552, data.length);
+        for (; index < end; index++) {
+            a += data[index];
+            b += a;
+        }
+        a %= 65521;
+        b %= 65521;
+    }
+    return ((b << 16) | a) >>> 0;
+}
+
+function reverseBits(code, length) {
+    let reversed = 0;
+    for (let bit = 0; bit < length; bit++) {
+        reversed = (reversed << 1) | (code & 1);
+        code >>= 1;
+    }
+    return reversed;
+}
+
+// codes are stored with their first bit lowest, the way the stream is read
+function canonicalCodes(lengths) {
+    const counts = new Uint16Array(16);
+    for (const length of lengths) counts[length]++;
+    counts[0] = 0;
+    const next = new Uint16Array(16);
+    for (let length = 1, code = 0; length < 16; length++) {
+        code = (code + counts[length - 1]) << 1;
+        next[length] = code;
+    }
+    const codes = new Uint16Array(lengths.length);
+    for (let symbol = 0; symbol < lengths.length; symbol++) {
+        if (lengths[symbol]) codes[symbol] = reverseBits(next[lengths[symbol]]++, lengths[symbol]);
+    }
+    return codes;
+}
+
+// depth of every leaf in the huffman tree of the weights
+function treeDepths(weights) {
+    const count = weights.length;
+    const order = weights.map((_, index) => index).sort((a, b) => weights[a] - weights[b]);
+    const weight = weights.slice();
+    const parent = new Int32Array(2 * count - 1);
+    // merged nodes come out in increasing weight, so they queue up behind the sorted leaves
+    let leaf = 0;
+    let node = count;
+    const lightest = () => (leaf < count && (node >= weight.length || weights[order[leaf]] <= weight[node])) ? order[leaf++] : node++;
+    while (weight.length < 2 * count - 1) {
+        const a = lightest();
+        const b = lightest();
+        parent[a] = parent[b] = weight.length;
+        weight.push(weight[a] + weight[b]);
+    }
+    const depths = new Int32Array(2 * count - 1);
+    for (let index = 2 * count - 3; index >= 0; index--) depths[index] = depths[parent[index]] + 1;
+    return depths.subarray(0, count);
+}
+
+// huffman code lengths of at most maxLength bits, at least two symbols get one so the code is complete
+function codeLengths(frequencies, maxLength) {
+    for (let symbol = 0, used = frequencies.filter(frequency => frequency > 0).length; used < 2; symbol++) {
+        if (frequencies[symbol] == 0) {
+            frequencies[symbol] = 1;
+            used++;
+        }
+    }
+    const symbols = [];
+    for (let symbol = 0; symbol < frequencies.length; symbol++) {
+        if (frequencies[symbol] > 0) symbols.push(symbol);
+    }
+    let weights = symbols.map(symbol => frequencies[symbol]);
+    const lengths = new Uint8Array(frequencies.length);
+    while (true) {
+        const depths = treeDepths(weights);
+        if (Math.max(...depths) <= maxLength) {
+            symbols.forEach((symbol, index) => lengths[symbol] = depths[index]);
+            return lengths;
+        }
+        // flatter weights give a shallower tree
+        weights = weights.map(weight => (weight + 1) >> 1);
+    }
+}
+
+class BitWriter {
+    constructor(capacity) {
+        this.buffer = new Uint8Array(Math.max(capacity, 1024));
+        this.length = 0;
+        this.bits = 0;
+        this.count = 0;
+    }
+
+    byte(value) {
+        if (this.length == this.buffer.length) {
+            const buffer = new Uint8Array(this.buffer.length * 2);
+            buffer.set(this.buffer);
+            this.buffer = buffer;
+        }
+        this.buffer[this.length++] = value;
+    }
+
+    // at most 16 bits at a time
+    write(value, count) {
+        this.bits |= value << this.count;
+        this.count += count;
+        while (this.count >= 8) {
+            this.byte(this.bits & 0xff);
+            this.bits >>>= 8;
+            this.count -= 8;
+        }
+    }
+
+    align() {
+        if (this.count > 0) this.byte(this.bits & 0xff);
+        this.bits = 0;
+        this.count = 0;
+    }
+}
+
+// code lengths run length coded with 16 (repeat previous), 17 and 18 (repeat zero), as [symbol, extra bits value]
+function runLengths(lengths) {
+    const runs = [];
+    for (let index = 0; index < lengths.length;) {
+        const length = lengths[index];
+        let run = 1;
+        while (index + run < lengths.length && lengths[index + run] == length) run++;
+        index += run;
+        if (length == 0) {
+            while (run >= 11) {
+                const repeat = Math.min(run, 138);
+                runs.push([18, repeat - 11]);
+                run -= repeat;
+            }
+            if (run >= 3) {
+                runs.push([17, run - 3]);
+                run = 0;
+            }
+        } else {
+            runs.push([length, 0]);
+            run--;
+            while (run >= 3) {
+                const repeat = Math.min(run, 6);
+                runs.push([16, repeat - 3]);
+                run -= repeat;
+            }
+        }
+        for (; run > 0; run--) runs.push([length, 0]);
+    }
+    return runs;
+}
+
+// literals have no distance, matches keep their length in literals
+function writeBlock(writer, literals, distances, count, last) {
+    const literalFrequencies = new Array(286).fill(0);
+    const distanceFrequencies = new Array(30).fill(0);
+    literalFrequencies[256] = 1;
+    for (let index = 0; index < count; index++) {
+        if (distances[index]) {
+            literalFrequencies[257 + LENGTH_CODE[literals[index]]]++;
+            distanceFrequencies[DISTANCE_CODE[distances[index]]]++;
+        } else {
+            literalFrequencies[literals[index]]++;
+        }
+    }
+    const literalLengths = codeLengths(literalFrequencies, 15);
+    const distanceLengths = codeLengths(distanceFrequencies, 15);
+    let literalCount = 286;
+    while (literalCount > 257 && literalLengths[literalCount - 1] == 0) literalCount--;
+    let distanceCount = 30;
+    while (distanceCount > 1 && distanceLengths[distanceCount - 1] == 0) distanceCount--;
+    const runs = runLengths([...literalLengths.subarray(0, literalCount), ...distanceLengths.subarray(0, distanceCount)]);
+    const runFrequencies = new Array(19).fill(0);
+    for (const [symbol] of runs) runFrequencies[symbol]++;
+    const runLengthLengths = codeLengths(runFrequencies, 7);
+    let runLengthCount = 19;
+    while (runLengthCount > 4 && runLengthLengths[CODE_LENGTH_ORDER[runLengthCount - 1]] == 0) runLengthCount--;
+
+    writer.write(last ? 1 : 0, 1);
+    writer.write(2, 2);
+    writer.write(literalCount - 257, 5);
+    writer.write(distanceCount - 1, 5);
+    writer.write(runLengthCount - 4, 4);
+    for (let index = 0; index < runLengthCount; index++) writer.write(runLengthLengths[CODE_LENGTH_ORDER[index]], 3);
+    const runLengthCodes = canonicalCodes(runLengthLengths);
+    for (const [symbol, extra] of runs) {
+        writer.write(runLengthCodes[symbol], runLengthLengths[symbol]);
+        if (symbol == 16) writer.write(extra, 2);
+        else if (symbol == 17) writer.write(extra, 3);
+        else if (symbol == 18) writer.write(extra, 7);
+    }
+
+    const literalCodes = canonicalCodes(literalLengths);
+    const distanceCodes = canonicalCodes(distanceLengths);
+    for (let index = 0; index < count; index++) {
+        const distance = distances[index];
+        if (!distance) {
+            writer.write(literalCodes[literals[index]], literalLengths[literals[index]]);
+            continue;
+        }
+        const length = literals[index];
+        const lengthCode = LENGTH_CODE[length];
+        writer.write(literalCodes[257 + lengthCode], literalLengths[257 + lengthCode]);
+        if (LENGTH_EXTRA[lengthCode]) writer.write(length - LENGTH_BASE[lengthCode], LENGTH_EXTRA[lengthCode]);
+        const distanceCode = DISTANCE_CODE[distance];
+        writer.write(distanceCodes[distanceCode], distanceLengths[distanceCode]);
+        if (DISTANCE_EXTRA[distanceCode]) writer.write(distance - DISTANCE_BASE[distanceCode], DISTANCE_EXTRA[distanceCode]);
+    }
+    writer.write(literalCodes[256], literalLengths[256]);
+}
+
+function hashAt(data, index) {
+    return ((data[index] << 10) ^ (data[index + 1] << 5) ^ data[index + 2]) & ((1 << HASH_BITS) - 1);
+}
+
+function deflate(data) {
+    const writer = new BitWriter(data.length >> 2);
+    // deflate with a 32k window, no preset dictionary, fastest level
+    writer.byte(0x78);
+    writer.byte(0x01);
+    const head = new Int32Array(1 << HASH_BITS).fill(-1);
+    const literals = new Uint16Array(BLOCK_SYMBOLS);
+    const distances = new Uint16Array(BLOCK_SYMBOLS);
+    let count = 0;
+    for (let index = 0; index < data.length;) {
+        let length = 0;
+        if (index + MIN_MATCH <= data.length) {
+            const hash = hashAt(data, index);
+            const candidate = head[hash];
+            head[hash] = index;
+            if (candidate >= 0 && index - candidate <= WINDOW_SIZE) {
+                const maxLength = Math.min(MAX_MATCH, data.length - index);
+                while (length < maxLength && data[candidate + length] == data[index + length]) length++;
+                if (length >= MIN_MATCH) distances[count] = index - candidate;
+            }
+        }
+        if (length >= MIN_MATCH) {
+            literals[count++] = length;
+            if (length <= MAX_INSERT_LENGTH) {
+                for (let inserted = index + 1; inserted < index + length && inserted + MIN_MATCH <= data.length; inserted++) head[hashAt(data, inserted)] = inserted;
+            }
+            index += length;
+        } else {
+            distances[count] = 0;
+            literals[count++] = data[index++];
+        }
+        if (count == BLOCK_SYMBOLS) {
+            writeBlock(writer, literals, distances, count, false);
+            count = 0;
+        }
+    }
+    writeBlock(writer, literals, distances, count, true);
+    writer.align();
+    const checksum = adler32(data);
+    for (let shift = 24; shift >= 0; shift -= 8) writer.byte((checksum >>> shift) & 0xff);
+    return writer.buffer.slice(0, writer.length);
+}
+
+class BitReader {
+    constructor(data, offset) {
+        this.data = data;
+        this.offset = offset;
+        this.bits = 0;
+        this.count = 0;
+    }
+
+    // loads what is left when the stream ends earlier, decode checks the code fits
+    fill(count) {
+        while (this.count < count && this.offset < this.data.length) {
+            this.bits |= this.data[this.offset++] << this.count;
+            this.count += 8;
+        }
+    }
+
+    read(count) {
+        if (count == 0) return 0;
+        this.fill(count);
+        if (this.count < count) throw new Error('Truncated zlib stream');
+        const value = this.bits & ((1 << count) - 1);
+        this.bits >>>= count;
+        this.count -= count;
+        return value;
+    }
+
+    decode(table) {
+        this.fill(table.bits);
+        const entry = table.entries[this.bits & ((1 << table.bits) - 1)];
+        const length = entry & 0xf;
+        if (length == 0 || length > this.count) throw new Error('Invalid zlib stream');
+        this.bits >>>= length;
+        this.count -= length;
+        return entry >> 4;
+    }
+
+    align() {
+        this.bits >>>= this.count & 7;
+        this.count -= this.count & 7;
+    }
+}
+
+// every index of table.bits low bits maps to symbol << 4 | code length
+function decodeTable(lengths) {
+    const bits = Math.max(1, ...lengths);
+    const entries = new Int32Array(1 << bits);
+    const codes = canonicalCodes(lengths);
+    for (let symbol = 0; symbol < lengths.length; symbol++) {
+        const length = lengths[symbol];
+        if (!length) continue;
+        for (let index = codes[symbol]; index < entries.length; index += 1 << length) entries[index] = (symbol << 4) | length;
+    }
+    return { bits, entries };
+}
+
+let fixedTables = null;
+function getFixedTables() {
+    if (!fixedTables) {
+        const literalLengths = new Array(288).fill(8, 0, 144).fill(9, 144, 256).fill(7, 256, 280).fill(8, 280, 288);
+        fixedTables = [decodeTable(literalLengths), decodeTable(new Array(30).fill(5))];
+    }
+    return fixedTables;
+}
+
+function readDynamicTables(reader) {
+    const literalCount = reader.read(5) + 257;
+    const distanceCount = reader.read(5) + 1;
+    const runLengthCount = reader.read(4) + 4;
+    const runLengthLengths = new Array(19).fill(0);
+    for (let index = 0; index < runLengthCount; index++) runLengthLengths[CODE_LENGTH_ORDER[index]] = reader.read(3);
+    const runLengthTable = decodeTable(runLengthLengths);
+    const lengths = [];
+    while (lengths.length < literalCount + distanceCount) {
+        const symbol = reader.decode(runLengthTable);
+        if (symbol < 16) {
+            lengths.push(symbol);
+            continue;
+        }
+        let length = 0;
+        let repeat;
+        if (symbol == 16) {
+            if (lengths.length == 0) throw new Error('Invalid zlib stream');
+            length = lengths[lengths.length - 1];
+            repeat = reader.read(2) + 3;
+        } else if (symbol == 17) {
+            repeat = reader.read(3) + 3;
+        } else {
+            repeat = reader.read(7) + 11;
+        }
+        for (; repeat > 0; repeat--) lengths.push(length);
+    }
+    if (lengths.length > literalCount + distanceCount) throw new Error('Invalid zlib stream');
+    return [decodeTable(lengths.slice(0, literalCount)), decodeTable(lengths.slice(literalCount))];
+}
+
+function inflate(data) {
+    if (data.length < 6 || (data[0] & 0x0f) != 8 || ((data[0] << 8) | data[1]) % 31 != 0 || (data[1] & 0x20)) throw new Error('Not a zlib stream');
+    const reader = new BitReader(data, 2);
+    let output = new Uint8Array(Math.max(data.length * 4, 1024));
+    let length = 0;
+    const reserve = (size) => {
+        if (length + size <= output.length) return;
+        let capacity = output.length * 2;
+        while (capacity < length + size) capacity *= 2;
+        const buffer = new Uint8Array(capacity);
+        buffer.set(output.subarray(0, length));
+        output = buffer;
+    };
+    let last = 0;
+    while (!last) {
+        last = reader.read(1);
+        const type = reader.read(2);
+        if (type == 0) {
+            reader.align();
+            const size = reader.read(16);
+            if ((size ^ 0xffff) != reader.read(16)) throw new Error('Invalid zlib stream');
+            // whole bytes are left in the reader after aligning
+            reserve(size);
+            for (let index = 0; index < size; index++) output[length++] = reader.read(8);
+            continue;
+        }
+        if (type == 3) throw new Error('Invalid zlib stream');
+        const [literalTable, distanceTable] = type == 1 ? getFixedTables() : readDynamicTables(reader);
+        while (true) {
+            const symbol = reader.decode(literalTable);
+            if (symbol < 256) {
+                reserve(1);
+                output[length++] = symbol;
+                continue;
+            }
+            if (symbol == 256) break;
+            const lengthCode = symbol - 257;
+            if (lengthCode >= LENGTH_BASE.length) throw new Error('Invalid zlib stream');
+            const matchLength = LENGTH_BASE[lengthCode] + reader.read(LENGTH_EXTRA[lengthCode]);
+            const distanceCode = reader.decode(distanceTable);
+            if (distanceCode >= DISTANCE_BASE.length) throw new Error('Invalid zlib stream');
+            const distance = DISTANCE_BASE[distanceCode] + reader.read(DISTANCE_EXTRA[distanceCode]);
+            if (distance > length) throw new Error('Invalid zlib stream');
+            reserve(matchLength);
+            // byte by byte, the match may overlap what it copies
+            for (let index = 0; index < matchLength; index++, length++) output[length] = output[length - distance];
+        }
+    }
+    reader.align();
+    let checksum = 0;
+    for (let index = 0; index < 4; index++) checksum = (checksum << 8) | reader.read(8);
+    if ((checksum >>> 0) != adler32(output.subarray(0, length))) throw new Error('zlib checksum mismatch');
+    return output.length == length ? output : output.slice(0, length);
 }
 
 /***/ }),
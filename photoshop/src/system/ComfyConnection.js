@@ -3,6 +3,14 @@ import get_layers from "./events/get_layers";
 import send_images from "./events/send_images";
 import get_image from "./events/get_image";
 import get_active_history_state_id from "./events/get_active_history_state_id";
+import { SUPPORTED_CODECS } from "./codecs";
+import { SUPPORTED_MESSAGE_CODECS, encodeMessage, decodeMessage } from "./msgpack";
+
+const PROTOCOL_VERSION = 2;
+const PROTOCOL_FEATURES = ['binary_push', 'batch', 'layer_delta', 'bulk_images', 'tile_delta', 'resume'];
+const BINARY_FRAME_IMAGE = 1;
+const BINARY_FRAME_IMAGE_BUNDLE = 2;
+const BINARY_FRAME_MESSAGE = 3;
 
 export default class ComfyConnection {
     static instance = null;
@@ -31,6 +39,18 @@ export default class ComfyConnection {
     }
 
     comfyURL = '';
+    // features accepted by the server in the handshake
+    features = new Set();
+    // image encoding picked by the server in the handshake
+    codec = 'png';
+    // encoding of the messages after the handshake, json text frames or msgpack binary frames
+    messageCodec = 'json';
+    // binary frames received before their call, keyed by call_id then index
+    binaryFrames = {};
+    // token from the handshake, reconnecting with it lets the server reuse what it knows about this photoshop
+    session = '';
+    // set by disconnect, no reconnect after that
+    closed = false;
     constructor(comfyURL, userId) {
         ComfyConnection.instance = this;
         if (!comfyURL) {
@@ -50,20 +70,87 @@ export default class ComfyConnection {
             return;
         }
         try {
-            this.socket.send(JSON.stringify({
+            this.sendMessage({
                 push_data: data,
-            }));
+            });
         } catch (e) { console.error(e); }
     }
     reconnectTimer = null;
 
+    scheduleReconnect() {
+        if (this.closed || this.reconnectTimer) return;
+        this.reconnectTimer = setTimeout(() => {
+            console.log(`Reconnecting to ${this.comfyURL.replace('http://', 'ws://').replace(/\/*$/, '')}`);
+            this.connect();
+        }, 3000);
+    }
+
+    supports(feature) {
+        return this.features.has(feature);
+    }
+
+    sendMessage(payload) {
+        if (this.messageCodec != 'msgpack') {
+            this.socket.send(JSON.stringify(payload));
+            return;
+        }
+        // same layout as the image frames, with an empty header
+        const header = '{}';
+        const body = encodeMessage(payload);
+        const frame = new Uint8Array(5 + header.length + body.length);
+        const view = new DataView(frame.buffer);
+        view.setUint8(0, BINARY_FRAME_MESSAGE);
+        view.setUint32(1, header.length);
+        for (let index = 0; index < header.length; index++) frame[5 + index] = header.charCodeAt(index);
+        frame.set(body, 5 + header.length);
+        this.socket.send(frame.buffer);
+    }
+
+    decodeMessageFrame(data) {
+        const headerLength = new DataView(data).getUint32(1);
+        return decodeMessage(new Uint8Array(data, 5 + headerLength));
+    }
+
+    takeBinaryFrames(callId) {
+        const frames = this.binaryFrames[callId] || [];
+        delete this.binaryFrames[callId];
+        return frames;
+    }
+
+    onBinaryMessage(data) {
+        const view = new DataView(data);
+        const kind = view.getUint8(0);
+        const headerLength = view.getUint32(1);
+        const headerStart = 5;
+        // header is plain ascii json
+        const header = JSON.parse(String.fromCharCode.apply(null, new Uint8Array(data, headerStart, headerLength)));
+        const payload = new Uint8Array(data, headerStart + headerLength);
+        const frames = this.binaryFrames[header.call_id] = this.binaryFrames[header.call_id] || [];
+        if (kind == BINARY_FRAME_IMAGE) {
+            frames[header.index] = { header, data: payload };
+        } else if (kind == BINARY_FRAME_IMAGE_BUNDLE) {
+            // views into the bundle, no copy, big batches come in several bundles
+            const first = header.first || 0;
+            header.frames.forEach((frameHeader, index) => {
+                frames[first + index] = { header: frameHeader, data: payload.subarray(frameHeader.offset, frameHeader.offset + frameHeader.length) };
+            });
+        } else {
+            console.error('Unknown binary frame kind', kind);
+        }
+    }
+
     connect() {
         if (this.reconnectTimer) {
             clearTimeout(this.reconnectTimer);
             this.reconnectTimer = null;
         }
         // Create WebSocket connection.
-        const socket = this.socket = new WebSocket(this.comfyURL.replace('http://', 'ws://') + '/photoshop_instance?version=1&user_id=' + this.userId);
+        const socket = this.socket = new WebSocket(this.comfyURL.replace('http://', 'ws://') + '/photoshop_instance?version=' + PROTOCOL_VERSION + '&features=' + PROTOCOL_FEATURES.join(',') + '&codecs=' + SUPPORTED_CODECS.join(',') + '&message_codecs=' + SUPPORTED_MESSAGE_CODECS.join(',') + '&user_id=' + this.userId + (this.session ? '&session=' + encodeURIComponent(this.session) : ''));
+        socket.binaryType = 'arraybuffer';
+        this.features = new Set();
+        this.codec = 'png';
+        this.messageCodec = 'json';
+        this.binaryFrames = {};
 
         socket.addEventListener("open", (ev) => {
             storage.secureStorage.setItem('comfyURL', this.comfyURL);
@@ -78,55 +165,91 @@ export default class ComfyConnection {
             console.log("Connection close", event.reason);
             this._isConnected = false;
             ComfyConnection._callConnectStateChange();
+            // the server drops peers that miss heartbeats, come back with the session
+            if (this.socket === socket) this.scheduleReconnect();
         });
 
         socket.addEventListener('error', (event) => {
             console.log("Connection error", event);
-            this.reconnectTimer = setTimeout(() => {
-                console.log(`Reconnecting to ${this.comfyURL.replace('http://', 'ws://').replace(/\/*$/, '')}`);
-                this.connect();
-            }, 3000);
+            if (this.socket === socket) this.scheduleReconnect();
         });
     }
 
     disconnect() {
+        this.closed = true;
+        if (this.reconnectTimer) {
+            clearTimeout(this.reconnectTimer);
+            this.reconnectTimer = null;
+        }
         if (this.socket) {
             this.socket.close();
         }
     }
 
+    async runAction(payload) {
+        if (payload.action == 'get_layers') {
+            return await get_layers.call(this, payload);
+        } else if (payload.action == 'send_images') {
+            return await send_images.call(this, payload);
+        } else if (payload.action == 'get_image') {
+            return await get_image.call(this, payload);
+        } else if (payload.action == 'get_active_history_state_id') {
+            return await get_active_history_state_id.call(this, payload);
+        }
+        return {};
+    }
+
+    // run calls in order, one failing call doesn't stop the rest
+    async runBatch(payload) {
+        const results = [];
+        for (const call of payload.params.calls) {
+            try {
+                results.push({ result: await this.runAction({ call_id: payload.call_id, action: call.action, params: call.params, received_at: payload.received_at }) });
+            } catch (e) {
+                console.error("runBatch", call.action, e);
+                results.push({ error: e.message });
+            }
+        }
+        return { results };
+    }
+
     async onMessage(event) {
-        console.log("Message from comfy ", event.data);
+        const isBinary = event.data instanceof ArrayBuffer;
+        if (isBinary && new DataView(event.data).getUint8(0) != BINARY_FRAME_MESSAGE) {
+            this.onBinaryMessage(event.data);
+            return;
+        }
+        if (!isBinary) console.log("Message from comfy ", event.data);
         let payload;
         try {
             let result = {};
-            payload = JSON.parse(event.data);
-            if (payload.error){
+            // decoded once, whatever the encoding
+            payload = isBinary ? this.decodeMessageFrame(event.data) : JSON.parse(event.data);
+            payload.received_at = Date.now();
+            if (payload.handshake) {
+                this.features = new Set(payload.handshake.features || []);
+                this.codec = payload.handshake.codec || 'png';
+                this.session = payload.handshake.session || '';
+                this.messageCodec = payload.handshake.message_codec || 'json';
+                return;
+            } else if (payload.error){
                 throw new Error(payload.error);
-            } else if (payload.action == 'get_layers') {
-                result = await get_layers.call(this, payload);
-            } else if (payload.action == 'send_images') {
-                result = await send_images.call(this, payload);
-            } else if (payload.action == 'get_image') {
-                result = await get_image.call(this, payload);
-            } else if (payload.action == 'get_active_history_state_id') {
-                result = await get_active_history_state_id.call(this, payload);
+            } else if (payload.action == 'batch') {
+                result = await this.runBatch(payload);
+            } else {
+                result = await this.runAction(payload);
             }
-            this.socket.send(
-                JSON.stringify({
-                    call_id: payload.call_id,
-                    result: result
-                })
-            );
+            this.sendMessage({
+                call_id: payload.call_id,
+                result: result
+            });
         } catch (e) {
             console.error("onMessage", e);
             if (payload && payload.call_id){
-                this.socket.send(
-                    JSON.stringify({
-                        call_id: payload.call_id,
-                        error: e.message
-                    })
-                );
+                this.sendMessage({
+                    call_id: payload.call_id,
+                    error: e.message
+                });
             }
         }
     }
@@ -13,7 +13,8 @@ class HistoryChecker {
         HistoryChecker.instance = this;
         this.lastCheckId = {};
         this.changeCallback = null;
-        action.addNotificationListener(["historyStateChanged"], () => {
+        // opening or closing a document changes the document list the comfyui tabs show
+        action.addNotificationListener(["historyStateChanged", "open", "close", "newDocument"], () => {
             this.checkHistoryState();
         });
     }
@@ -32,6 +33,13 @@ class HistoryChecker {
     checkHistoryState() {
         console.log('checkHistoryState', app.documents?.length)
         let changedDocIdToHistoryId = {};
+        const openDocIds = new Set((app.documents || []).map(doc => String(doc.id)));
+        Object.keys(this.lastCheckId).forEach(docId => {
+            if (openDocIds.has(docId)) return;
+            // closed, null tells the server there's no pushed state for it anymore
+            changedDocIdToHistoryId[docId] = null;
+            delete this.lastCheckId[docId];
+        });
         app.documents?.forEach(doc => {
             const historyState = getLastHistoryState(doc);
             console.log('checkHistoryState historyState:', historyState?.id, 'doc.id:', historyState?.docId)
@@ -0,0 +1,19 @@
+import { deflate, inflate } from "./zlib";
+
+// image encodings this plugin understands, the server picks one per connection in the handshake
+export const SUPPORTED_CODECS = ['zlib', 'raw', 'png'];
+
+// raw and zlib carry bare rgba rows and their size travels next to them, png goes through jimp
+export function isRGBACodec(encoding) {
+    return encoding == 'raw' || encoding == 'zlib';
+}
+
+export function compressRGBA(data, encoding) {
+    if (encoding == 'zlib') return deflate(data);
+    return data;
+}
+
+export function decompressRGBA(data, encoding) {
+    if (encoding == 'zlib') return inflate(data);
+    return data;
+}
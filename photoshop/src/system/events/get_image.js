@@ -1,17 +1,18 @@
 import { imaging } from "photoshop";
 import { executeAsModalUntilSuccess, findInAllSubLayer, unTrimImageData, findDocument } from '../util.js';
 import Jimp from "../library/jimp.min";
-import { SPECIAL_LAYER_NAME_TO_ID, SPECIAL_LAYER_USE_SELECTION } from "../util";
+import { SPECIAL_LAYER_NAME_TO_ID, SPECIAL_LAYER_USE_SELECTION, getLastHistoryState, createTimings } from "../util";
+import { isRGBACodec, compressRGBA } from "../codecs";
 
 function isLayerFolder(layer){
     return layer.layers && layer.layers.length > 0;
 }
 
-async function findLayer(layerID) {
+async function findLayer(targetDocument, layerID) {
     let layer;
     let isFolder = false;
     if (layerID <= 0) return [layer, isFolder];
-    layer = findInAllSubLayer(this.targetDocument, layerID)
+    layer = findInAllSubLayer(targetDocument, layerID)
     if (!layer) throw new Error(`Layer(id: ${layerID}) not found`);
     if (!isLayerFolder(layer)) return [layer, isFolder];
     // layer is folder
@@ -22,7 +23,7 @@ async function findLayer(layerID) {
 }
 
 // ps returns trimmed data so need padding
-function padAndTrimLayerDataToDesireBounds(layer, pixelDataFromAPI, desireBounds) {
+function padAndTrimLayerDataToDesireBounds(targetDocument, layer, pixelDataFromAPI, desireBounds) {
     if (pixelDataFromAPI.length == desireBounds.width * desireBounds.height * 4) {
         return pixelDataFromAPI;
     }
@@ -30,8 +31,8 @@ function padAndTrimLayerDataToDesireBounds(layer, pixelDataFromAPI, desireBounds
     let bounds = {
         left: 0,
         top: 0,
-        right: this.targetDocument.width,
-        bottom: this.targetDocument.height,
+        right: targetDocument.width,
+        bottom: targetDocument.height,
     }
     if (layer) bounds = layer.bounds;
     unTrimImageData(
@@ -43,9 +44,9 @@ function padAndTrimLayerDataToDesireBounds(layer, pixelDataFromAPI, desireBounds
     return pixelDataForReturn;
 }
 
-async function getPixelsDataHelper(layer, desireBounds) {
+async function getPixelsDataHelper(targetDocument, layer, desireBounds) {
     let options = {
-        documentID: this.targetDocument.id,
+        documentID: targetDocument.id,
         applyAlpha: false,
         sourceBounds: desireBounds,
     }
@@ -63,29 +64,29 @@ async function getPixelsDataHelper(layer, desireBounds) {
     return pixelDataFromAPI
 }
 
-async function getPixelsData(layer, desireBounds) {
+async function getPixelsData(targetDocument, layer, desireBounds) {
     // layer null = document data
     if (!layer) {
-        return await getPixelsDataHelper.call(this, null, desireBounds);
+        return await getPixelsDataHelper(targetDocument, null, desireBounds);
     }
     // normal layer
-    return await getPixelsDataHelper.call(this, layer, desireBounds);
+    return await getPixelsDataHelper(targetDocument, layer, desireBounds);
 }
 
 
-function getDesiredBounds(boundsLayerID) {
+function getDesiredBounds(targetDocument, boundsLayerID) {
     const docBounds = {
         left: 0, 
         top: 0, 
-        right: this.targetDocument.width, 
-        bottom: this.targetDocument.height,
-        width: this.targetDocument.width,
-        height: this.targetDocument.height
+        right: targetDocument.width, 
+        bottom: targetDocument.height,
+        width: targetDocument.width,
+        height: targetDocument.height
     };
     // use selection bounds
     if (boundsLayerID == SPECIAL_LAYER_NAME_TO_ID[SPECIAL_LAYER_USE_SELECTION]) {
         // if no selection use document bounds
-        const selectionBounds = this.targetDocument.selection?.bounds;
+        const selectionBounds = targetDocument.selection?.bounds;
         if (!selectionBounds) return docBounds;
         return {
             left: selectionBounds.left,
@@ -98,7 +99,7 @@ function getDesiredBounds(boundsLayerID) {
     }
     let boundsLayer;
     if (boundsLayerID > 0) {
-        boundsLayer = findInAllSubLayer(this.targetDocument, boundsLayerID)
+        boundsLayer = findInAllSubLayer(targetDocument, boundsLayerID)
         if (!boundsLayer) throw new Error(`Bounds layer(id: ${boundsLayerID}) not found`);
     }
     // null boundsLayer = document bounds
@@ -119,58 +120,159 @@ function getDesiredBounds(boundsLayerID) {
     return desireBounds
 }
 
+// two 32 bit fnv-1a lanes per tile, row major, edge tiles clipped to the image
+function hashTiles(pixels, width, height, tileSize) {
+    const aligned = pixels.byteOffset % 4 == 0 ? pixels : pixels.slice();
+    const words = new Uint32Array(aligned.buffer, aligned.byteOffset, width * height);
+    const tilesX = Math.ceil(width / tileSize);
+    const tilesY = Math.ceil(height / tileSize);
+    const hashes = [];
+    for (let tileY = 0; tileY < tilesY; tileY++) {
+        for (let tileX = 0; tileX < tilesX; tileX++) {
+            let hashA = 2166136261;
+            let hashB = 3735928559;
+            const right = Math.min(width, (tileX + 1) * tileSize);
+            const bottom = Math.min(height, (tileY + 1) * tileSize);
+            for (let y = tileY * tileSize; y < bottom; y++) {
+                for (let i = y * width + tileX * tileSize, end = y * width + right; i < end; i++) {
+                    hashA = Math.imul(hashA ^ words[i], 16777619);
+                    hashB = Math.imul(hashB ^ words[i], 2246822519);
+                }
+            }
+            hashes.push((hashA >>> 0).toString(16).padStart(8, '0') + (hashB >>> 0).toString(16).padStart(8, '0'));
+        }
+    }
+    return hashes;
+}
+
+// rgba rows of the given tiles back to back
+function collectTiles(pixels, width, height, tileSize, tiles) {
+    const tilesX = Math.ceil(width / tileSize);
+    const chunks = [];
+    let length = 0;
+    for (const index of tiles) {
+        const left = (index % tilesX) * tileSize;
+        const top = Math.floor(index / tilesX) * tileSize;
+        const right = Math.min(width, left + tileSize);
+        const bottom = Math.min(height, top + tileSize);
+        for (let y = top; y < bottom; y++) {
+            const row = pixels.subarray((y * width + left) * 4, (y * width + right) * 4);
+            chunks.push(row);
+            length += row.length;
+        }
+    }
+    const data = new Uint8Array(length);
+    let offset = 0;
+    for (const chunk of chunks) {
+        data.set(chunk, offset);
+        offset += chunk.length;
+    }
+    return data;
+}
+
 export default async function get_image(payload) {
     const documentID = payload.params.document_id;
     const layerID = payload.params.layer_id;
     const boundsLayerID = payload.params.use_layer_bounds;
+    // in memory upload endpoint, falls back to comfy's /upload/image on older servers
+    const uploadURL = payload.params.upload_url;
     let uploadName = 0;
+    let uploadKey = 0;
     let layerOpacity = 100;
-    this.targetDocument = undefined;
+    // per call, calls run concurrently and must not share the document
+    let targetDocument = undefined;
+    // the server keeps the pixels of the last fetch, only changed tiles are uploaded when its size still matches
+    const tileDelta = payload.params.tile_delta;
+    let tileResult = {};
+    // png unless the server negotiated an rgba encoding, tiles are always rgba
+    const encoding = payload.params.encoding || 'png';
+    const tileEncoding = isRGBACodec(encoding) ? encoding : 'raw';
+    let uploadEncoding = encoding;
+    let imageWidth = 0;
+    let imageHeight = 0;
+    const timings = createTimings(payload);
 
+    // pipelined with a history check, nothing to do if the document didn't change since the server's copy
+    const skipIfHistoryStateID = payload.params.skip_if_history_state_id;
+    if (skipIfHistoryStateID) {
+        const historyStateID = getLastHistoryState(findDocument(documentID))?.id;
+        if (historyStateID == skipIfHistoryStateID) {
+            return { skipped: true, history_state_id: historyStateID };
+        }
+    }
+
+    const modalStartTime = Date.now();
     await executeAsModalUntilSuccess(async (executionContext) => {
         let hostControl;
         let suspensionID;
         const startTime = Date.now();
+        timings.add('wait modal', modalStartTime);
         let layer;
         let isFolder = false;
         let activeLayers;
         try {
-            this.targetDocument = findDocument(documentID);
-            console.log("targetDocument: ", this.targetDocument, this.targetDocument?.id, this.targetDocument?.name)
-            activeLayers = this.targetDocument.activeLayers;
+            targetDocument = findDocument(documentID);
+            console.log("targetDocument: ", targetDocument, targetDocument?.id, targetDocument?.name)
+            activeLayers = targetDocument.activeLayers;
             hostControl = executionContext.hostControl;
             suspensionID = await hostControl.suspendHistory({
-                "documentID": this.targetDocument.id,
+                "documentID": targetDocument.id,
                 "name": "Image To ComfyUI"
             });
-            [layer, isFolder] = await findLayer.call(this, layerID);
+            [layer, isFolder] = await findLayer(targetDocument, layerID);
             layerOpacity = layer?.opacity ?? 100;
-            const desireBounds =  getDesiredBounds.call(this, boundsLayerID);
-            const pixelDataFromAPI = await getPixelsData.call(this, layer, desireBounds);
-            const pixelDataForReturn = padAndTrimLayerDataToDesireBounds.call(this, layer, pixelDataFromAPI, desireBounds);
+            const desireBounds =  getDesiredBounds(targetDocument, boundsLayerID);
+            imageWidth = desireBounds.width;
+            imageHeight = desireBounds.height;
+            let phaseStartTime = Date.now();
+            const pixelDataFromAPI = await getPixelsData(targetDocument, layer, desireBounds);
+            const pixelDataForReturn = padAndTrimLayerDataToDesireBounds(targetDocument, layer, pixelDataFromAPI, desireBounds);
             // console.log('getPixels', Date.now() - startTime, 'ms');
-            // log desire size
-            const image = await new Promise((resolve, reject) => {
-                new Jimp({
-                    data: pixelDataForReturn,
-                    width: desireBounds.width,
-                    height: desireBounds.height
-                }, (err, image) => {
-                    err ? reject(err) : resolve(image);
+            timings.add('getPixels', phaseStartTime);
+            phaseStartTime = Date.now();
+            let PhotoshopBlob;
+            if (tileDelta) {
+                const tileHashes = hashTiles(pixelDataForReturn, desireBounds.width, desireBounds.height, tileDelta.tile_size);
+                tileResult = { tile_hashes: tileHashes, tile_size: tileDelta.tile_size };
+                if (tileDelta.hashes && tileDelta.width == desireBounds.width && tileDelta.height == desireBounds.height) {
+                    const tiles = [];
+                    tileHashes.forEach((hash, index) => { if (hash !== tileDelta.hashes[index]) tiles.push(index); });
+                    tileResult.delta = true;
+                    tileResult.tiles = tiles;
+                    uploadEncoding = tileEncoding;
+                    if (tiles.length > 0) PhotoshopBlob = new Blob([compressRGBA(collectTiles(pixelDataForReturn, desireBounds.width, desireBounds.height, tileDelta.tile_size, tiles), tileEncoding)], { type: "application/octet-stream" });
+                }
+            }
+            if (!tileResult.delta && isRGBACodec(encoding)) {
+                PhotoshopBlob = new Blob([compressRGBA(pixelDataForReturn, encoding)], { type: "application/octet-stream" });
+            } else if (!tileResult.delta) {
+                // log desire size
+                const image = await new Promise((resolve, reject) => {
+                    new Jimp({
+                        data: pixelDataForReturn,
+                        width: desireBounds.width,
+                        height: desireBounds.height
+                    }, (err, image) => {
+                        err ? reject(err) : resolve(image);
+                    })
                 })
-            })
-            // console.log('new Jimp', Date.now() - startTime, 'ms');
-            image.quality(100);
-            // console.log('quality', Date.now() - startTime, 'ms');
-            const file = await image.getBufferAsync(Jimp.MIME_PNG);
-            // console.log('create pngfile', Date.now() - startTime, 'ms');
+                // console.log('new Jimp', Date.now() - startTime, 'ms');
+                image.quality(100);
+                // console.log('quality', Date.now() - startTime, 'ms');
+                const file = await image.getBufferAsync(Jimp.MIME_PNG);
+                // console.log('create pngfile', Date.now() - startTime, 'ms');
+                PhotoshopBlob = new Blob([file], { type: "image/png" });
+            }
+            timings.add(tileResult.delta ? 'encode tiles' : 'encode ' + encoding, phaseStartTime);
+            // nothing changed at all, nothing to upload
+            if (!PhotoshopBlob) return;
 
             const fd = new FormData();
-            const PhotoshopBlob = new Blob([file], { type: "image/png" });
             fd.append('image', PhotoshopBlob, "PhotoshopBlob.png")              ;
-            fd.append('overwrite', "true");
+            if (!uploadURL) fd.append('overwrite', "true");
             // console.log('start upload', Date.now() - startTime, 'ms');
-            const promise = fetch(this.comfyURL + '/upload/image', {
+            phaseStartTime = Date.now();
+            const promise = fetch(this.comfyURL + (uploadURL || '/upload/image'), {
                 method: 'POST',
                 body: fd,
             }).then(res => {
@@ -182,10 +284,16 @@ export default async function get_image(payload) {
             // console.log('finish upload', Date.now() - startTime, 'ms')
             const result = await promise
             // console.log('upload resulted', Date.now() - startTime, 'ms')
+            timings.add('upload', phaseStartTime);
 
             if (result.error) throw new Error(result.error);
-            if (!result.name) throw new Error('No upload_name')
-            uploadName = result.name
+            if (uploadURL) {
+                if (!result.upload_key) throw new Error('No upload_key')
+                uploadKey = result.upload_key
+            } else {
+                if (!result.name) throw new Error('No upload_name')
+                uploadName = result.name
+            }
 
         } catch (e) {
             console.error(e);
@@ -202,9 +310,16 @@ export default async function get_image(payload) {
         }
         
     }, { commandName: "get content of layer " + layerID })
+    timings.add('modal', modalStartTime);
 
-    return {
+    return Object.assign({
             upload_name: uploadName,
+            upload_key: uploadKey,
             layer_opacity: layerOpacity,
-        }
+            history_state_id: getLastHistoryState(targetDocument)?.id,
+            encoding: uploadEncoding,
+            width: imageWidth,
+            height: imageHeight,
+            timings: payload.params.trace ? timings.timings : undefined,
+        }, tileResult)
 }
\ No newline at end of file
@@ -1,14 +1,52 @@
-import { getAllSubLayer, SPECIAL_DOCUMENT_USE_ACTIVE, SPECIAL_DOCUMENT_TO_ID } from "../util";
+import { getAllSubLayer, getLastHistoryState, SPECIAL_DOCUMENT_USE_ACTIVE, SPECIAL_DOCUMENT_TO_ID } from "../util";
 import { app } from "photoshop";
 
+// last tree sent per document id, base of the next delta
+const sentLayerTrees = {};
+
+function getLayerTreeVersion(doc) {
+    return doc.activeHistoryState?.id || getLastHistoryState(doc)?.id || 0;
+}
+
+function getLayerTree(doc, knownVersions) {
+    const version = getLayerTreeVersion(doc);
+    const knownVersion = knownVersions[doc.id];
+    if (version && knownVersion == version) {
+        return { id: doc.id, version, unchanged: true };
+    }
+    const layers = getAllSubLayer(doc);
+    const sentLayerTree = sentLayerTrees[doc.id];
+    if (version) sentLayerTrees[doc.id] = { version, layers };
+    if (!version || !knownVersion || !sentLayerTree || sentLayerTree.version != knownVersion) {
+        return { id: doc.id, version, layers };
+    }
+    // only new or renamed layers are sent with their names, the rest by id
+    const sentNames = {};
+    sentLayerTree.layers.forEach(layer => { sentNames[layer.id] = layer.name; });
+    return {
+        id: doc.id,
+        version,
+        base_version: knownVersion,
+        order: layers.map(layer => layer.id),
+        changed: layers.filter(layer => sentNames[layer.id] !== layer.name),
+    };
+}
+
 export default async function get_layers(payload) {
     const documentIdsToSyncLayers = payload.params.document_ids_to_sync_layers
     const documents = app.documents;
     const allDocumentInfo = app.documents.map(doc => ({ name: doc.name, id: doc.id }));
-    const targetDocuments = documents.filter(doc => documentIdsToSyncLayers.includes(doc.id));
-    const allLayers = targetDocuments.map(doc => ({id: doc.id, layers: getAllSubLayer(doc)}));
-    if (app.activeDocument) {
-        allLayers.push({id: SPECIAL_DOCUMENT_TO_ID[SPECIAL_DOCUMENT_USE_ACTIVE], layers: getAllSubLayer(app.activeDocument)});
+    // older servers don't send known_versions and get full trees
+    if (!payload.params.known_versions) {
+        const targetDocuments = documents.filter(doc => documentIdsToSyncLayers.includes(doc.id));
+        const allLayers = targetDocuments.map(doc => ({id: doc.id, layers: getAllSubLayer(doc)}));
+        if (app.activeDocument) {
+            allLayers.push({id: SPECIAL_DOCUMENT_TO_ID[SPECIAL_DOCUMENT_USE_ACTIVE], layers: getAllSubLayer(app.activeDocument)});
+        }
+        return { layers: allLayers, documents: allDocumentInfo };
     }
-    return { layers: allLayers, documents: allDocumentInfo };
-}
\ No newline at end of file
+    const knownVersions = payload.params.known_versions;
+    const targetDocuments = documents.filter(doc => documentIdsToSyncLayers.includes(doc.id) || doc.id == app.activeDocument?.id);
+    const allLayers = targetDocuments.map(doc => getLayerTree(doc, knownVersions));
+    return { layers: allLayers, documents: allDocumentInfo, active_document_id: app.activeDocument?.id };
+}
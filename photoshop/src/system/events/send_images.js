@@ -1,6 +1,7 @@
 import { imaging } from "photoshop";
-import { executeAsModalUntilSuccess, findDocument } from '../util.js';
+import { executeAsModalUntilSuccess, findDocument, getLastHistoryState, createTimings } from '../util.js';
 import Jimp from "../library/jimp.min";
+import { isRGBACodec, decompressRGBA } from '../codecs.js';
 
 import { SPECIAL_LAYER_NAME_TO_ID, SPECIAL_LAYER_NEW_LAYER } from '../util.js';
 
@@ -26,11 +27,98 @@ function autocrop(jimp) {
     return jimp;
 }
 
+function jimpFromRGBA(data, width, height) {
+    return new Promise((resolve, reject) => {
+        new Jimp({ data, width, height }, (err, image) => {
+            err ? reject(err) : resolve(image);
+        })
+    })
+}
+
+// encoding and crop come with the call, rgba encodings need the crop's size
+async function readImage(imageId, binaryFrame, encoding, crop) {
+    if (!binaryFrame) {
+        const url = this.comfyURL + '/finished_images?id=' + imageId;
+        if (!isRGBACodec(encoding)) return await Jimp.read(url);
+        const res = await fetch(url);
+        if (res.status != 200) throw new Error('HTTP ' + res.status);
+        if (res.headers.get('content-type')?.includes('json')) throw new Error((await res.json()).error);
+        const data = decompressRGBA(new Uint8Array(await res.arrayBuffer()), encoding);
+        return await jimpFromRGBA(data, crop.width, crop.height);
+    }
+    // rgba pushed over the websocket before the call
+    return await jimpFromRGBA(decompressRGBA(binaryFrame.data, binaryFrame.header.encoding), binaryFrame.header.width, binaryFrame.header.height);
+}
+
+// crop: set when the server already cropped the image to its non transparent pixels
+async function placeImage(targetDocument, layerId, imageIds, imageId, jimp, crop) {
+    let layer;
+    let existingLayerName;
+    let newLayerName;
+    if (layerId && layerId != SPECIAL_LAYER_NAME_TO_ID[SPECIAL_LAYER_NEW_LAYER]) {
+        layer = await targetDocument.layers.find(l => l.id == layerId)
+        // deal with multiple images
+        let imageIndexSuffix = ""
+        console.log("imageIds.length: ", imageIds.length)
+        if (imageIds.length > 1){
+            const index = imageIds.indexOf(imageId)
+            console.log("imageIds.index: ", index)
+            if (index > 0)
+                imageIndexSuffix = ` ${index}`
+        }
+        if (imageIndexSuffix != "" && layer != null){
+            const layerName = layer?.name;
+            existingLayerName = layerName + imageIndexSuffix
+            console.log("existingLayerName: ", existingLayerName)
+            layer = await targetDocument.layers.find(l => l.name == existingLayerName)
+        }
+    }
+    // deal with new layer or id/name not found layer
+    if (!layer) {
+        newLayerName = existingLayerName ?? 'Comfy Images ' + imageId
+        console.log("newLayerName: ", newLayerName)
+        layer = await targetDocument.createLayer("pixel", {
+            name: newLayerName
+        })
+    }
+    if (!crop) autocrop(jimp)
+    let putPixelsOptions = {
+        layerID: layer.id,
+        imageData: await imaging.createImageDataFromBuffer(
+            jimp.bitmap.data,
+            {
+                width: jimp.bitmap.width,
+                height: jimp.bitmap.height,
+                components: 4,
+                colorSpace: "RGB"
+            }
+        ),
+        replace: true,
+    }
+    if (!newLayerName) {
+        let bounds = layer.bounds
+        if (bounds.width != jimp.bitmap.width || bounds.height != jimp.bitmap.height) {
+            let centerBounds = {}
+            centerBounds.left = bounds.left + (bounds.width - jimp.bitmap.width) / 2
+            centerBounds.top = bounds.top + (bounds.height - jimp.bitmap.height) / 2
+            centerBounds.right = bounds.left + jimp.bitmap.width
+            centerBounds.bottom = bounds.top + jimp.bitmap.height
+            centerBounds.width = jimp.bitmap.width
+            centerBounds.height = jimp.bitmap.height
+            bounds = centerBounds
+        }
+        putPixelsOptions.targetBounds = bounds
+    }
+    await imaging.putPixels(putPixelsOptions)
+}
+
 export default async function send_images(payload) {
     const documentId = payload.params.document_id
     const imageIds = payload.params.image_ids
     const layerId = payload.params.layer_id
+    const binaryFrames = payload.params.binary ? this.takeBinaryFrames(payload.call_id) : [];
     let targetDocument = undefined;
+    const timings = createTimings(payload);
     console.log("send_images layerId: ", layerId)
     try {
         targetDocument = findDocument(documentId);
@@ -38,70 +126,32 @@ export default async function send_images(payload) {
         console.error(e.message)
         throw e;
     }
-    await Promise.all(
-        imageIds.map(async imageId => {
-            let layer;
-            let existingLayerName;
-            let newLayerName;
-            await executeAsModalUntilSuccess(async () => {
-                if (layerId && layerId != SPECIAL_LAYER_NAME_TO_ID[SPECIAL_LAYER_NEW_LAYER]) {
-                    layer = await targetDocument.layers.find(l => l.id == layerId)
-                    // deal with multiple images
-                    let imageIndexSuffix = ""
-                    console.log("imageIds.length: ", imageIds.length)
-                    if (imageIds.length > 1){
-                        index = imageIds.indexOf(imageId)
-                        console.log("imageIds.index: ", index)
-                        if (index > 0)
-                            imageIndexSuffix = ` ${index}`
-                    }
-                    if (imageIndexSuffix != "" && layer != null){
-                        const layerName = layer?.name;
-                        existingLayerName = layerName + imageIndexSuffix
-                        console.log("existingLayerName: ", existingLayerName)
-                        layer = await targetDocument.layers.find(l => l.name == existingLayerName)
-                    }
-                }
-                // deal with new layer or id/name not found layer
-                if (!layer) {
-                    newLayerName = existingLayerName ?? 'Comfy Images ' + imageId
-                    console.log("newLayerName: ", newLayerName)
-                    layer = await targetDocument.createLayer("pixel", {
-                        name: newLayerName
-                    })
-                }
-                const jimp = (await Jimp.read(this.comfyURL + '/finished_images?id=' + imageId))
-                autocrop(jimp)
-                let putPixelsOptions = {
-                    layerID: layer.id,
-                    imageData: await imaging.createImageDataFromBuffer(
-                        jimp.bitmap.data,
-                        {
-                            width: jimp.bitmap.width,
-                            height: jimp.bitmap.height,
-                            components: 4,
-                            colorSpace: "RGB"
-                        }
-                    ),
-                    replace: true,
-                }
-                if (!newLayerName) {
-                    let bounds = layer.bounds
-                    if (bounds.width != jimp.bitmap.width || bounds.height != jimp.bitmap.height) {
-                        let centerBounds = {}
-                        centerBounds.left = bounds.left + (bounds.width - jimp.bitmap.width) / 2
-                        centerBounds.top = bounds.top + (bounds.height - jimp.bitmap.height) / 2
-                        centerBounds.right = bounds.left + jimp.bitmap.width
-                        centerBounds.bottom = bounds.top + jimp.bitmap.height
-                        centerBounds.width = jimp.bitmap.width
-                        centerBounds.height = jimp.bitmap.height
-                        bounds = centerBounds
-                    }
-                    putPixelsOptions.targetBounds = bounds
-                }
-                await imaging.putPixels(putPixelsOptions)
-            })
+    if (payload.params.binary) {
+        // every pixel is already here, place the whole batch in one modal session
+        let phaseStartTime = Date.now();
+        const jimps = await Promise.all(imageIds.map((imageId, index) => readImage.call(this, imageId, binaryFrames[index])));
+        timings.add('read images', phaseStartTime);
+        phaseStartTime = Date.now();
+        await executeAsModalUntilSuccess(async () => {
+            for (let index = 0; index < imageIds.length; index++) {
+                await placeImage(targetDocument, layerId, imageIds, imageIds[index], jimps[index], binaryFrames[index]?.header.crop);
+            }
         })
-    )
-    return {};
+        timings.add('place images', phaseStartTime);
+    } else {
+        const phaseStartTime = Date.now();
+        await Promise.all(
+            imageIds.map(async (imageId, index) => {
+                await executeAsModalUntilSuccess(async () => {
+                    const jimp = await readImage.call(this, imageId, null, payload.params.encoding, payload.params.crops?.[index])
+                    await placeImage(targetDocument, layerId, imageIds, imageId, jimp, payload.params.crops?.[index]);
+                })
+            })
+        )
+        timings.add('read and place images', phaseStartTime);
+    }
+    return {
+        history_state_id: getLastHistoryState(targetDocument)?.id,
+        timings: payload.params.trace ? timings.timings : undefined,
+    };
 }
\ No newline at end of file
@@ -0,0 +1,208 @@
+// minimal messagepack for the websocket messages: nil, booleans, numbers, strings, binary, arrays and maps
+// numbers that aren't 32 bit integers are sent as float64, decoding understands every format the server's msgpack writes
+
+// message encodings this plugin understands, the server picks one per connection in the handshake
+export const SUPPORTED_MESSAGE_CODECS = ['msgpack', 'json'];
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+class Writer {
+    constructor() {
+        this.buffer = new Uint8Array(1024);
+        this.view = new DataView(this.buffer.buffer);
+        this.length = 0;
+    }
+
+    reserve(size) {
+        if (this.length + size <= this.buffer.length) return;
+        let capacity = this.buffer.length * 2;
+        while (capacity < this.length + size) capacity *= 2;
+        const buffer = new Uint8Array(capacity);
+        buffer.set(this.buffer.subarray(0, this.length));
+        this.buffer = buffer;
+        this.view = new DataView(buffer.buffer);
+    }
+
+    uint8(value) {
+        this.reserve(1);
+        this.view.setUint8(this.length, value);
+        this.length += 1;
+    }
+
+    uint16(value) {
+        this.reserve(2);
+        this.view.setUint16(this.length, value);
+        this.length += 2;
+    }
+
+    uint32(value) {
+        this.reserve(4);
+        this.view.setUint32(this.length, value);
+        this.length += 4;
+    }
+
+    int32(value) {
+        this.reserve(4);
+        this.view.setInt32(this.length, value);
+        this.length += 4;
+    }
+
+    float64(value) {
+        this.reserve(8);
+        this.view.setFloat64(this.length, value);
+        this.length += 8;
+    }
+
+    bytes(data) {
+        this.reserve(data.length);
+        this.buffer.set(data, this.length);
+        this.length += data.length;
+    }
+
+    // type byte plus a length fitting 8, 16 or 32 bits
+    header(type8, type16, type32, length) {
+        if (type8 !== null && length < 0x100) {
+            this.uint8(type8);
+            this.uint8(length);
+        } else if (length < 0x10000) {
+            this.uint8(type16);
+            this.uint16(length);
+        } else {
+            this.uint8(type32);
+            this.uint32(length);
+        }
+    }
+
+    value(value) {
+        if (value === null || value === undefined) {
+            this.uint8(0xc0);
+        } else if (value === false) {
+            this.uint8(0xc2);
+        } else if (value === true) {
+            this.uint8(0xc3);
+        } else if (typeof value == 'number') {
+            this.number(value);
+        } else if (typeof value == 'string') {
+            const data = textEncoder.encode(value);
+            if (data.length < 32) this.uint8(0xa0 | data.length);
+            else this.header(0xd9, 0xda, 0xdb, data.length);
+            this.bytes(data);
+        } else if (value instanceof Uint8Array) {
+            this.header(0xc4, 0xc5, 0xc6, value.length);
+            this.bytes(value);
+        } else if (Array.isArray(value)) {
+            if (value.length < 16) this.uint8(0x90 | value.length);
+            else this.header(null, 0xdc, 0xdd, value.length);
+            value.forEach(item => this.value(item));
+        } else if (typeof value.toJSON == 'function') {
+            this.value(value.toJSON());
+        } else {
+            // like JSON.stringify, undefined members are left out
+            const keys = Object.keys(value).filter(key => value[key] !== undefined);
+            if (keys.length < 16) this.uint8(0x80 | keys.length);
+            else this.header(null, 0xde, 0xdf, keys.length);
+            keys.forEach(key => {
+                this.value(key);
+                this.value(value[key]);
+            });
+        }
+    }
+
+    number(value) {
+        if (Number.isInteger(value) && value >= -0x80000000 && value <= 0xffffffff) {
+            if (value >= 0 && value < 0x80) {
+                this.uint8(value);
+            } else if (value < 0 && value >= -32) {
+                this.uint8(value & 0xff);
+            } else if (value >= 0) {
+                this.uint8(0xce);
+                this.uint32(value);
+            } else {
+                this.uint8(0xd2);
+                this.int32(value);
+            }
+        } else {
+            this.uint8(0xcb);
+            this.float64(value);
+        }
+    }
+}
+
+export function encodeMessage(value) {
+    const writer = new Writer();
+    writer.value(value);
+    return writer.buffer.subarray(0, writer.length);
+}
+
+class Reader {
+    constructor(data) {
+        this.data = data;
+        this.view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+        this.offset = 0;
+    }
+
+    skip(size) {
+        const offset = this.offset;
+        this.offset += size;
+        return offset;
+    }
+
+    string(length) {
+        return textDecoder.decode(this.data.subarray(this.skip(length), this.offset));
+    }
+
+    array(length) {
+        const array = new Array(length);
+        for (let index = 0; index < length; index++) array[index] = this.value();
+        return array;
+    }
+
+    map(length) {
+        const map = {};
+        for (let index = 0; index < length; index++) {
+            const key = this.value();
+            map[key] = this.value();
+        }
+        return map;
+    }
+
+    value() {
+        const type = this.view.getUint8(this.skip(1));
+        if (type < 0x80) return type;
+        if (type < 0x90) return this.map(type & 0x0f);
+        if (type < 0xa0) return this.array(type & 0x0f);
+        if (type < 0xc0) return this.string(type & 0x1f);
+        if (type >= 0xe0) return type - 0x100;
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return this.data.slice(this.skip(this.view.getUint8(this.skip(1))), this.offset);
+            case 0xc5: return this.data.slice(this.skip(this.view.getUint16(this.skip(2))), this.offset);
+            case 0xc6: return this.data.slice(this.skip(this.view.getUint32(this.skip(4))), this.offset);
+            case 0xca: return this.view.getFloat32(this.skip(4));
+            case 0xcb: return this.view.getFloat64(this.skip(8));
+            case 0xcc: return this.view.getUint8(this.skip(1));
+            case 0xcd: return this.view.getUint16(this.skip(2));
+            case 0xce: return this.view.getUint32(this.skip(4));
+            case 0xcf: return Number(this.view.getBigUint64(this.skip(8)));
+            case 0xd0: return this.view.getInt8(this.skip(1));
+            case 0xd1: return this.view.getInt16(this.skip(2));
+            case 0xd2: return this.view.getInt32(this.skip(4));
+            case 0xd3: return Number(this.view.getBigInt64(this.skip(8)));
+            case 0xd9: return this.string(this.view.getUint8(this.skip(1)));
+            case 0xda: return this.string(this.view.getUint16(this.skip(2)));
+            case 0xdb: return this.string(this.view.getUint32(this.skip(4)));
+            case 0xdc: return this.array(this.view.getUint16(this.skip(2)));
+            case 0xdd: return this.array(this.view.getUint32(this.skip(4)));
+            case 0xde: return this.map(this.view.getUint16(this.skip(2)));
+            case 0xdf: return this.map(this.view.getUint32(this.skip(4)));
+        }
+        throw new Error('Unsupported msgpack type 0x' + type.toString(16));
+    }
+}
+
+export function decodeMessage(data) {
+    return new Reader(data).value();
+}
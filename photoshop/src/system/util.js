@@ -132,3 +132,16 @@ export async function executeAsModalUntilSuccess(...args) {
     }
     return result;
 }
+
+// phase timings returned to the server when it traces the call, in ms from when the call arrived
+export function createTimings(payload) {
+    const enabled = payload.params.trace;
+    const callStart = payload.received_at || Date.now();
+    const timings = [];
+    return {
+        timings,
+        add(name, start) {
+            if (enabled) timings.push({ name, start: start - callStart, duration: Date.now() - start });
+        },
+    };
+}
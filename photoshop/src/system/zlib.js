@@ -0,0 +1,438 @@
+// minimal zlib streams for the 'zlib' pixel encoding, read and written by python's zlib on the server
+// deflate matches greedily against one candidate per hash like zlib's fastest level, every block gets its own huffman codes
+
+const LENGTH_BASE = [3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 15, 17, 19, 23, 27, 31, 35, 43, 51, 59, 67, 83, 99, 115, 131, 163, 195, 227, 258];
+const LENGTH_EXTRA = [0, 0, 0, 0, 0, 0, 0, 0, 1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5, 0];
+const DISTANCE_BASE = [1, 2, 3, 4, 5, 7, 9, 13, 17, 25, 33, 49, 65, 97, 129, 193, 257, 385, 513, 769, 1025, 1537, 2049, 3073, 4097, 6145, 8193, 12289, 16385, 24577];
+const DISTANCE_EXTRA = [0, 0, 0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6, 7, 7, 8, 8, 9, 9, 10, 10, 11, 11, 12, 12, 13, 13];
+// order the lengths of the code length code are stored in
+const CODE_LENGTH_ORDER = [16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15];
+
+const WINDOW_SIZE = 32768;
+const HASH_BITS = 15;
+const MIN_MATCH = 3;
+const MAX_MATCH = 258;
+// matches up to this long also index the positions they cover
+const MAX_INSERT_LENGTH = 4;
+const BLOCK_SYMBOLS = 16384;
+
+// length and distance to their code
+const LENGTH_CODE = new Uint8Array(MAX_MATCH + 1);
+for (let code = 0; code < LENGTH_BASE.length; code++) {
+    for (let length = LENGTH_BASE[code]; length < LENGTH_BASE[code] + (1 << LENGTH_EXTRA[code]) && length <= MAX_MATCH; length++) LENGTH_CODE[length] = code;
+}
+const DISTANCE_CODE = new Uint8Array(WINDOW_SIZE + 1);
+for (let code = 0; code < DISTANCE_BASE.length; code++) {
+    for (let distance = DISTANCE_BASE[code]; distance < DISTANCE_BASE[code] + (1 << DISTANCE_EXTRA[code]); distance++) DISTANCE_CODE[distance] = code;
+}
+
+function adler32(data) {
+    let a = 1;
+    let b = 0;
+    for (let index = 0; index < data.length;) {
+        // the sums can't overflow before the modulo within 5552 bytes
+        const end = Math.min(index + 5552, data.length);
+        for (; index < end; index++) {
+            a += data[index];
+            b += a;
+        }
+        a %= 65521;
+        b %= 65521;
+    }
+    return ((b << 16) | a) >>> 0;
+}
+
+function reverseBits(code, length) {
+    let reversed = 0;
+    for (let bit = 0; bit < length; bit++) {
+        reversed = (reversed << 1) | (code & 1);
+        code >>= 1;
+    }
+    return reversed;
+}
+
+// codes are stored with their first bit lowest, the way the stream is read
+function canonicalCodes(lengths) {
+    const counts = new Uint16Array(16);
+    for (const length of lengths) counts[length]++;
+    counts[0] = 0;
+    const next = new Uint16Array(16);
+    for (let length = 1, code = 0; length < 16; length++) {
+        code = (code + counts[length - 1]) << 1;
+        next[length] = code;
+    }
+    const codes = new Uint16Array(lengths.length);
+    for (let symbol = 0; symbol < lengths.length; symbol++) {
+        if (lengths[symbol]) codes[symbol] = reverseBits(next[lengths[symbol]]++, lengths[symbol]);
+    }
+    return codes;
+}
+
+// depth of every leaf in the huffman tree of the weights
+function treeDepths(weights) {
+    const count = weights.length;
+    const order = weights.map((_, index) => index).sort((a, b) => weights[a] - weights[b]);
+    const weight = weights.slice();
+    const parent = new Int32Array(2 * count - 1);
+    // merged nodes come out in increasing weight, so they queue up behind the sorted leaves
+    let leaf = 0;
+    let node = count;
+    const lightest = () => (leaf < count && (node >= weight.length || weights[order[leaf]] <= weight[node])) ? order[leaf++] : node++;
+    while (weight.length < 2 * count - 1) {
+        const a = lightest();
+        const b = lightest();
+        parent[a] = parent[b] = weight.length;
+        weight.push(weight[a] + weight[b]);
+    }
+    const depths = new Int32Array(2 * count - 1);
+    for (let index = 2 * count - 3; index >= 0; index--) depths[index] = depths[parent[index]] + 1;
+    return depths.subarray(0, count);
+}
+
+// huffman code lengths of at most maxLength bits, at least two symbols get one so the code is complete
+function codeLengths(frequencies, maxLength) {
+    for (let symbol = 0, used = frequencies.filter(frequency => frequency > 0).length; used < 2; symbol++) {
+        if (frequencies[symbol] == 0) {
+            frequencies[symbol] = 1;
+            used++;
+        }
+    }
+    const symbols = [];
+    for (let symbol = 0; symbol < frequencies.length; symbol++) {
+        if (frequencies[symbol] > 0) symbols.push(symbol);
+    }
+    let weights = symbols.map(symbol => frequencies[symbol]);
+    const lengths = new Uint8Array(frequencies.length);
+    while (true) {
+        const depths = treeDepths(weights);
+        if (Math.max(...depths) <= maxLength) {
+            symbols.forEach((symbol, index) => lengths[symbol] = depths[index]);
+            return lengths;
+        }
+        // flatter weights give a shallower tree
+        weights = weights.map(weight => (weight + 1) >> 1);
+    }
+}
+
+class BitWriter {
+    constructor(capacity) {
+        this.buffer = new Uint8Array(Math.max(capacity, 1024));
+        this.length = 0;
+        this.bits = 0;
+        this.count = 0;
+    }
+
+    byte(value) {
+        if (this.length == this.buffer.length) {
+            const buffer = new Uint8Array(this.buffer.length * 2);
+            buffer.set(this.buffer);
+            this.buffer = buffer;
+        }
+        this.buffer[this.length++] = value;
+    }
+
+    // at most 16 bits at a time
+    write(value, count) {
+        this.bits |= value << this.count;
+        this.count += count;
+        while (this.count >= 8) {
+            this.byte(this.bits & 0xff);
+            this.bits >>>= 8;
+            this.count -= 8;
+        }
+    }
+
+    align() {
+        if (this.count > 0) this.byte(this.bits & 0xff);
+        this.bits = 0;
+        this.count = 0;
+    }
+}
+
+// code lengths run length coded with 16 (repeat previous), 17 and 18 (repeat zero), as [symbol, extra bits value]
+function runLengths(lengths) {
+    const runs = [];
+    for (let index = 0; index < lengths.length;) {
+        const length = lengths[index];
+        let run = 1;
+        while (index + run < lengths.length && lengths[index + run] == length) run++;
+        index += run;
+        if (length == 0) {
+            while (run >= 11) {
+                const repeat = Math.min(run, 138);
+                runs.push([18, repeat - 11]);
+                run -= repeat;
+            }
+            if (run >= 3) {
+                runs.push([17, run - 3]);
+                run = 0;
+            }
+        } else {
+            runs.push([length, 0]);
+            run--;
+            while (run >= 3) {
+                const repeat = Math.min(run, 6);
+                runs.push([16, repeat - 3]);
+                run -= repeat;
+            }
+        }
+        for (; run > 0; run--) runs.push([length, 0]);
+    }
+    return runs;
+}
+
+// literals have no distance, matches keep their length in literals
+function writeBlock(writer, literals, distances, count, last) {
+    const literalFrequencies = new Array(286).fill(0);
+    const distanceFrequencies = new Array(30).fill(0);
+    literalFrequencies[256] = 1;
+    for (let index = 0; index < count; index++) {
+        if (distances[index]) {
+            literalFrequencies[257 + LENGTH_CODE[literals[index]]]++;
+            distanceFrequencies[DISTANCE_CODE[distances[index]]]++;
+        } else {
+            literalFrequencies[literals[index]]++;
+        }
+    }
+    const literalLengths = codeLengths(literalFrequencies, 15);
+    const distanceLengths = codeLengths(distanceFrequencies, 15);
+    let literalCount = 286;
+    while (literalCount > 257 && literalLengths[literalCount - 1] == 0) literalCount--;
+    let distanceCount = 30;
+    while (distanceCount > 1 && distanceLengths[distanceCount - 1] == 0) distanceCount--;
+    const runs = runLengths([...literalLengths.subarray(0, literalCount), ...distanceLengths.subarray(0, distanceCount)]);
+    const runFrequencies = new Array(19).fill(0);
+    for (const [symbol] of runs) runFrequencies[symbol]++;
+    const runLengthLengths = codeLengths(runFrequencies, 7);
+    let runLengthCount = 19;
+    while (runLengthCount > 4 && runLengthLengths[CODE_LENGTH_ORDER[runLengthCount - 1]] == 0) runLengthCount--;
+
+    writer.write(last ? 1 : 0, 1);
+    writer.write(2, 2);
+    writer.write(literalCount - 257, 5);
+    writer.write(distanceCount - 1, 5);
+    writer.write(runLengthCount - 4, 4);
+    for (let index = 0; index < runLengthCount; index++) writer.write(runLengthLengths[CODE_LENGTH_ORDER[index]], 3);
+    const runLengthCodes = canonicalCodes(runLengthLengths);
+    for (const [symbol, extra] of runs) {
+        writer.write(runLengthCodes[symbol], runLengthLengths[symbol]);
+        if (symbol == 16) writer.write(extra, 2);
+        else if (symbol == 17) writer.write(extra, 3);
+        else if (symbol == 18) writer.write(extra, 7);
+    }
+
+    const literalCodes = canonicalCodes(literalLengths);
+    const distanceCodes = canonicalCodes(distanceLengths);
+    for (let index = 0; index < count; index++) {
+        const distance = distances[index];
+        if (!distance) {
+            writer.write(literalCodes[literals[index]], literalLengths[literals[index]]);
+            continue;
+        }
+        const length = literals[index];
+        const lengthCode = LENGTH_CODE[length];
+        writer.write(literalCodes[257 + lengthCode], literalLengths[257 + lengthCode]);
+        if (LENGTH_EXTRA[lengthCode]) writer.write(length - LENGTH_BASE[lengthCode], LENGTH_EXTRA[lengthCode]);
+        const distanceCode = DISTANCE_CODE[distance];
+        writer.write(distanceCodes[distanceCode], distanceLengths[distanceCode]);
+        if (DISTANCE_EXTRA[distanceCode]) writer.write(distance - DISTANCE_BASE[distanceCode], DISTANCE_EXTRA[distanceCode]);
+    }
+    writer.write(literalCodes[256], literalLengths[256]);
+}
+
+function hashAt(data, index) {
+    return ((data[index] << 10) ^ (data[index + 1] << 5) ^ data[index + 2]) & ((1 << HASH_BITS) - 1);
+}
+
+export function deflate(data) {
+    const writer = new BitWriter(data.length >> 2);
+    // deflate with a 32k window, no preset dictionary, fastest level
+    writer.byte(0x78);
+    writer.byte(0x01);
+    const head = new Int32Array(1 << HASH_BITS).fill(-1);
+    const literals = new Uint16Array(BLOCK_SYMBOLS);
+    const distances = new Uint16Array(BLOCK_SYMBOLS);
+    let count = 0;
+    for (let index = 0; index < data.length;) {
+        let length = 0;
+        if (index + MIN_MATCH <= data.length) {
+            const hash = hashAt(data, index);
+            const candidate = head[hash];
+            head[hash] = index;
+            if (candidate >= 0 && index - candidate <= WINDOW_SIZE) {
+                const maxLength = Math.min(MAX_MATCH, data.length - index);
+                while (length < maxLength && data[candidate + length] == data[index + length]) length++;
+                if (length >= MIN_MATCH) distances[count] = index - candidate;
+            }
+        }
+        if (length >= MIN_MATCH) {
+            literals[count++] = length;
+            if (length <= MAX_INSERT_LENGTH) {
+                for (let inserted = index + 1; inserted < index + length && inserted + MIN_MATCH <= data.length; inserted++) head[hashAt(data, inserted)] = inserted;
+            }
+            index += length;
+        } else {
+            distances[count] = 0;
+            literals[count++] = data[index++];
+        }
+        if (count == BLOCK_SYMBOLS) {
+            writeBlock(writer, literals, distances, count, false);
+            count = 0;
+        }
+    }
+    writeBlock(writer, literals, distances, count, true);
+    writer.align();
+    const checksum = adler32(data);
+    for (let shift = 24; shift >= 0; shift -= 8) writer.byte((checksum >>> shift) & 0xff);
+    return writer.buffer.slice(0, writer.length);
+}
+
+class BitReader {
+    constructor(data, offset) {
+        this.data = data;
+        this.offset = offset;
+        this.bits = 0;
+        this.count = 0;
+    }
+
+    // loads what is left when the stream ends earlier, decode checks the code fits
+    fill(count) {
+        while (this.count < count && this.offset < this.data.length) {
+            this.bits |= this.data[this.offset++] << this.count;
+            this.count += 8;
+        }
+    }
+
+    read(count) {
+        if (count == 0) return 0;
+        this.fill(count);
+        if (this.count < count) throw new Error('Truncated zlib stream');
+        const value = this.bits & ((1 << count) - 1);
+        this.bits >>>= count;
+        this.count -= count;
+        return value;
+    }
+
+    decode(table) {
+        this.fill(table.bits);
+        const entry = table.entries[this.bits & ((1 << table.bits) - 1)];
+        const length = entry & 0xf;
+        if (length == 0 || length > this.count) throw new Error('Invalid zlib stream');
+        this.bits >>>= length;
+        this.count -= length;
+        return entry >> 4;
+    }
+
+    align() {
+        this.bits >>>= this.count & 7;
+        this.count -= this.count & 7;
+    }
+}
+
+// every index of table.bits low bits maps to symbol << 4 | code length
+function decodeTable(lengths) {
+    const bits = Math.max(1, ...lengths);
+    const entries = new Int32Array(1 << bits);
+    const codes = canonicalCodes(lengths);
+    for (let symbol = 0; symbol < lengths.length; symbol++) {
+        const length = lengths[symbol];
+        if (!length) continue;
+        for (let index = codes[symbol]; index < entries.length; index += 1 << length) entries[index] = (symbol << 4) | length;
+    }
+    return { bits, entries };
+}
+
+let fixedTables = null;
+function getFixedTables() {
+    if (!fixedTables) {
+        const literalLengths = new Array(288).fill(8, 0, 144).fill(9, 144, 256).fill(7, 256, 280).fill(8, 280, 288);
+        fixedTables = [decodeTable(literalLengths), decodeTable(new Array(30).fill(5))];
+    }
+    return fixedTables;
+}
+
+function readDynamicTables(reader) {
+    const literalCount = reader.read(5) + 257;
+    const distanceCount = reader.read(5) + 1;
+    const runLengthCount = reader.read(4) + 4;
+    const runLengthLengths = new Array(19).fill(0);
+    for (let index = 0; index < runLengthCount; index++) runLengthLengths[CODE_LENGTH_ORDER[index]] = reader.read(3);
+    const runLengthTable = decodeTable(runLengthLengths);
+    const lengths = [];
+    while (lengths.length < literalCount + distanceCount) {
+        const symbol = reader.decode(runLengthTable);
+        if (symbol < 16) {
+            lengths.push(symbol);
+            continue;
+        }
+        let length = 0;
+        let repeat;
+        if (symbol == 16) {
+            if (lengths.length == 0) throw new Error('Invalid zlib stream');
+            length = lengths[lengths.length - 1];
+            repeat = reader.read(2) + 3;
+        } else if (symbol == 17) {
+            repeat = reader.read(3) + 3;
+        } else {
+            repeat = reader.read(7) + 11;
+        }
+        for (; repeat > 0; repeat--) lengths.push(length);
+    }
+    if (lengths.length > literalCount + distanceCount) throw new Error('Invalid zlib stream');
+    return [decodeTable(lengths.slice(0, literalCount)), decodeTable(lengths.slice(literalCount))];
+}
+
+export function inflate(data) {
+    if (data.length < 6 || (data[0] & 0x0f) != 8 || ((data[0] << 8) | data[1]) % 31 != 0 || (data[1] & 0x20)) throw new Error('Not a zlib stream');
+    const reader = new BitReader(data, 2);
+    let output = new Uint8Array(Math.max(data.length * 4, 1024));
+    let length = 0;
+    const reserve = (size) => {
+        if (length + size <= output.length) return;
+        let capacity = output.length * 2;
+        while (capacity < length + size) capacity *= 2;
+        const buffer = new Uint8Array(capacity);
+        buffer.set(output.subarray(0, length));
+        output = buffer;
+    };
+    let last = 0;
+    while (!last) {
+        last = reader.read(1);
+        const type = reader.read(2);
+        if (type == 0) {
+            reader.align();
+            const size = reader.read(16);
+            if ((size ^ 0xffff) != reader.read(16)) throw new Error('Invalid zlib stream');
+            // whole bytes are left in the reader after aligning
+            reserve(size);
+            for (let index = 0; index < size; index++) output[length++] = reader.read(8);
+            continue;
+        }
+        if (type == 3) throw new Error('Invalid zlib stream');
+        const [literalTable, distanceTable] = type == 1 ? getFixedTables() : readDynamicTables(reader);
+        while (true) {
+            const symbol = reader.decode(literalTable);
+            if (symbol < 256) {
+                reserve(1);
+                output[length++] = symbol;
+                continue;
+            }
+            if (symbol == 256) break;
+            const lengthCode = symbol - 257;
+            if (lengthCode >= LENGTH_BASE.length) throw new Error('Invalid zlib stream');
+            const matchLength = LENGTH_BASE[lengthCode] + reader.read(LENGTH_EXTRA[lengthCode]);
+            const distanceCode = reader.decode(distanceTable);
+            if (distanceCode >= DISTANCE_BASE.length) throw new Error('Invalid zlib stream');
+            const distance = DISTANCE_BASE[distanceCode] + reader.read(DISTANCE_EXTRA[distanceCode]);
+            if (distance > length) throw new Error('Invalid zlib stream');
+            reserve(matchLength);
+            // byte by byte, the match may overlap what it copies
+            for (let index = 0; index < matchLength; index++, length++) output[length] = output[length - distance];
+        }
+    }
+    reader.align();
+    let checksum = 0;
+    for (let index = 0; index < 4; index++) checksum = (checksum << 8) | reader.read(8);
+    if ((checksum >>> 0) != adler32(output.subarray(0, length))) throw new Error('zlib checksum mismatch');
+    return output.length == length ? output : output.slice(0, length);
+}
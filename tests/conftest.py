@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the comfy/ modules are loaded the way the benchmarks load them, without a running ComfyUI
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from _loader import install_prompt_server
+
+install_prompt_server()
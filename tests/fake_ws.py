@@ -0,0 +1,25 @@
+import json
+import asyncio
+
+# websocket stand-in: records what is sent, the message loop runs until close()
+class FakeWS:
+    def __init__(self):
+        self.sent = []
+        self.closed = asyncio.Event()
+
+    def __aiter__(self):
+        return self._messages()
+
+    async def _messages(self):
+        await self.closed.wait()
+        return
+        yield
+
+    async def send_str(self, data):
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self):
+        self.closed.set()
@@ -0,0 +1,65 @@
+import asyncio
+import concurrent.futures
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from _loader import load_sd_ppp_module
+
+apis = load_sd_ppp_module('apis')
+ImageCache = load_sd_ppp_module('image_cache').ImageCache
+
+BODY = bytes(range(10))
+
+def cache_body():
+    data = concurrent.futures.Future()
+    data.set_result(BODY)
+    return ImageCache.instance().put(data, len(BODY), content_type='application/octet-stream')
+
+# (status, headers, body, still cached) of /finished_images for a fresh entry
+def download(headers=None):
+    async def run():
+        app = web.Application()
+        app.add_routes(apis.PromptServer.instance.routes)
+        image_id = cache_body()
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get('/finished_images', params={'id': image_id}, headers=headers or {})
+            body = await response.read()
+            return response.status, response.headers, body, ImageCache.instance().get_entry(image_id) is not None
+    return asyncio.run(run())
+
+def test_full_download_drops_the_image():
+    status, headers, body, cached = download()
+    assert status == 200
+    assert body == BODY
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert not cached
+
+def test_range_in_the_middle_keeps_the_image():
+    status, headers, body, cached = download({'Range': 'bytes=2-5'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 2-5/10'
+    assert body == BODY[2:6]
+    assert cached
+
+def test_open_range_resumes_to_the_end():
+    status, headers, body, cached = download({'Range': 'bytes=7-'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 7-9/10'
+    assert body == BODY[7:]
+    assert not cached
+
+def test_suffix_range():
+    status, headers, body, cached = download({'Range': 'bytes=-3'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 7-9/10'
+    assert body == BODY[7:]
+
+def test_range_past_the_end_is_416():
+    status, headers, body, cached = download({'Range': 'bytes=20-'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */10'
+    assert cached
+
+def test_malformed_range_is_ignored():
+    status, headers, body, cached = download({'Range': 'lines=1-2'})
+    assert status == 200
+    assert body == BODY
@@ -0,0 +1,55 @@
+from _loader import load_sd_ppp_module
+from fake_ws import FakeWS
+
+PhotoshopInstance = load_sd_ppp_module('photoshop_instance').PhotoshopInstance
+ACTIVE_DOCUMENT_ID = PhotoshopInstance.SPECIAL_DOCUMENT_TO_ID[PhotoshopInstance.SPECIAL_DOCUMENT_USE_ACTIVE]
+
+def layer(layer_id, name):
+    return {'id': layer_id, 'name': name}
+
+def instance_with(layers, layer_versions):
+    instance = PhotoshopInstance(FakeWS(), version=2, features=['layer_delta'])
+    instance.layers = layers
+    instance.layer_versions = layer_versions
+    return instance
+
+def test_full_trees_and_the_active_document():
+    instance = instance_with({}, {})
+    layers, versions = instance.apply_layer_trees([
+        {'id': 1, 'version': 3, 'layers': [layer(10, 'a')]},
+        {'id': 2, 'layers': [layer(20, 'b')]},
+    ], active_document_id=2)
+    assert layers == {1: [layer(10, 'a')], 2: [layer(20, 'b')], ACTIVE_DOCUMENT_ID: [layer(20, 'b')]}
+    # no version, photoshop sends it in full again
+    assert versions == {1: 3}
+
+def test_unchanged_keeps_the_known_layers():
+    instance = instance_with({1: [layer(10, 'a')]}, {1: 3})
+    layers, versions = instance.apply_layer_trees([{'id': 1, 'version': 3, 'unchanged': True}])
+    assert layers == {1: [layer(10, 'a')]}
+    assert versions == {1: 3}
+
+def test_delta_reorders_and_replaces_changed_layers():
+    instance = instance_with({1: [layer(10, 'a'), layer(11, 'b'), layer(12, 'c')]}, {1: 3})
+    layers, versions = instance.apply_layer_trees([
+        {'id': 1, 'version': 4, 'base_version': 3, 'order': [12, 13, 10], 'changed': [layer(13, 'new'), layer(12, 'renamed')]},
+    ])
+    assert layers == {1: [layer(12, 'renamed'), layer(13, 'new'), layer(10, 'a')]}
+    assert versions == {1: 4}
+
+def test_delta_against_another_base_is_dropped():
+    instance = instance_with({1: [layer(10, 'a')]}, {1: 2})
+    layers, versions = instance.apply_layer_trees([
+        {'id': 1, 'version': 4, 'base_version': 3, 'order': [10], 'changed': []},
+    ])
+    # left out with its version, the next get_layers asks for the full tree
+    assert layers == {}
+    assert versions == {}
+
+def test_delta_with_an_unknown_layer_is_dropped():
+    instance = instance_with({1: [layer(10, 'a')]}, {1: 3})
+    layers, versions = instance.apply_layer_trees([
+        {'id': 1, 'version': 4, 'base_version': 3, 'order': [10, 11], 'changed': []},
+    ])
+    assert layers == {}
+    assert versions == {}
@@ -0,0 +1,102 @@
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from _loader import load_sd_ppp_module
+from fake_ws import FakeWS
+
+PhotoshopManager = load_sd_ppp_module('photoshop_manager').PhotoshopManager
+
+FEATURES = ['resume']
+
+def test_session_resumes_the_same_instance():
+    async def run():
+        manager = PhotoshopManager()
+        first_ws = FakeWS()
+        instance = await manager.new_ps_instance(first_ws, '1.2.3.4', 1, 2, FEATURES)
+        assert instance.session is not None
+        instance.layers = {1: [{'id': 10, 'name': 'a'}]}
+        instance.detach()
+        second_ws = FakeWS()
+        resumed = await manager.new_ps_instance(second_ws, '1.2.3.4', 1, 2, FEATURES, session=instance.session)
+        assert resumed is instance
+        assert instance.detached_handle is None
+        assert instance.wsCallsManager.ws is second_ws
+        assert first_ws.closed.is_set()
+        assert instance.layers == {1: [{'id': 10, 'name': 'a'}]}
+        await instance.destroy()
+    asyncio.run(run())
+
+def test_session_of_another_photoshop_starts_fresh():
+    async def run():
+        manager = PhotoshopManager()
+        instance = await manager.new_ps_instance(FakeWS(), '1.2.3.4', 1, 2, FEATURES)
+        other_ip = await manager.new_ps_instance(FakeWS(), '5.6.7.8', 1, 2, FEATURES, session=instance.session)
+        other_user = await manager.new_ps_instance(FakeWS(), '1.2.3.4', 2, 2, FEATURES, session=instance.session)
+        assert other_ip is not instance
+        assert other_user is not instance
+        assert other_ip.session != instance.session
+        await asyncio.gather(instance.destroy(), other_ip.destroy(), other_user.destroy())
+    asyncio.run(run())
+
+def test_unknown_or_unsupported_session_starts_fresh():
+    async def run():
+        manager = PhotoshopManager()
+        instance = await manager.new_ps_instance(FakeWS(), '1.2.3.4', 1, 2, FEATURES, session='unknown')
+        assert instance.session != 'unknown'
+        # without 'resume' no session is handed out or honoured
+        replaced = await manager.new_ps_instance(FakeWS(), '1.2.3.4', 1, 2, [], session=instance.session)
+        assert replaced is not instance
+        assert replaced.session is None
+        assert instance.destroyed
+        await replaced.destroy()
+    asyncio.run(run())
+
+def test_detached_instance_expires_after_the_grace_period():
+    async def run():
+        manager = PhotoshopManager()
+        ws = FakeWS()
+        instance = await manager.new_ps_instance(ws, '1.2.3.4', 1, 2, FEATURES)
+        instance.RESUME_GRACE = 0.01
+        manager.instance_from_client_info('1.2.3.4', 'client', 1)
+        # the connection drops, the loop detaches instead of destroying
+        await ws.close()
+        await instance.run_server_loop(ws)
+        assert not instance.destroyed
+        assert manager.instance_from_client_id('client') is instance
+        await asyncio.sleep(0.05)
+        assert instance.destroyed
+        assert manager.session_to_ps_instance == {}
+        assert manager.instance_from_client_id('client') is None
+        resumed = await manager.new_ps_instance(FakeWS(), '1.2.3.4', 1, 2, FEATURES, session=instance.session)
+        assert resumed is not instance
+        await resumed.destroy()
+    asyncio.run(run())
+
+def test_polls_during_the_grace_period_serve_the_cached_state():
+    apis = load_sd_ppp_module('apis')
+    async def run():
+        manager = apis.PhotoshopManager.instance()
+        ws = FakeWS()
+        instance = await manager.new_ps_instance(ws, '127.0.0.1', 0, 2, FEATURES)
+        instance.documents = [{'id': 1, 'name': 'doc'}]
+        instance.layers = {1: [{'id': 10, 'name': 'a'}]}
+        instance.rebuild_indexes()
+        await ws.close()
+        await instance.run_server_loop(ws)
+        assert not instance.destroyed
+        app = web.Application()
+        app.add_routes(apis.PromptServer.instance.routes)
+        try:
+            async with TestClient(TestServer(app)) as client:
+                query = {'client_id': 'grace', 'user_id': '0'}
+                response = await client.post('/sd-ppp/getlayers', params=dict(query, now='true'), json={'document_str_list': []})
+                assert response.status == 200
+                layers = await response.json()
+                assert layers['matched']
+                assert layers['doc_strs'] == instance.get_documents()
+                response = await client.post('/sd-ppp/checkchanges', params=query, json={'document_str_list': []})
+                assert response.status == 200
+                assert await response.json() == {'is_changed': False}
+        finally:
+            await instance.destroy()
+    asyncio.run(run())
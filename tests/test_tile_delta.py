@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from _loader import load_sd_ppp_module
+
+tile_delta = load_sd_ppp_module('tile_delta')
+ImageCache = load_sd_ppp_module('image_cache').ImageCache
+
+def tile_data(*tiles):
+    return b''.join(np.ascontiguousarray(tile).tobytes() for tile in tiles)
+
+def test_apply_tiles_patches_only_the_listed_tiles():
+    pixels = np.zeros((300, 260, 4), np.uint8)
+    # 2x2 tiles of 256, the right and bottom ones are clipped to 4 and 44 pixels
+    right = np.full((256, 4, 4), 1, np.uint8)
+    bottom_right = np.full((44, 4, 4), 2, np.uint8)
+    tile_delta.apply_tiles(pixels, 256, [1, 3], tile_data(right, bottom_right))
+    assert (pixels[:256, 256:] == 1).all()
+    assert (pixels[256:, 256:] == 2).all()
+    assert (pixels[:, :256] == 0).all()
+
+def test_apply_tiles_rejects_truncated_and_extra_data():
+    pixels = np.zeros((8, 8, 4), np.uint8)
+    tile = np.ones((4, 4, 4), np.uint8)
+    with pytest.raises(ValueError, match='truncated'):
+        tile_delta.apply_tiles(pixels, 4, [0, 1], tile_data(tile))
+    with pytest.raises(ValueError, match='extra'):
+        tile_delta.apply_tiles(pixels, 4, [0], tile_data(tile, tile))
+    with pytest.raises(ValueError, match='outside'):
+        tile_delta.apply_tiles(pixels, 4, [4], tile_data(tile))
+
+def upload(data):
+    return ImageCache.uploads().put(data, len(data))
+
+def test_load_tile_upload_full_then_delta():
+    pixels = np.random.randint(0, 255, (6, 5, 4), np.uint8)
+    base, image, mask = tile_delta.load_tile_upload(None, {
+        'upload_key': upload(pixels.tobytes()), 'encoding': 'raw', 'width': 5, 'height': 6, 'tile_size': 4, 'tile_hashes': ['a', 'b', 'c', 'd'],
+    })
+    assert (base.pixels == pixels).all()
+    assert base.params() == {'tile_size': 4, 'width': 5, 'height': 6, 'hashes': ['a', 'b', 'c', 'd']}
+    assert tuple(image.shape) == (1, 6, 5, 3)
+
+    tile = np.full((2, 1, 4), 255, np.uint8)
+    patched, image, mask = tile_delta.load_tile_upload(base, {
+        'upload_key': upload(tile.tobytes()), 'encoding': 'raw', 'delta': True, 'tiles': [3], 'tile_hashes': ['a', 'b', 'c', 'e'],
+    })
+    assert patched is base
+    assert base.hashes == ['a', 'b', 'c', 'e']
+    assert (base.pixels[4:, 4:] == 255).all()
+    assert (base.pixels[:4] == pixels[:4]).all()
+    assert float(image[0, 5, 4, 0]) == 1.0
+    assert float(mask[0, 5, 4]) == 0.0
+
+def test_load_tile_upload_compressed_delta():
+    base = tile_delta.TileBase(np.zeros((4, 4, 4), np.uint8), 2, ['a', 'b', 'c', 'd'])
+    codec = load_sd_ppp_module('pixel_codecs').get_codec('zlib')
+    tile = np.full((2, 2, 4), 7, np.uint8)
+    tile_delta.load_tile_upload(base, {
+        'upload_key': upload(codec.compress(tile.tobytes())), 'encoding': 'zlib', 'delta': True, 'tiles': [0], 'tile_hashes': ['x', 'b', 'c', 'd'],
+    })
+    assert (base.pixels[:2, :2] == 7).all()
+    assert (base.pixels[2:] == 0).all()
+
+def test_load_tile_upload_delta_needs_a_base():
+    with pytest.raises(ValueError, match='base'):
+        tile_delta.load_tile_upload(None, {'upload_key': upload(b''), 'encoding': 'raw', 'delta': True, 'tiles': [], 'tile_hashes': []})
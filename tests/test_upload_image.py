@@ -0,0 +1,35 @@
+import os
+import asyncio
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from _loader import load_sd_ppp_module
+
+apis = load_sd_ppp_module('apis')
+ImageCache = load_sd_ppp_module('image_cache').ImageCache
+
+# (status, json) of /sd-ppp/upload_image for a multipart form
+def upload(form):
+    async def run():
+        app = web.Application(client_max_size=1 << 30)
+        app.add_routes(apis.PromptServer.instance.routes)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post('/sd-ppp/upload_image', data=form)
+            return response.status, await response.json()
+    return asyncio.run(run())
+
+def test_upload_is_kept_in_memory():
+    # bigger than the size aiohttp's request.post() spools to a temporary file
+    data = os.urandom(3 * 1024 * 1024)
+    form = aiohttp.FormData()
+    form.add_field('image', data, filename='PhotoshopBlob.png', content_type='image/png')
+    status, result = upload(form)
+    assert status == 200
+    assert bytes(ImageCache.uploads().pop(result['upload_key'])) == data
+
+def test_upload_without_image():
+    form = aiohttp.FormData()
+    form.add_field('overwrite', 'true')
+    form.add_field('mask', b'1234', filename='mask.png')
+    status, result = upload(form)
+    assert result == {'error': 'image is required'}
@@ -0,0 +1,29 @@
+import asyncio
+from _loader import load_sd_ppp_module
+from fake_ws import FakeWS
+
+PhotoshopManager = load_sd_ppp_module('photoshop_manager').PhotoshopManager
+
+async def watching_instance(manager, client_id):
+    instance = await manager.new_ps_instance(FakeWS(), '1.2.3.4', 1, 2, [])
+    assert manager.instance_from_client_info('1.2.3.4', client_id, 1) is instance
+    instance.watched_layers[client_id] = {(1, 10, 10)}
+    return instance
+
+def test_evicted_client_stops_watching():
+    async def run():
+        manager = PhotoshopManager()
+        instance = await watching_instance(manager, 'client')
+        manager.evict_idle_clients(now=manager.client_id_last_seen['client'] + manager.CLIENT_IDLE_TIMEOUT + 1)
+        assert instance.watched_layers == {}
+        await instance.destroy()
+    asyncio.run(run())
+
+def test_clients_of_a_disconnected_photoshop_stop_watching():
+    async def run():
+        manager = PhotoshopManager()
+        instance = await watching_instance(manager, 'client')
+        await instance.destroy()
+        assert instance.watched_layers == {}
+        assert manager.instance_from_client_id('client') is None
+    asyncio.run(run())
@@ -0,0 +1,133 @@
+import asyncio
+import pytest
+from _loader import load_sd_ppp_module
+from fake_ws import FakeWS
+
+ws_call_manager = load_sd_ppp_module('ws_call_manager')
+
+def new_manager(max_concurrent_calls=1):
+    manager = ws_call_manager.WSCallsManager(FakeWS())
+    manager.MAX_CONCURRENT_CALLS = max_concurrent_calls
+    return manager
+
+# read only calls reach the scheduler through one more task
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+async def wait_sent(manager, count):
+    for _ in range(100):
+        if len(manager.ws.sent) >= count:
+            return
+        await asyncio.sleep(0)
+    raise AssertionError(f'{len(manager.ws.sent)} calls sent, expected {count}')
+
+def test_queued_calls_run_by_priority_then_arrival():
+    async def run():
+        manager = new_manager()
+        calls = [asyncio.ensure_future(manager.call('send_images', {'n': 0}))]
+        await wait_sent(manager, 1)
+        for (n, action) in enumerate(['get_image', 'get_layers', 'send_images', 'get_active_history_state_id'], 1):
+            calls.append(asyncio.ensure_future(manager.call(action, {'n': n})))
+        await settle()
+        assert manager.stats()['queued'] == 4
+        order = []
+        while len(order) < len(calls):
+            await wait_sent(manager, len(order) + 1)
+            message = manager.ws.sent[len(order)]
+            order.append(message['params']['n'])
+            manager.handle_call(message['call_id'], result={'n': message['params']['n']})
+        assert [call['n'] for call in await asyncio.gather(*calls)] == [0, 1, 2, 3, 4]
+        return order
+    assert asyncio.run(run()) == [0, 4, 2, 1, 3]
+
+def test_identical_read_only_calls_share_one_request():
+    async def run():
+        manager = new_manager(4)
+        calls = [asyncio.ensure_future(manager.call('get_active_history_state_id', {'document_id_list': [1]})) for _ in range(3)]
+        other = asyncio.ensure_future(manager.call('get_active_history_state_id', {'document_id_list': [2]}))
+        await wait_sent(manager, 2)
+        await settle()
+        assert len(manager.ws.sent) == 2
+        for message in manager.ws.sent:
+            manager.handle_call(message['call_id'], result={'history_state_id': message['params']['document_id_list']})
+        results = await asyncio.gather(*calls)
+        assert results == [{'history_state_id': [1]}] * 3
+        assert await other == {'history_state_id': [2]}
+        assert manager.coalesced_calls == 2
+        assert manager.single_flight_calls == {}
+    asyncio.run(run())
+
+def test_one_waiter_giving_up_keeps_the_shared_call():
+    async def run():
+        manager = new_manager()
+        first = asyncio.ensure_future(manager.call('get_layers', {}))
+        second = asyncio.ensure_future(manager.call('get_layers', {}))
+        await wait_sent(manager, 1)
+        first.cancel()
+        manager.handle_call(manager.ws.sent[0]['call_id'], result={'layers': []})
+        assert await second == {'layers': []}
+    asyncio.run(run())
+
+def test_slot_handed_to_a_cancelled_waiter_moves_on():
+    async def run():
+        manager = new_manager()
+        await manager._acquire_slot(2)
+        cancelled = asyncio.ensure_future(manager._acquire_slot(2))
+        next_in_line = asyncio.ensure_future(manager._acquire_slot(2))
+        await asyncio.sleep(0)
+        # the slot is handed over, the waiter is cancelled before it gets to run
+        manager._release_slot()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await asyncio.wait_for(next_in_line, 1)
+        assert manager.running_calls == 1
+        manager._release_slot()
+        assert manager.running_calls == 0
+    asyncio.run(run())
+
+def test_waiter_cancelled_while_queued_takes_no_slot():
+    async def run():
+        manager = new_manager()
+        await manager._acquire_slot(2)
+        cancelled = asyncio.ensure_future(manager._acquire_slot(0))
+        next_in_line = asyncio.ensure_future(manager._acquire_slot(2))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        manager._release_slot()
+        await asyncio.wait_for(next_in_line, 1)
+        assert manager.running_calls == 1
+    asyncio.run(run())
+
+def test_calls_fail_when_the_message_loop_ends():
+    async def run():
+        manager = new_manager()
+        loop = asyncio.ensure_future(manager.message_loop())
+        calls = [asyncio.ensure_future(manager.call('get_image', {'n': n})) for n in range(3)]
+        await wait_sent(manager, 1)
+        assert manager.stats()['queued'] == 2
+        await manager.ws.close()
+        await loop
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(result, ConnectionError) for result in results)
+        assert manager.stats()['running'] == 0
+        with pytest.raises(ConnectionError):
+            await manager.call('get_image', {})
+    asyncio.run(run())
+
+def test_call_events_are_counted_when_they_happen():
+    Metrics = load_sd_ppp_module('metrics').Metrics
+    def coalesced():
+        return Metrics.instance().counters.get(('sd_ppp_call_events_total', (('event', 'coalesced'),)), 0)
+    async def run():
+        manager = new_manager()
+        calls = [asyncio.ensure_future(manager.call('get_layers', {})) for _ in range(2)]
+        await wait_sent(manager, 1)
+        manager.handle_call(manager.ws.sent[0]['call_id'], result={})
+        await asyncio.gather(*calls)
+    before = coalesced()
+    asyncio.run(run())
+    # kept once the connection is gone, a counter never goes down
+    assert coalesced() == before + 1